@@ -2,31 +2,60 @@ import streamlit as st
 from PIL import Image
 import io
 import yaml
-from google.cloud import storage
 import datetime
-import pandas as pd
 import os
-
-from src.workflow import SubmitQueryRequest, QueryRepsonse, build_workflow
-
-# workflow code
-graph  = build_workflow()
-def submit_query_endpoint(request:SubmitQueryRequest) -> QueryRepsonse:
-    """ invoke the graph and return reposne"""
-    state = graph.invoke({"question":request})
-    return QueryRepsonse(
-    solution_pathway = state.get("solution_pathway", None),
-    reason = state.get("feedback", None),
-    value_points = state.get("value_points", None),
-    mark= state.get("mark", 0.0),
-    extracted_answer = state.get("student_answer_text", None),
-    content_analysis = state.get("content_analysis", None),
-    cost = state.get("cost", 0.0),
-    input_tokens = state.get("input_tokens", 0.0), 
-    output_tokens = state.get("output_tokens", 0.0),
-    success = state.get("success", True),
-    error_message = state.get("error_message", None)
-    )
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+load_dotenv()
+
+# workflow code, the graph is compiled on the first submission and reused across reruns
+from src.workflow import SubmitQueryRequest, QueryRepsonse, stream_query
+
+# progress labels of the graph nodes
+NODE_LABELS = {
+    "image_preprocessor": "Preparing answer images",
+    "extractor": "Reading your handwritten answer",
+    "dedupe": "Looking for an identical graded answer",
+    "solution_pathway_analyzer": "Identifying your solution approach",
+    "content_analyzer": "Analysing your answer",
+    "feedback_generator": "Grading and writing feedback",
+    "fused_analyzer": "Analysing and grading your answer",
+    "mark_validation": "Checking the marks",
+    "value_point_analyzer": "Assessing value points",
+}
+
+def stream_query_endpoint(request:SubmitQueryRequest, status, analysis_placeholder) -> QueryRepsonse:
+    """ grade the request, showing node progress and the analysis text while they arrive"""
+    analysis = ""
+    response = None
+    for event in stream_query(request):
+        if event["type"] == "node" and event["status"] == "started" and event["node"] in NODE_LABELS:
+            status.update(label=f"{NODE_LABELS[event['node']]}...")
+            status.write(NODE_LABELS[event["node"]])
+        elif event["type"] == "partial" and event["field"] == "content_analysis":
+            analysis += event["text"]
+            analysis_placeholder.markdown(analysis)
+        elif event["type"] == "result":
+            response = event["response"]
+    return response
+
+# archive uploaded answers to GCP without blocking the grading
+@st.cache_resource
+def get_archive_executor():
+    """ single background worker shared across reruns"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="gcs-archive")
+
+def archive_image_to_gcs(image_bytes, object_name, content_type, service_account_path, bucket_name):
+    """ Upload the answer image to the GCP bucket"""
+    try:
+        from google.cloud import storage
+        client = storage.Client.from_service_account_json(service_account_path)
+        bucket = client.bucket(bucket_name)
+        blob = bucket.blob(object_name)
+        blob.upload_from_string(image_bytes, content_type=content_type)
+    except Exception as e:
+        logging.getLogger(__name__).error(f"Error archiving image to GCP: {e}")
 
 # Configure the page
 st.set_page_config(page_title="Quiz App", layout="wide")
@@ -111,42 +140,27 @@ col1, col2, col3 = st.columns([1, 1, 2])
 with col1:
     if st.button("🔍 Evaluate", type="primary", use_container_width=True):
         
-        with st.spinner("Evaluating your answer..."):
+        with st.status("Evaluating your answer...", expanded=True) as status:
 
-            # Upload the image to GCP and return a signed url 
             # GCP Configuration
             service_account_path = os.environ.get("GEMINI_SERVICE_ACCOUNT_KEY")
             bucket_name = os.environ.get("GEMINI_BUCKET_NAME")
 
-            # Upload image to GCP and generate signed URL if image exists
+            # The uploaded page is graded straight from memory
+            answer_images = []
             if uploaded_image is not None:
-                try:
+                uploaded_image.seek(0)  # Reset file pointer
+                image_bytes = uploaded_image.read()
+                answer_images.append(image_bytes)
+
+                # Archive to GCP in the background, grading does not wait for the upload
+                if bucket_name:
                     # Create a unique filename using question_id and timestamp
                     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
                     file_extension = uploaded_image.name.split('.')[-1]
                     object_name = f"{current_question_id}_{timestamp}.{file_extension}"
-                    
-                    # Initialize GCP client and upload
-                    client = storage.Client.from_service_account_json(service_account_path)
-                    bucket = client.bucket(bucket_name)
-                    blob = bucket.blob(object_name)
-                    
-                    # Upload the image
-                    uploaded_image.seek(0)  # Reset file pointer
-                    blob.upload_from_file(uploaded_image, content_type=uploaded_image.type)
-                    
-                    # Generate signed URL
-                    signed_url = blob.generate_signed_url(
-                        expiration=datetime.timedelta(hours=1),
-                        version="v4",
-                        method="GET"
-                    )
-                    
-                    st.success(f"Image uploaded successfully!!")
-                    
-                except Exception as e:
-                    st.error(f"Error uploading image to GCP: {e}")
-                    signed_url = None
+                    get_archive_executor().submit(
+                        archive_image_to_gcs, image_bytes, object_name, uploaded_image.type, service_account_path, bucket_name)
             
             # create test request
             test_request = SubmitQueryRequest(
@@ -163,10 +177,14 @@ with col1:
             rubrics_for_evaluation = current_question_details['rubrics_for_evaluation'],
             student_answer_typed = text_answer,
             handwritten = True,
-            student_answer_image_urls = [signed_url],
+            student_answer_image_urls = [],
+            student_answer_images = answer_images,
             complexity = current_question_details['complexity'])
 
-            response = submit_query_endpoint(request=test_request)
+            # progress and the analysis are shown while the answer is graded
+            analysis_placeholder = st.empty()
+            response = stream_query_endpoint(test_request, status, analysis_placeholder)
+            status.update(label="Evaluation complete", state="complete" if response.success else "error", expanded=False)
 
             score = response.mark  
             feedback = response.reason.criteria 
@@ -203,6 +221,7 @@ if st.session_state.show_result and st.session_state.current_result:
     # Feedback display
     st.markdown("### Feedback")
     # Convert to DataFrame
+    import pandas as pd
     df = pd.DataFrame(result['feedback'], columns=["Criteria", "Marks", "Feedback"])
     #dispaly table
     st.dataframe(df, use_container_width=True,hide_index=True)
@@ -0,0 +1,108 @@
+"""
+Offline load benchmark on the fake LLM backend.
+
+Grades the questions of test_questions.yaml many times at increasing concurrency and
+reports throughput and latency percentiles. A run with zero simulated latency measures
+the graph overhead per submission. With --replay the LLM responses and their timing come
+from recorded traffic (see llm_traffic in config/settings.yaml) instead of the fake
+backend, run it before and after a change to compare throughput and p95 latency.
+
+    python -m benchmarks.fake_load --submissions 200 --concurrency 1 10 50
+    python -m benchmarks.fake_load --latency 0 --submissions 500
+    python -m benchmarks.fake_load --requests submissions.jsonl --replay recordings/llm_traffic.jsonl
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+os.environ["LLM_BACKEND"] = "fake"
+
+import yaml
+
+from config import settings
+from src.llm.router import percentile
+from src.workflow import SubmitQueryRequest, asubmit_query
+from src.workflow.batch import load_requests
+
+
+def load_test_requests(path: Path) -> List[SubmitQueryRequest]:
+    """ Requests built from the test questions, each with a single inline answer page"""
+    with open(path, "r", encoding="utf-8") as f:
+        questions = yaml.safe_load(f)["test_questions"]
+    requests = []
+    for question in questions:
+        fields = {key: value for key, value in question.items() if key in SubmitQueryRequest.model_fields}
+        fields.update(student_answer_images=[b"fake answer page"], student_answer_image_urls=[])
+        requests.append(SubmitQueryRequest(**fields))
+    return requests
+
+async def run_level(requests: List[SubmitQueryRequest], submissions: int, concurrency: int) -> dict:
+    """ Grade the submissions with at most `concurrency` in flight and summarise the latencies"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def grade(request):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            response = await asubmit_query(request)
+            latencies.append(time.perf_counter() - start)
+            failures += not response.success
+
+    start = time.perf_counter()
+    await asyncio.gather(*(grade(requests[i % len(requests)]) for i in range(submissions)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "throughput": submissions / elapsed,
+        "p50": statistics.median(latencies),
+        "p95": percentile(latencies, 0.95),
+        "failures": failures,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure graph throughput and latency on the fake LLM backend")
+    parser.add_argument("--submissions", type=int, default=100, help="submissions graded per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50], help="concurrency levels")
+    parser.add_argument("--latency", type=float, default=None, help="fixed simulated latency of every call in seconds")
+    parser.add_argument("--failure-rate", type=float, default=None, help="fraction of failing calls")
+    parser.add_argument("--questions", default=str(project_root / "test_questions.yaml"))
+    parser.add_argument("--requests", default=None, help="JSONL/YAML submissions to grade instead of the test questions")
+    parser.add_argument("--replay", default=None, metavar="TRAFFIC", help="replay recorded LLM traffic from this JSONL file")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="factor applied to the replayed latencies")
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        os.environ["LLM_TRAFFIC_MODE"] = "replay"
+        settings["llm_traffic"].update(path=args.replay, time_scale=args.time_scale)
+
+    if args.latency is not None:
+        settings["fake_llm"].update(latency={"distribution": "fixed", "mean_seconds": args.latency}, models={})
+    if args.failure_rate is not None:
+        settings["fake_llm"]["failure_rate"] = args.failure_rate
+    # no network or image decoding in the benchmark
+    settings["image_preprocessing"]["enabled"] = False
+    # every submission is graded in full, repeated test questions would otherwise reuse their grades
+    settings["dedupe"]["enabled"] = False
+
+    requests = load_requests(args.requests) if args.requests else load_test_requests(Path(args.questions))
+    for concurrency in args.concurrency:
+        result = asyncio.run(run_level(requests, args.submissions, concurrency))
+        print(f"|| concurrency {result['concurrency']:4d} : {result['throughput']:8.1f} submissions/s, "
+              f"p50 {result['p50'] * 1000:8.1f} ms, p95 {result['p95'] * 1000:8.1f} ms, {result['failures']} failed ||")
+    if args.replay:
+        from src.llm.recording import get_traffic_log
+        print(f"|| replayed exchanges : {get_traffic_log(args.replay).stats()} ||")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Fused single call analysis against the three call analysis.
+
+Grades every numerical submission of the fused_analysis complexities with both graph
+variants and reports their latency, cost and how often they award the same mark. On the
+fake backend (default) the latency and cost of the call structure are compared; mark
+agreement is only meaningful on the real backend.
+
+    python -m benchmarks.fused_analysis --runs 5
+    python -m benchmarks.fused_analysis --backend gemini --requests submissions.jsonl
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+
+def summarise(name: str, latencies: List[float], costs: List[float], failures: int) -> str:
+    from src.llm.router import percentile
+    latencies = sorted(latencies)
+    return (f"|| {name:10s} : p50 {statistics.median(latencies) * 1000:8.1f} ms, "
+            f"p95 {percentile(latencies, 0.95) * 1000:8.1f} ms, "
+            f"cost {statistics.mean(costs):.6f} $/submission, {failures} failed ||")
+
+async def compare(requests, runs: int, concurrency: int):
+    """ Grade every request with both variants, return the per variant results in request order"""
+    from src.workflow import asubmit_query
+    from src.workflow.endpoint import get_graph
+    graphs = {"three_call": get_graph(asynchronous=True, fused=False), "fused": get_graph(asynchronous=True, fused=True)}
+    semaphore = asyncio.Semaphore(concurrency)
+    results = {name: [] for name in graphs}
+
+    async def grade(name, request):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await asubmit_query(request, graph=graphs[name])
+            return time.perf_counter() - start, response
+
+    for name in graphs:
+        jobs = [request for _ in range(runs) for request in requests]
+        results[name] = await asyncio.gather(*(grade(name, request) for request in jobs))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the fused single call analysis with the three call analysis")
+    parser.add_argument("--backend", choices=["fake", "gemini"], default="fake", help="LLM backend of the comparison")
+    parser.add_argument("--runs", type=int, default=3, help="times every submission is graded per variant")
+    parser.add_argument("--concurrency", type=int, default=4, help="submissions in flight")
+    parser.add_argument("--questions", default=str(project_root / "test_questions.yaml"))
+    parser.add_argument("--requests", default=None, help="JSONL/YAML submissions to grade instead of the test questions")
+    args = parser.parse_args(argv)
+
+    from benchmarks.fake_load import load_test_requests
+    # set after the import, the load benchmark module selects the fake backend
+    os.environ["LLM_BACKEND"] = args.backend
+    from config import settings
+    from src.workflow.batch import load_requests
+    # both variants must grade every submission, a reused grade would hide the difference
+    settings["dedupe"]["enabled"] = False
+    if args.backend == "fake":
+        settings["image_preprocessing"]["enabled"] = False
+
+    requests = load_requests(args.requests) if args.requests else load_test_requests(Path(args.questions))
+    complexities = settings.get("fused_analysis", {}).get("complexities", ["basic"])
+    requests = [request for request in requests if request.type == "numerical_problem" and request.complexity in complexities]
+    if not requests:
+        print(f"|| No numerical submissions of complexity {complexities} to compare ||")
+        return
+
+    results = asyncio.run(compare(requests, args.runs, args.concurrency))
+    for name, graded in results.items():
+        print(summarise(name, [latency for latency, _ in graded], [response.cost for _, response in graded],
+                        sum(not response.success for _, response in graded)))
+
+    pairs = [(three.mark, fused.mark) for (_, three), (_, fused) in zip(results["three_call"], results["fused"])
+             if three.success and fused.success]
+    if pairs:
+        agreement = sum(three == fused for three, fused in pairs) / len(pairs)
+        difference = statistics.mean(abs((three or 0) - (fused or 0)) for three, fused in pairs)
+        print(f"|| mark agreement : {agreement:.0%} identical, mean absolute difference {difference:.2f} marks over {len(pairs)} submissions ||")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Cold start import benchmark.
+
+Imports each module in a fresh interpreter with `python -X importtime`, reports the
+cumulative import time and the heaviest imports, and exits non zero when a module is
+slower than its budget, so a regression in start up time fails the check.
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --budget src.workflow=300 --top 15
+"""
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+project_root = Path(__file__).parent.parent
+
+# cumulative import time budget in milliseconds
+DEFAULT_BUDGETS = {
+    "config": 150,
+    "src.llm": 400,
+    "src.workflow": 400,
+    "src.workflow.endpoint": 500,
+}
+
+
+def measure(module: str) -> List[Tuple[str, float, float]]:
+    """ Import the module in a fresh interpreter and return (name, self ms, cumulative ms) per import"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=project_root, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        imports.append((name.strip(), int(self_us) / 1000, int(cumulative_us) / 1000))
+    return imports
+
+def report(module: str, budget: float, top: int) -> bool:
+    """ Print the import time of a module and its heaviest imports, return False when over budget"""
+    imports = measure(module)
+    total = next(cumulative for name, _, cumulative in reversed(imports) if name == module)
+    within_budget = total <= budget
+    print(f"|| {module}: {total:.1f} ms (budget {budget:.0f} ms) {'ok' if within_budget else 'OVER BUDGET'} ||")
+    for name, self_ms, cumulative_ms in sorted(imports, key=lambda item: item[1], reverse=True)[:top]:
+        print(f"    {self_ms:8.1f} ms self {cumulative_ms:8.1f} ms cumulative  {name}")
+    return within_budget
+
+def parse_budgets(values: List[str]) -> Dict[str, float]:
+    budgets = dict(DEFAULT_BUDGETS)
+    for value in values:
+        module, _, milliseconds = value.partition("=")
+        budgets[module] = float(milliseconds)
+    return budgets
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure cold start import time against per module budgets")
+    parser.add_argument("--budget", action="append", default=[], metavar="MODULE=MS",
+                        help="cumulative import budget of a module in milliseconds, may be repeated")
+    parser.add_argument("--top", type=int, default=10, help="number of heaviest imports listed per module")
+    args = parser.parse_args(argv)
+
+    budgets = parse_budgets(args.budget)
+    results = [report(module, budget, args.top) for module, budget in budgets.items()]
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Load test of the HTTP grading service.
+
+Clients submit the questions of test_questions.yaml at a fixed arrival rate and long-poll
+their results. Reports accepted and refused (429) submissions, throughput and end to end
+latency percentiles. By default the service runs in this process on the fake LLM backend
+(driven through httpx without a network server); --url targets a running service instead.
+
+    python -m benchmarks.service_load --submissions 500 --rate 100 --workers 20 --queue-size 50
+    python -m benchmarks.service_load --url http://127.0.0.1:8000 --submissions 200 --rate 20
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+
+async def run_load(client: httpx.AsyncClient, requests, submissions: int, rate: float, retries: int) -> dict:
+    """ Submit `submissions` requests at `rate` per second and wait for all of their results"""
+    from src.llm.router import percentile
+    latencies = []
+    counts = {"accepted": 0, "refused": 0, "failed": 0}
+
+    async def submit(index: int):
+        await asyncio.sleep(index / rate)
+        start = time.perf_counter()
+        payload = requests[index % len(requests)].model_dump_json()
+        for attempt in range(retries + 1):
+            reply = await client.post("/v1/submissions", content=payload, headers={"content-type": "application/json"})
+            if reply.status_code != 429:
+                break
+            counts["refused"] += 1
+            if attempt < retries:
+                await asyncio.sleep(float(reply.headers.get("retry-after", 1)))
+        if reply.status_code != 202:
+            return
+        counts["accepted"] += 1
+        request_id = reply.headers["x-request-id"]
+        while True:
+            result = await client.get(f"/v1/submissions/{request_id}/result", params={"wait": 30})
+            if result.status_code != 202:
+                break
+        latencies.append(time.perf_counter() - start)
+        counts["failed"] += result.status_code != 200 or not result.json().get("success", False)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(submit(index) for index in range(submissions)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        **counts,
+        "throughput": len(latencies) / elapsed,
+        "p50": statistics.median(latencies) if latencies else 0.0,
+        "p95": percentile(latencies, 0.95) if latencies else 0.0,
+    }
+
+async def run_in_process(args, requests) -> dict:
+    from src.workflow.service import GradingService, create_app
+    service = GradingService(queue_size=args.queue_size, workers=args.workers)
+    # httpx drives the app without the ASGI lifespan, the workers are started here
+    await service.start()
+    try:
+        transport = httpx.ASGITransport(app=create_app(service))
+        async with httpx.AsyncClient(transport=transport, base_url="http://service", timeout=None) as client:
+            result = await run_load(client, requests, args.submissions, args.rate, args.retries)
+    finally:
+        await service.stop()
+    return {**result, "service": service.health()}
+
+async def run_remote(args, requests) -> dict:
+    async with httpx.AsyncClient(base_url=args.url, timeout=None) as client:
+        return await run_load(client, requests, args.submissions, args.rate, args.retries)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the HTTP grading service")
+    parser.add_argument("--url", default=None, help="base url of a running service, default runs one in process")
+    parser.add_argument("--submissions", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=50.0, help="submissions per second")
+    parser.add_argument("--retries", type=int, default=0, help="times a refused (429) submission is retried after Retry-After")
+    parser.add_argument("--workers", type=int, default=20, help="service workers (in process only)")
+    parser.add_argument("--queue-size", type=int, default=100, help="service queue size (in process only)")
+    parser.add_argument("--latency", type=float, default=None, help="fixed simulated latency of every call in seconds")
+    parser.add_argument("--questions", default=str(project_root / "test_questions.yaml"))
+    args = parser.parse_args(argv)
+
+    from benchmarks.fake_load import load_test_requests
+    from config import settings
+    if args.latency is not None:
+        settings["fake_llm"].update(latency={"distribution": "fixed", "mean_seconds": args.latency}, models={})
+    # no network or image decoding, every submission graded in full
+    settings["image_preprocessing"]["enabled"] = False
+    settings["dedupe"]["enabled"] = False
+
+    requests = load_test_requests(Path(args.questions))
+    result = asyncio.run(run_remote(args, requests) if args.url else run_in_process(args, requests))
+    print(f"|| {result['accepted']} accepted, {result['refused']} refused (429), {result['failed']} failed : "
+          f"{result['throughput']:.1f} submissions/s, p50 {result['p50'] * 1000:.1f} ms, p95 {result['p95'] * 1000:.1f} ms ||")
+    if "service" in result:
+        print(f"|| service : {result['service']} ||")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ prompt imports
 """
 
 import os
+import hashlib
 import yaml
 from pathlib import Path
 from string import Formatter
@@ -12,18 +13,138 @@ _config_dir = Path(os.path.dirname(os.path.abspath(__file__)))
 _system_prompt_path = _config_dir / "system_prompts.yaml"
 _user_prompts_path = _config_dir / "user_prompts.yaml"
 _model_path = _config_dir / "models.yaml"
+_settings_path = _config_dir / "settings.yaml"
 
-# Load the prompts from YAML
-with open(_system_prompt_path, "r") as f:
-    system_prompts = yaml.safe_load(f)
+# YAML files are parsed on first access (PEP 562 module __getattr__) so importing config is cheap
+_yaml_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+def _load_yaml(path):
+    with open(path, "r") as f:
+        return yaml.load(f, Loader=_yaml_loader)
+
+def _compile_system_prompts():
+    return {name: PromptTemplate(name, text, literal=True) for name, text in _lazy("system_prompts").items()}
+
+def _compile_user_prompts():
+    return {name: PromptTemplate(name, text) for name, text in _lazy("user_prompts").items()}
+
+def _prompt_versions():
+    # prompt version hashes, keyed "system:<name>" / "user:<name>", for cache keys and logging
+    return {
+        **{f"system:{name}": template.version for name, template in _lazy("system_prompt_templates").items()},
+        **{f"user:{name}": template.version for name, template in _lazy("user_prompt_templates").items()},
+    }
+
+def _prompts_version():
+    # single version of the whole prompt set
+    return hashlib.sha256(
+        "".join(f"{name}={version};" for name, version in sorted(_lazy("prompt_versions").items())).encode("utf-8")).hexdigest()[:12]
+
+_lazy_attributes = {
+    "system_prompts": lambda: _load_yaml(_system_prompt_path),
+    "user_prompts": lambda: _load_yaml(_user_prompts_path),
+    "_model_file": lambda: _load_yaml(_model_path),
+    # model entries and the routing section share config/models.yaml
+    "models": lambda: {name: entry for name, entry in _lazy("_model_file").items() if name != "routing"},
+    "routing": lambda: _lazy("_model_file").get("routing", {}),
+    "settings": lambda: _load_yaml(_settings_path),
+    "system_prompt_templates": _compile_system_prompts,
+    "user_prompt_templates": _compile_user_prompts,
+    "prompt_versions": _prompt_versions,
+    "prompts_version": _prompts_version,
+}
+
+def __getattr__(name):
+    if name not in _lazy_attributes:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = _lazy_attributes[name]()
+    globals()[name] = value
+    return value
+
+def _lazy(name):
+    """ module level access to a lazy attribute from inside this module"""
+    return globals()[name] if name in globals() else __getattr__(name)
+
+
+# parameters that change with every student, everything before the first of them is question scoped
+STUDENT_SCOPED_PARAMS = {"student_answer", "reason_for_classification", "content_analysis_output"}
+
+
+class PromptTemplate:
+    """
+    Prompt template compiled once, when the prompt files are first loaded.
+
+    Holds the parameter set, a content hash used as the prompt version, and the
+    template of the question scoped prefix, so rendering only formats.
+    """
+    __slots__ = ("name", "text", "params", "version", "_prefix_text")
+
+    def __init__(self, name, text, literal=False):
+        """
+        Args:
+            name: Name of the prompt in the YAML file
+            text: Template text
+            literal: The text is used as is (system prompts), no parameters are parsed
+        """
+        self.name = name
+        self.text = text
+        self.version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+        self.params = frozenset()
+        self._prefix_text = text
+        if literal:
+            return
+        params = set()
+        prefix = []
+        in_prefix = True
+        for literal_text, param, spec, conversion in Formatter().parse(text):
+            if in_prefix:
+                prefix.append(literal_text.replace("{", "{{").replace("}", "}}"))
+            if param is None:
+                continue
+            params.add(param)
+            if param in STUDENT_SCOPED_PARAMS:
+                in_prefix = False
+            if in_prefix:
+                prefix.append("{" + param + (f"!{conversion}" if conversion else "") + (f":{spec}" if spec else "") + "}")
+        self.params = frozenset(params)
+        self._prefix_text = "".join(prefix)
+
+    def _check(self, kwargs):
+        missing_params = self.params - kwargs.keys()
+        if missing_params:
+            raise ValueError(f"Missing required parameters for template '{self.name}': {set(missing_params)}")
+
+    def render(self, **kwargs):
+        """ Format the template, raises ValueError if parameters are missing"""
+        self._check(kwargs)
+        return self.text.format(**kwargs)
+
+    def render_parts(self, **kwargs):
+        """ Format the template split into (question scoped prefix, remainder)"""
+        self._check(kwargs)
+        user_prompt = self.text.format(**kwargs)
+        prefix = self._prefix_text.format(**kwargs)
+        return prefix, user_prompt[len(prefix):]
 
-# Load the prompts from YAML
-with open(_model_path, "r") as f:
-    models = yaml.safe_load(f)
-    
-# Load the prompt templates from YAML
-with open(_user_prompts_path, "r") as f:
-    user_prompts = yaml.safe_load(f)
+
+def validate_prompts(system_prompt_names=(), user_prompt_names=()):
+    """
+    Check that every referenced prompt exists.
+
+    Raises:
+        KeyError: listing all missing prompts
+    """
+    missing = [f"system_prompts.yaml:{name}" for name in system_prompt_names if name not in _lazy("system_prompt_templates")]
+    missing += [f"user_prompts.yaml:{name}" for name in user_prompt_names if name not in _lazy("user_prompt_templates")]
+    if missing:
+        raise KeyError(f"Prompts referenced by the workflow are missing: {missing}")
+
+
+def _user_prompt_template(user_prompt_name):
+    user_prompt_templates = _lazy("user_prompt_templates")
+    if user_prompt_name not in user_prompt_templates:
+        raise KeyError(f"User Prompt:  '{user_prompt_name}' not found in user_prompts.yaml")
+    return user_prompt_templates[user_prompt_name]
 
 
 def format_user_prompt(user_prompt_name, **kwargs):
@@ -41,17 +162,17 @@ def format_user_prompt(user_prompt_name, **kwargs):
         KeyError: If user pormpt name doesn't exist
         ValueError: If required parameters are missing
     """
-    if user_prompt_name not in user_prompts:
-        raise KeyError(f"User Prompt:  '{user_prompt_name}' not found in user_prompts.yaml")
-    
-    user_prompt = user_prompts[user_prompt_name]
-    
-    # Check for missing parameters
-    required_params = {param for _, param, _, _ in Formatter().parse(user_prompt) if param}
-    missing_params = required_params - set(kwargs.keys())
-    
-    if missing_params:
-        raise ValueError(f"Missing required parameters for template '{user_prompt_name}': {missing_params}")
-    
-    # Format the template
-    return user_prompt.format(**kwargs)
+    return _user_prompt_template(user_prompt_name).render(**kwargs)
+
+
+def format_user_prompt_parts(user_prompt_name, **kwargs):
+    """
+    Format a user prompt template and split it into a question scoped prefix and the rest.
+
+    The prefix ends where the first student scoped parameter starts, so it is identical for
+    every student answering the same question and can be cached on the provider side.
+
+    Returns:
+        (prefix, remainder) tuple, prefix + remainder is the formatted prompt
+    """
+    return _user_prompt_template(user_prompt_name).render_parts(**kwargs)
@@ -5,5 +5,26 @@ This module provides interfaces for various LLM services.
 
 
 from .base import LLMClient
-from .gemini_client import GeminiClient
-__all__ = ["LLMClient", "GeminiClient"]
+from .registry import ClientRegistry, get_client, get_registry
+__all__ = ["LLMClient", "GeminiClient", "ClientRegistry", "get_client", "get_registry",
+           "CachedLLMClient", "ResponseCache", "get_response_cache", "FakeLLMClient",
+           "RecordingLLMClient", "ReplayLLMClient"]
+
+# clients pulling in provider SDKs are imported on first use to keep start up fast
+_lazy_imports = {
+    "GeminiClient": ".gemini_client",
+    "CachedLLMClient": ".cache",
+    "ResponseCache": ".cache",
+    "get_response_cache": ".cache",
+    "FakeLLMClient": ".fake_client",
+    "RecordingLLMClient": ".recording",
+    "ReplayLLMClient": ".recording",
+}
+
+def __getattr__(name):
+    if name not in _lazy_imports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    value = getattr(importlib.import_module(_lazy_imports[name], __name__), name)
+    globals()[name] = value
+    return value
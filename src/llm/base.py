@@ -2,8 +2,9 @@
 Base implementation for LLM service 
 """
 
+import asyncio
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Union, Any
+from typing import Callable, Dict, List, Optional, Union, Any
 from pydantic import BaseModel
 
 class LLMClient(ABC):
@@ -48,4 +49,44 @@ class LLMClient(ABC):
         Returns:
             Generated response structure 
         """
-        pass
\ No newline at end of file
+        pass
+
+    async def agenerate(self, system_prompt: Optional[str], user_prompt: str, **kwargs) -> BaseModel:
+        """Awaitable version of generate.
+
+        Clients without a native async API run the blocking call in a worker thread.
+        """
+        return await asyncio.to_thread(self.generate, system_prompt=system_prompt, user_prompt=user_prompt, **kwargs)
+
+    async def agenerate_structured_response(self, system_prompt: Optional[str], user_prompt: str, structure, **kwargs) -> BaseModel:
+        """Awaitable version of generate_structured_response.
+
+        Clients without a native async API run the blocking call in a worker thread.
+        """
+        return await asyncio.to_thread(self.generate_structured_response, system_prompt=system_prompt, user_prompt=user_prompt, structure=structure, **kwargs)
+
+    def generate_stream(self, system_prompt: Optional[str], user_prompt: str, on_text: Callable[[str], None], **kwargs) -> BaseModel:
+        """Generate text, passing the output to on_text in pieces as it is produced.
+
+        Clients without a streaming API generate the full text and pass it on once.
+
+        Args:
+            system_prompt: Optional system  prompt
+            user_prompt: user prompt
+            on_text: called with each new piece of text
+            **kwargs: Additional generation parameters
+
+        Returns:
+            Generated response structure with the complete text
+        """
+        response = self.generate(system_prompt=system_prompt, user_prompt=user_prompt, **kwargs)
+        if response.success and response.content:
+            on_text(response.content)
+        return response
+
+    async def agenerate_stream(self, system_prompt: Optional[str], user_prompt: str, on_text: Callable[[str], None], **kwargs) -> BaseModel:
+        """Awaitable version of generate_stream."""
+        response = await self.agenerate(system_prompt=system_prompt, user_prompt=user_prompt, **kwargs)
+        if response.success and response.content:
+            on_text(response.content)
+        return response
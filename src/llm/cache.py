@@ -0,0 +1,345 @@
+"""
+Content addressed cache of LLM responses.
+
+The cache key covers everything that determines a response : model, system prompt,
+user prompt, image bytes, response schema and sampling parameters. Responses are kept
+in an in-memory LRU tier backed by a persistent SQLite tier with size and TTL eviction.
+Cache hits are returned with zero tokens and cost so the node totals only count real calls.
+"""
+import asyncio
+import hashlib
+import importlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from pydantic import BaseModel
+
+from .base import LLMClient
+from .images import load_images
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _schema_fingerprint(structure) -> Optional[str]:
+    """ Return a stable text form of a response schema (dict or pydantic model)"""
+    if structure is None:
+        return None
+    if isinstance(structure, type) and issubclass(structure, BaseModel):
+        structure = structure.model_json_schema()
+    return json.dumps(structure, sort_keys=True, default=str)
+
+def cache_key(model: str,
+              system_prompt: Optional[str],
+              user_prompt: str,
+              image_digests: List[str] = [],
+              structure = None,
+              temperature: Optional[float] = None,
+              max_tokens: Optional[int] = None) -> str:
+    """ Build the content address of an LLM request"""
+    payload = json.dumps({
+        "model": model,
+        "system_prompt": system_prompt,
+        "user_prompt": user_prompt,
+        "images": image_digests,
+        "schema": _schema_fingerprint(structure),
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two tier (memory LRU + SQLite) store of serialized LLM responses."""
+
+    def __init__(self,
+                 memory_max_entries: int = 1024,
+                 sqlite_path: Optional[str] = None,
+                 sqlite_max_bytes: int = 256 * 1024 * 1024,
+                 ttl_seconds: Optional[float] = None,
+                ):
+        """Initialize the cache.
+
+        Args:
+            memory_max_entries: Size of the in-memory LRU tier
+            sqlite_path: Path of the persistent tier, None keeps the cache in memory only
+            sqlite_max_bytes: Total payload size kept in the SQLite tier
+            ttl_seconds: Entries older than this are treated as misses and evicted
+        """
+        self.memory_max_entries = memory_max_entries
+        self.sqlite_max_bytes = sqlite_max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        if sqlite_path:
+            Path(sqlite_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed_at)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses(created_at)")
+            self._db.commit()
+        # payload bytes in the SQLite tier, summed once and then kept up to date
+        self._total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] if self._db is not None else 0
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached payload for the key, or None on a miss."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and self._expired(entry[1]):
+                del self._memory[key]
+                entry = None
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if self._db is not None:
+                row = self._db.execute("SELECT payload, created_at, size FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and self._expired(row[1]):
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+                    self._total_bytes -= row[2]
+                    row = None
+                if row is not None:
+                    self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, payload: str):
+        """Store a payload in both tiers and evict to stay within the limits."""
+        now = time.time()
+        with self._lock:
+            self._remember(key, payload, now)
+            if self._db is not None:
+                size = len(payload.encode("utf-8"))
+                replaced = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, payload, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, payload, size, now, now))
+                self._total_bytes += size - (replaced[0] if replaced is not None else 0)
+                self._evict(now)
+                self._db.commit()
+
+    def _remember(self, key: str, payload: str, created_at: float):
+        self._memory[key] = (payload, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now: float):
+        """Drop expired rows, then least recently used rows above the size limit."""
+        if self.ttl_seconds is not None:
+            expired = self._db.execute("SELECT key, size FROM responses WHERE created_at < ?", (now - self.ttl_seconds,)).fetchall()
+            self._db.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key, _ in expired])
+            self._total_bytes -= sum(size for _, size in expired)
+        if self._total_bytes <= self.sqlite_max_bytes:
+            return
+        evict = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed_at ASC"):
+            if self._total_bytes <= self.sqlite_max_bytes:
+                break
+            evict.append((key,))
+            self._total_bytes -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evict)
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and tier sizes."""
+        with self._lock:
+            stats = {"hits": self.hits, "misses": self.misses, "memory_entries": len(self._memory)}
+            if self._db is not None:
+                count = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                stats.update({"sqlite_entries": count, "sqlite_bytes": self._total_bytes})
+            return stats
+
+
+class CachedLLMClient(LLMClient):
+    """LLM client wrapper that serves repeated requests from a ResponseCache."""
+
+    def __init__(self, client: LLMClient, cache: ResponseCache):
+        """Initialize the wrapper.
+
+        Args:
+            client: Client that handles cache misses
+            cache: Response cache shared between clients
+        """
+        super().__init__()
+        self.client = client
+        self.model = getattr(client, "model", None)
+        self.cache = cache
+
+    def _lookup(self, key: str) -> Optional[BaseModel]:
+        payload = self.cache.get(key)
+        if payload is None:
+            return None
+        record = json.loads(payload)
+        module, _, name = record["response_class"].rpartition(".")
+        response_class = getattr(importlib.import_module(module), name)
+        response = response_class(**record["response"])
+        # nothing was paid for this response
+        return response.model_copy(update={"input_tokens": 0, "output_tokens": 0, "cached_input_tokens": 0, "thinking_tokens": 0, "cost": 0.0, "cache_hit": True})
+
+    def _store(self, key: str, response: BaseModel):
+        if not response.success:
+            return
+        response_class = type(response)
+        self.cache.put(key, json.dumps({
+            "response_class": f"{response_class.__module__}.{response_class.__qualname__}",
+            "response": response.model_dump(mode="json"),
+        }))
+
+    def _text_key(self, user_prompt, system_prompt, images, max_tokens, temperature, prompt_prefix):
+        image_bytes = load_images(images)
+        digests = [hashlib.sha256(data).hexdigest() for data in image_bytes]
+        key = cache_key(self.model, system_prompt, (prompt_prefix or "") + user_prompt, digests, None, temperature, max_tokens)
+        return key, image_bytes
+
+    def generate(self,
+                 user_prompt: str,
+                 system_prompt: Optional[str] = None,
+                 images: List = [],
+                 max_tokens: int = 4048,
+                 temperature: float = 0.1,
+                 prompt_prefix: Optional[str] = None,
+                ) -> BaseModel:
+        """Generate text, served from the cache when the same request was seen before."""
+        key, image_bytes = self._text_key(user_prompt, system_prompt, images, max_tokens, temperature, prompt_prefix)
+        response = self._lookup(key)
+        if response is None:
+            # images are passed on as bytes so they are not downloaded twice
+            response = self.client.generate(user_prompt=user_prompt, system_prompt=system_prompt, images=image_bytes,
+                                            max_tokens=max_tokens, temperature=temperature, prompt_prefix=prompt_prefix)
+            self._store(key, response)
+        return response
+
+    async def agenerate(self,
+                        user_prompt: str,
+                        system_prompt: Optional[str] = None,
+                        images: List = [],
+                        max_tokens: int = 4048,
+                        temperature: float = 0.1,
+                        prompt_prefix: Optional[str] = None,
+                       ) -> BaseModel:
+        """Async version of generate."""
+        key, image_bytes = await asyncio.to_thread(self._text_key, user_prompt, system_prompt, images, max_tokens, temperature, prompt_prefix)
+        response = await asyncio.to_thread(self._lookup, key)
+        if response is None:
+            response = await self.client.agenerate(user_prompt=user_prompt, system_prompt=system_prompt, images=image_bytes,
+                                                   max_tokens=max_tokens, temperature=temperature, prompt_prefix=prompt_prefix)
+            await asyncio.to_thread(self._store, key, response)
+        return response
+
+    def generate_stream(self,
+                        user_prompt: str,
+                        on_text: Callable[[str], None],
+                        system_prompt: Optional[str] = None,
+                        images: List = [],
+                        max_tokens: int = 4048,
+                        temperature: float = 0.1,
+                        prompt_prefix: Optional[str] = None,
+                       ) -> BaseModel:
+        """Stream text from the wrapped client, a cached response is passed on at once."""
+        key, image_bytes = self._text_key(user_prompt, system_prompt, images, max_tokens, temperature, prompt_prefix)
+        response = self._lookup(key)
+        if response is not None:
+            on_text(response.content)
+            return response
+        response = self.client.generate_stream(user_prompt=user_prompt, on_text=on_text, system_prompt=system_prompt, images=image_bytes,
+                                               max_tokens=max_tokens, temperature=temperature, prompt_prefix=prompt_prefix)
+        self._store(key, response)
+        return response
+
+    async def agenerate_stream(self,
+                               user_prompt: str,
+                               on_text: Callable[[str], None],
+                               system_prompt: Optional[str] = None,
+                               images: List = [],
+                               max_tokens: int = 4048,
+                               temperature: float = 0.1,
+                               prompt_prefix: Optional[str] = None,
+                              ) -> BaseModel:
+        """Async version of generate_stream."""
+        key, image_bytes = await asyncio.to_thread(self._text_key, user_prompt, system_prompt, images, max_tokens, temperature, prompt_prefix)
+        response = await asyncio.to_thread(self._lookup, key)
+        if response is not None:
+            on_text(response.content)
+            return response
+        response = await self.client.agenerate_stream(user_prompt=user_prompt, on_text=on_text, system_prompt=system_prompt, images=image_bytes,
+                                                      max_tokens=max_tokens, temperature=temperature, prompt_prefix=prompt_prefix)
+        await asyncio.to_thread(self._store, key, response)
+        return response
+
+    def generate_structured_response(self,
+                                     user_prompt: str,
+                                     structure,
+                                     system_prompt: Optional[str] = None,
+                                     max_tokens: int = 4048,
+                                     temperature: float = 0.1,
+                                     prompt_prefix: Optional[str] = None,
+                                    ) -> BaseModel:
+        """Generate a structured response, served from the cache when possible."""
+        key = cache_key(self.model, system_prompt, (prompt_prefix or "") + user_prompt, [], structure, temperature, max_tokens)
+        response = self._lookup(key)
+        if response is None:
+            response = self.client.generate_structured_response(user_prompt=user_prompt, structure=structure, system_prompt=system_prompt,
+                                                                max_tokens=max_tokens, temperature=temperature, prompt_prefix=prompt_prefix)
+            self._store(key, response)
+        return response
+
+    async def agenerate_structured_response(self,
+                                            user_prompt: str,
+                                            structure,
+                                            system_prompt: Optional[str] = None,
+                                            max_tokens: int = 4048,
+                                            temperature: float = 0.1,
+                                            prompt_prefix: Optional[str] = None,
+                                           ) -> BaseModel:
+        """Async version of generate_structured_response."""
+        key = cache_key(self.model, system_prompt, (prompt_prefix or "") + user_prompt, [], structure, temperature, max_tokens)
+        response = await asyncio.to_thread(self._lookup, key)
+        if response is None:
+            response = await self.client.agenerate_structured_response(user_prompt=user_prompt, structure=structure, system_prompt=system_prompt,
+                                                                       max_tokens=max_tokens, temperature=temperature, prompt_prefix=prompt_prefix)
+            await asyncio.to_thread(self._store, key, response)
+        return response
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Return the process wide response cache configured in config/settings.yaml."""
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                cache_settings = settings.get("response_cache", {})
+                _response_cache = ResponseCache(
+                    memory_max_entries=cache_settings.get("memory_max_entries", 1024),
+                    sqlite_path=cache_settings.get("sqlite_path"),
+                    sqlite_max_bytes=cache_settings.get("sqlite_max_bytes", 256 * 1024 * 1024),
+                    ttl_seconds=cache_settings.get("ttl_seconds"),
+                )
+    return _response_cache
@@ -0,0 +1,246 @@
+"""
+Question scoped provider side context caching.
+
+Every student answering the same question is graded with the same system prompt and the
+same question header (question text, rubrics). That prefix is stored once per question and
+model as a Gemini cached content and referenced by name from every request, the cached
+tokens are billed at the cheaper cached input rate. Entries are refreshed before they
+expire and recreated when the provider has dropped them.
+"""
+import hashlib
+import itertools
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Tuple
+
+from config import settings, models
+
+logger = logging.getLogger(__name__)
+
+
+class ContextCacheBackend(ABC):
+    """Provider API used to store cached prefixes."""
+
+    @abstractmethod
+    def create(self, model: str, system_prompt: Optional[str], prefix: str, ttl_seconds: int) -> Tuple[str, float, int]:
+        """Create a cached prefix.
+
+        Returns:
+            (name, expire time as unix timestamp, cached token count)
+        """
+        pass
+
+    @abstractmethod
+    def refresh(self, name: str, ttl_seconds: int) -> float:
+        """Extend the lifetime of a cached prefix and return its new expire time."""
+        pass
+
+    @abstractmethod
+    def delete(self, name: str):
+        """Delete a cached prefix."""
+        pass
+
+    def is_too_small(self, error: Exception) -> bool:
+        """Return whether a create failed because the prefix is below the provider minimum."""
+        return False
+
+
+class GeminiContextCacheBackend(ContextCacheBackend):
+    """Gemini explicit context caching."""
+
+    def __init__(self, api_key: Optional[str] = None):
+        from dotenv import load_dotenv
+        from google import genai
+        load_dotenv()
+        api_key = api_key or os.environ.get("GEMINI_API_KEY")
+        if not api_key:
+            raise ValueError("The api key must be provided either as an argument or via environment variable")
+        self.client = genai.Client(api_key=api_key)
+
+    def create(self, model, system_prompt, prefix, ttl_seconds):
+        from google.genai import types
+        cached = self.client.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                system_instruction=system_prompt,
+                contents=[prefix],
+                ttl=f"{ttl_seconds}s",
+                display_name="question-context",
+            ))
+        tokens = getattr(cached.usage_metadata, "total_token_count", None) or 0
+        return cached.name, cached.expire_time.timestamp(), tokens
+
+    def refresh(self, name, ttl_seconds):
+        from google.genai import types
+        cached = self.client.caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=f"{ttl_seconds}s"))
+        return cached.expire_time.timestamp()
+
+    def delete(self, name):
+        self.client.caches.delete(name=name)
+
+    def is_too_small(self, error):
+        # 400 INVALID_ARGUMENT "Cached content is too small. total_token_count=..., min_total_token_count=..."
+        message = str(error).lower()
+        return "too small" in message or "min_total_token_count" in message
+
+
+class FakeContextCacheBackend(ContextCacheBackend):
+    """In-memory backend for offline runs and tests, tokens are estimated as chars / 4."""
+
+    def __init__(self, min_tokens: int = 0):
+        self.entries: Dict[str, dict] = {}
+        self.min_tokens = min_tokens
+        self._ids = itertools.count(1)
+
+    def create(self, model, system_prompt, prefix, ttl_seconds):
+        tokens = (len(system_prompt or "") + len(prefix)) // 4
+        if tokens < self.min_tokens:
+            raise ValueError(f"Cached content is too small. total_token_count={tokens}, min_total_token_count={self.min_tokens}")
+        name = f"cachedContents/fake-{next(self._ids)}"
+        self.entries[name] = {"model": model, "system_prompt": system_prompt, "prefix": prefix,
+                              "expire_time": time.time() + ttl_seconds, "tokens": tokens}
+        return name, self.entries[name]["expire_time"], tokens
+
+    def refresh(self, name, ttl_seconds):
+        if name not in self.entries:
+            raise KeyError(f"Cached content {name} not found")
+        self.entries[name]["expire_time"] = time.time() + ttl_seconds
+        return self.entries[name]["expire_time"]
+
+    def delete(self, name):
+        self.entries.pop(name, None)
+
+    def is_too_small(self, error):
+        return "too small" in str(error)
+
+
+class QuestionContextCache:
+    """Maps (model, system prompt, question prefix) to a live provider side cache entry."""
+
+    def __init__(self,
+                 backend: ContextCacheBackend,
+                 ttl_seconds: int = 3600,
+                 refresh_margin_seconds: int = 300,
+                 min_prefix_chars: int = 0,
+                ):
+        """Initialize the cache.
+
+        Args:
+            backend: Provider API storing the prefixes
+            ttl_seconds: Lifetime of a cached prefix
+            refresh_margin_seconds: Entries closer than this to expiry are refreshed before use
+            min_prefix_chars: Shorter prefixes are sent inline, they are below the provider minimum
+        """
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.min_prefix_chars = min_prefix_chars
+        self._entries: Dict[str, dict] = {}
+        self._uncacheable = set()
+        # guards the tables and counters, provider calls only hold the lock of their key
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self.counters = {"created": 0, "reused": 0, "refreshed": 0, "invalidated": 0, "failed": 0,
+                         "storage_cost": 0.0}
+
+    @staticmethod
+    def key(model: str, system_prompt: Optional[str], prefix: str) -> str:
+        payload = "\x00".join([model, system_prompt or "", prefix])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, model: str, system_prompt: Optional[str], prefix: str) -> Optional[str]:
+        """Return the name of a live cached prefix, creating or refreshing it as needed.
+
+        Returns None when the prefix should be sent inline instead. Requests for the same
+        prefix wait for a single create or refresh, other prefixes are not held up.
+        """
+        if len((system_prompt or "") + prefix) < self.min_prefix_chars:
+            return None
+        key = self.key(model, system_prompt, prefix)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._uncacheable:
+                    return None
+                entry = self._entries.get(key)
+            now = time.time()
+            if entry is not None and entry["expire_time"] - now > self.refresh_margin_seconds:
+                with self._lock:
+                    self.counters["reused"] += 1
+                return entry["name"]
+            if entry is not None and entry["expire_time"] > now:
+                try:
+                    expire_time = self.backend.refresh(entry["name"], self.ttl_seconds)
+                    with self._lock:
+                        entry["expire_time"] = expire_time
+                        self.counters["refreshed"] += 1
+                        self._add_storage_cost(model, entry["tokens"])
+                    return entry["name"]
+                except Exception as e:
+                    # the provider may have dropped the entry, a new one is created below
+                    logger.warning(f"Refreshing the cached context of {model} failed, recreating it: {str(e)}")
+            try:
+                name, expire_time, tokens = self.backend.create(model, system_prompt, prefix, self.ttl_seconds)
+            except Exception as e:
+                with self._lock:
+                    self._entries.pop(key, None)
+                    self.counters["failed"] += 1
+                    if self.backend.is_too_small(e):
+                        # below the provider minimum token count, it will never be cacheable
+                        self._uncacheable.add(key)
+                if key in self._uncacheable:
+                    logger.warning(f"Prefix below the context caching minimum of {model}, sending it inline from now on")
+                else:
+                    logger.warning(f"Context caching unavailable for {model}, sending the prefix inline: {str(e)}")
+                return None
+            with self._lock:
+                self._entries[key] = {"name": name, "expire_time": expire_time, "tokens": tokens}
+                self.counters["created"] += 1
+                self._add_storage_cost(model, tokens)
+            return name
+
+    def _add_storage_cost(self, model: str, tokens: int):
+        """Storage is billed per million tokens per hour of ttl."""
+        price = models.get(model, {}).get("cache_storage_cost", 0.0)
+        self.counters["storage_cost"] += tokens * price / 1000000 * self.ttl_seconds / 3600
+
+    def invalidate(self, model: str, system_prompt: Optional[str], prefix: str):
+        """Forget an entry the provider no longer knows about, it is recreated on next use."""
+        key = self.key(model, system_prompt, prefix)
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.counters["invalidated"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, "entries": len(self._entries)}
+
+
+_context_cache: Optional[QuestionContextCache] = None
+_context_cache_lock = threading.Lock()
+
+
+def get_context_cache() -> Optional[QuestionContextCache]:
+    """Return the process wide context cache, None when disabled in config/settings.yaml."""
+    global _context_cache
+    cache_settings = settings.get("context_cache", {})
+    if not cache_settings.get("enabled", False):
+        return None
+    if _context_cache is None:
+        with _context_cache_lock:
+            if _context_cache is None:
+                if cache_settings.get("backend", "gemini") == "fake":
+                    backend = FakeContextCacheBackend()
+                else:
+                    backend = GeminiContextCacheBackend()
+                _context_cache = QuestionContextCache(
+                    backend,
+                    ttl_seconds=cache_settings.get("ttl_seconds", 3600),
+                    refresh_margin_seconds=cache_settings.get("refresh_margin_seconds", 300),
+                    min_prefix_chars=cache_settings.get("min_prefix_chars", 0),
+                )
+    return _context_cache
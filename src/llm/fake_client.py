@@ -0,0 +1,305 @@
+"""
+Deterministic fake LLM backend for offline load tests and benchmarks.
+
+Response content is generated from the request alone : the same prompt always gets the
+same text and the same schema valid structure. Latencies and failures are drawn from a
+seeded random stream per client, so a sequential run is reproducible while repeated
+identical requests still see the configured distribution.
+Latency distributions, failure rates and token counts come from the fake_llm section of
+config/settings.yaml so the graph overhead and concurrency scaling can be measured
+without an API key or network.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import random
+import re
+import threading
+import time
+from typing import Callable, List, Optional
+
+from pydantic import BaseModel
+
+from .base import LLMClient
+from config import models, settings
+
+logger = logging.getLogger(__name__)
+
+
+class FakeResponse(BaseModel):
+    content : Optional[str] = None
+    input_tokens: float
+    output_tokens: float
+    model: str
+    cost: float
+    cached_input_tokens: float = 0
+    thinking_tokens: float = 0
+    success: bool = True
+    error_message: Optional[str] = None
+    error_code: Optional[int] = None
+    retry_after: Optional[float] = None
+    cache_hit: bool = False
+
+class FakeStructuredResponse(BaseModel):
+    structure: Optional[dict] = None
+    input_tokens: float
+    output_tokens: float
+    model: str
+    cost: float
+    cached_input_tokens: float = 0
+    thinking_tokens: float = 0
+    success: bool = True
+    error_message: Optional[str] = None
+    error_code: Optional[int] = None
+    retry_after: Optional[float] = None
+    cache_hit: bool = False
+
+
+def fake_instance(schema: dict, rng: random.Random, name: str = "value"):
+    """ Build a value matching a JSON schema (object, array, string, number, integer, boolean, enum)"""
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    schema_type = schema.get("type", "string")
+    if schema_type == "object":
+        properties = schema.get("properties", {})
+        return {key: fake_instance(value, rng, key) for key, value in properties.items()}
+    if schema_type == "array":
+        # unbounded arrays get three items, the grading tables have three columns
+        min_items = schema.get("minItems", 3)
+        max_items = schema.get("maxItems", max(min_items, 3))
+        count = rng.randint(min_items, max(min_items, min(max_items, 3)))
+        return [fake_instance(schema.get("items", {}), rng, name) for _ in range(count)]
+    if schema_type == "number":
+        # marks in half steps, low enough to pass the mark validation of any question
+        return rng.choice([0.0, 0.5, 1.0])
+    if schema_type == "integer":
+        return rng.randint(schema.get("minimum", 0), schema.get("maximum", 10))
+    if schema_type == "boolean":
+        return rng.random() < 0.5
+    return f"fake {name} {rng.randint(0, 9999)}"
+
+_MAX_MARKS = re.compile(r"Maximum (?:Marks|marks available):\s*(\d+(?:\.\d+)?)")
+
+def fake_grading(instance: dict, rng: random.Random, max_marks: float) -> dict:
+    """ Make the criteria awards, the total row and the mark of a grading response agree.
+
+    Every criteria row gets a "awarded/maximum" cell in half marks, the step maxima add up to
+    max_marks and the awards to the mark, so the local mark reconciliation finds it consistent.
+    """
+    steps = max(1, int(max_marks * 2))
+    rows = instance["criteria"][:steps] or [["fake criteria", "", "fake feedback"]]
+    mark = 0.0
+    for index, row in enumerate(rows):
+        maximum = (steps // len(rows) + (index < steps % len(rows))) / 2 if max_marks > 0 else 0.0
+        awarded = rng.randint(0, int(maximum * 2)) / 2
+        mark += awarded
+        row[1:2] = [f"{awarded:g}/{maximum:g}"]
+    instance["criteria"] = rows
+    instance["total_points"] = [f"{mark:g}/{max_marks:g}"] + list(instance["total_points"][1:2] or ["fake feedback"])
+    instance["mark"] = mark
+    return instance
+
+
+class FakeLLMClient(LLMClient):
+    """LLM client returning simulated, schema valid responses."""
+
+    def __init__(self,
+                 model: str = "gemini-2.0-flash",
+                 latency_distribution: str = "lognormal",
+                 latency_mean_seconds: float = 1.0,
+                 latency_stddev_seconds: float = 0.3,
+                 failure_rate: float = 0.0,
+                 output_tokens: int = 300,
+                 chars_per_token: float = 4.0,
+                 image_tokens: int = 258,
+                 seed: int = 0,
+                ):
+        """Initialize the fake client.
+
+        Args:
+            model: Model name reported on the responses, priced from config/models.yaml
+            latency_distribution: fixed, uniform, normal or lognormal
+            latency_mean_seconds: Mean simulated latency of a call
+            latency_stddev_seconds: Spread of the latency (half width for uniform)
+            failure_rate: Fraction of calls returning an unsuccessful response
+            output_tokens: Mean output tokens of a call
+            chars_per_token: Prompt characters counted as one input token
+            image_tokens: Input tokens counted per image
+            seed: Changes every generated response while keeping them deterministic
+        """
+        super().__init__()
+        if latency_distribution not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution {latency_distribution}")
+        self.model = model
+        self.latency_distribution = latency_distribution
+        self.latency_mean_seconds = latency_mean_seconds
+        self.latency_stddev_seconds = latency_stddev_seconds
+        self.failure_rate = failure_rate
+        self.output_tokens = output_tokens
+        self.chars_per_token = chars_per_token
+        self.image_tokens = image_tokens
+        self.seed = seed
+        self.calls = 0
+        self._stream = random.Random(f"{seed}\x00{model}")
+        self._stream_lock = threading.Lock()
+
+    def _rng(self, *parts) -> random.Random:
+        """ Random generator seeded from the request, the same request gives the same response"""
+        digest = hashlib.sha256("\x00".join([str(self.seed), self.model, *map(str, parts)]).encode("utf-8")).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    def _latency(self, rng: random.Random) -> float:
+        mean, stddev = self.latency_mean_seconds, self.latency_stddev_seconds
+        if self.latency_distribution == "fixed" or mean <= 0:
+            return max(mean, 0.0)
+        if self.latency_distribution == "uniform":
+            return max(rng.uniform(mean - stddev, mean + stddev), 0.0)
+        if self.latency_distribution == "normal":
+            return max(rng.gauss(mean, stddev), 0.0)
+        # lognormal with the requested mean and standard deviation
+        variance = stddev ** 2
+        sigma2 = math.log(1 + variance / mean ** 2)
+        mu = math.log(mean) - sigma2 / 2
+        return rng.lognormvariate(mu, sigma2 ** 0.5)
+
+    def _simulate(self, system_prompt, user_prompt, prompt_prefix, images, structure):
+        """ Return the latency, the random generator and the response fields of a request"""
+        prompt = (system_prompt or "") + (prompt_prefix or "") + user_prompt
+        rng = self._rng(prompt, len(images), structure)
+        with self._stream_lock:
+            self.calls += 1
+            latency = self._latency(self._stream)
+            failed = self._stream.random() < self.failure_rate
+        input_tokens = int(len(prompt) / self.chars_per_token) + self.image_tokens * len(images)
+        output_tokens = max(1, int(rng.gauss(self.output_tokens, self.output_tokens * 0.2)))
+        prices = models.get(self.model, {})
+        cost = (input_tokens * prices.get("input_cost", 0.0) + output_tokens * prices.get("output_cost", 0.0)) / 1000000
+        fields = {"input_tokens": input_tokens, "output_tokens": output_tokens, "model": self.model, "cost": cost}
+        if failed:
+            fields.update({"input_tokens": 0, "output_tokens": 0, "cost": 0.0,
+                           "success": False, "error_message": "Simulated failure of the fake LLM backend", "error_code": 503})
+        return latency, rng, fields
+
+    def _text(self, rng: random.Random, fields: dict) -> FakeResponse:
+        if fields.get("success", True) == False:
+            return FakeResponse(**fields)
+        return FakeResponse(content=f"Fake response from {self.model} ({rng.randint(0, 999999)})", **fields)
+
+    def _structured(self, rng: random.Random, structure, fields: dict, user_prompt: str) -> FakeStructuredResponse:
+        if fields.get("success", True) == False:
+            return FakeStructuredResponse(**fields)
+        if isinstance(structure, type) and issubclass(structure, BaseModel):
+            structure = structure.model_json_schema()
+        instance = fake_instance(structure, rng)
+        if isinstance(instance, dict) and {"criteria", "total_points", "mark"} <= instance.keys():
+            # grading responses carry the maximum marks of the question in the prompt
+            match = _MAX_MARKS.search(user_prompt)
+            instance = fake_grading(instance, rng, float(match.group(1)) if match else 2.0)
+        return FakeStructuredResponse(structure=instance, **fields)
+
+    def generate(self,
+                 user_prompt: str,
+                 system_prompt: Optional[str] = None,
+                 images: List = [],
+                 max_tokens: int = 4048,
+                 temperature: float = 0.1,
+                 prompt_prefix: Optional[str] = None,
+                ) -> FakeResponse:
+        """Return a simulated text response after the simulated latency."""
+        latency, rng, fields = self._simulate(system_prompt, user_prompt, prompt_prefix, images, None)
+        time.sleep(latency)
+        return self._text(rng, fields)
+
+    async def agenerate(self,
+                        user_prompt: str,
+                        system_prompt: Optional[str] = None,
+                        images: List = [],
+                        max_tokens: int = 4048,
+                        temperature: float = 0.1,
+                        prompt_prefix: Optional[str] = None,
+                       ) -> FakeResponse:
+        """Async version of generate, the latency is awaited without holding a thread."""
+        latency, rng, fields = self._simulate(system_prompt, user_prompt, prompt_prefix, images, None)
+        await asyncio.sleep(latency)
+        return self._text(rng, fields)
+
+    def generate_stream(self,
+                        user_prompt: str,
+                        on_text: Callable[[str], None],
+                        system_prompt: Optional[str] = None,
+                        images: List = [],
+                        max_tokens: int = 4048,
+                        temperature: float = 0.1,
+                        prompt_prefix: Optional[str] = None,
+                       ) -> FakeResponse:
+        """Return a simulated text response, passed to on_text word by word over the simulated latency."""
+        latency, rng, fields = self._simulate(system_prompt, user_prompt, prompt_prefix, images, None)
+        response = self._text(rng, fields)
+        words = (response.content or "").split(" ")
+        for index, word in enumerate(words):
+            time.sleep(latency / len(words))
+            if response.success:
+                on_text(word if index == 0 else " " + word)
+        return response
+
+    async def agenerate_stream(self,
+                               user_prompt: str,
+                               on_text: Callable[[str], None],
+                               system_prompt: Optional[str] = None,
+                               images: List = [],
+                               max_tokens: int = 4048,
+                               temperature: float = 0.1,
+                               prompt_prefix: Optional[str] = None,
+                              ) -> FakeResponse:
+        """Async version of generate_stream."""
+        latency, rng, fields = self._simulate(system_prompt, user_prompt, prompt_prefix, images, None)
+        response = self._text(rng, fields)
+        words = (response.content or "").split(" ")
+        for index, word in enumerate(words):
+            await asyncio.sleep(latency / len(words))
+            if response.success:
+                on_text(word if index == 0 else " " + word)
+        return response
+
+    def generate_structured_response(self,
+                                     user_prompt: str,
+                                     structure,
+                                     system_prompt: Optional[str] = None,
+                                     max_tokens: int = 4048,
+                                     temperature: float = 0.1,
+                                     prompt_prefix: Optional[str] = None,
+                                    ) -> FakeStructuredResponse:
+        """Return a simulated response matching the schema after the simulated latency."""
+        latency, rng, fields = self._simulate(system_prompt, user_prompt, prompt_prefix, [], structure)
+        time.sleep(latency)
+        return self._structured(rng, structure, fields, user_prompt)
+
+    async def agenerate_structured_response(self,
+                                            user_prompt: str,
+                                            structure,
+                                            system_prompt: Optional[str] = None,
+                                            max_tokens: int = 4048,
+                                            temperature: float = 0.1,
+                                            prompt_prefix: Optional[str] = None,
+                                           ) -> FakeStructuredResponse:
+        """Async version of generate_structured_response."""
+        latency, rng, fields = self._simulate(system_prompt, user_prompt, prompt_prefix, [], structure)
+        await asyncio.sleep(latency)
+        return self._structured(rng, structure, fields, user_prompt)
+
+
+def fake_client_from_settings(model: str) -> FakeLLMClient:
+    """ Build a fake client from the fake_llm section of config/settings.yaml, per model overrides applied"""
+    fake_settings = dict(settings.get("fake_llm", {}))
+    fake_settings.update(fake_settings.pop("models", {}).get(model, {}) or {})
+    latency = fake_settings.get("latency", {})
+    return FakeLLMClient(
+        model=model,
+        latency_distribution=latency.get("distribution", "lognormal"),
+        latency_mean_seconds=latency.get("mean_seconds", 1.0),
+        latency_stddev_seconds=latency.get("stddev_seconds", 0.3),
+        failure_rate=fake_settings.get("failure_rate", 0.0),
+        output_tokens=fake_settings.get("output_tokens", 300),
+        seed=fake_settings.get("seed", 0),
+    )
@@ -3,17 +3,23 @@ Client implementation for Google's Gemini models .
 
 """
 import os
-from typing import Dict, List, Optional, Union, Any, Generator
+import asyncio
+from typing import Callable, Dict, List, Optional, Union, Any, Generator
 import logging
 from .base import LLMClient
+from .images import load_images, detect_mime_type
+from .context_cache import get_context_cache
 from pydantic import BaseModel
-import requests
 import base64
 import json
+from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 from config import models
 
+# api keys may come from a .env file, loaded when the gemini client is first needed
+load_dotenv()
+
 logger = logging.getLogger(__name__)
 
 #pydantic models for query and response
@@ -23,8 +29,13 @@ class GeminiResponse(BaseModel):
     output_tokens: float
     model: str 
     cost: float
+    cached_input_tokens: float = 0
+    thinking_tokens: float = 0
     success: bool = True
     error_message: Optional[str] = None
+    error_code: Optional[int] = None
+    retry_after: Optional[float] = None
+    cache_hit: bool = False
 
 class GeminiStructuredResponse(BaseModel):
     structure: Optional[dict] = None
@@ -32,8 +43,13 @@ class GeminiStructuredResponse(BaseModel):
     output_tokens: float
     model: str
     cost: float
+    cached_input_tokens: float = 0
+    thinking_tokens: float = 0
     success: bool = True
     error_message: Optional[str] = None
+    error_code: Optional[int] = None
+    retry_after: Optional[float] = None
+    cache_hit: bool = False
 
 class GeminiClient(LLMClient):
     """Client for interacting with Gemini modesl through Google AI studio API."""
@@ -55,12 +71,183 @@ class GeminiClient(LLMClient):
         self.model = model
         self.client = genai.Client(api_key=api_key)
 
+    def _model_config(self,
+                      system_prompt: Optional[str],
+                      max_tokens: int,
+                      temperature: float,
+                      structure = None,
+                      cached_content: Optional[str] = None,
+                     ) -> types.GenerateContentConfig:
+        """Prepare the generation config for thinking and non thinking models."""
+        structure_config = {}
+        if structure is not None:
+            structure_config = {"response_mime_type": "application/json", "response_schema": structure}
+        # the system prompt is part of the cached content, gemini rejects both together
+        if cached_content is not None:
+            structure_config["cached_content"] = cached_content
+        # Gemini2.5 pro only operates in thinking mode(cant put budget as zero)
+        if self.model == "gemini-2.0-flash" or self.model  == "gemini-2.5-pro":
+            return types.GenerateContentConfig(
+                system_instruction = system_prompt,
+                max_output_tokens=max_tokens,
+                temperature= temperature,
+                **structure_config
+                )
+        # thinking of flash can be restricted 
+        elif self.model == "gemini-2.5-flash":
+            return types.GenerateContentConfig(
+                system_instruction = system_prompt,
+                max_output_tokens=max_tokens,
+                temperature= temperature,
+                thinking_config=types.ThinkingConfig(thinking_budget=0), # Dont need thinking with flash 2.5 
+                **structure_config
+                )
+        raise ValueError(f"Model {self.model} is not supported by the Gemini client")
+
+    def _usage(self, response):
+        """Return input tokens, output tokens, cached input tokens, thinking tokens and cost of a response."""
+        input_tok = response.usage_metadata.prompt_token_count
+        output_tok = response.usage_metadata.total_token_count - response.usage_metadata.prompt_token_count
+        # cached tokens are part of the prompt tokens, billed at the cached input rate
+        cached_tok = response.usage_metadata.cached_content_token_count or 0
+        # thinking tokens are part of the output tokens, billed at the output rate
+        thinking_tok = response.usage_metadata.thoughts_token_count or 0
+        pricing = models[self.model]
+        # calculate cost of different models 
+        cost  = (input_tok - cached_tok)* (pricing['input_cost']/1000000) + cached_tok * (pricing.get('cached_input_cost', pricing['input_cost'])/1000000) + output_tok * (pricing['output_cost']/1000000)
+        return input_tok, output_tok, cached_tok, thinking_tok, cost
+
+    def _image_parts(self, images: List) -> List[types.Part]:
+        """Download the images (urls or raw bytes) and wrap them as parts for the model."""
+        image_content = []
+        # pages are fetched in parallel and returned in order
+        for image_bytes in load_images(images):
+            image = types.Part.from_bytes(
+            data=image_bytes, mime_type=detect_mime_type(image_bytes)
+            )
+            image_content.append(image)
+        return image_content
+
+    def _text_response(self, response, text: Optional[str] = None) -> GeminiResponse:
+        """Convert a Gemini text response to a GeminiResponse.
+
+        Streamed responses pass the joined text, usage is read from their last chunk.
+        """
+        # Check that the response has a `text` field
+        text = text if text is not None else getattr(response, "text", None)
+        if text is None:
+            raise ValueError("Gemini response did not contain text output.")
+        input_tok, output_tok, cached_tok, thinking_tok, cost = self._usage(response)
+        return GeminiResponse(
+            content = text,
+            input_tokens = input_tok,
+            output_tokens = output_tok,
+            cached_input_tokens = cached_tok,
+            thinking_tokens = thinking_tok,
+            cost = cost,
+            model= self.model,
+            success=True
+            )
+
+    @staticmethod
+    def _error_details(e: Exception):
+        """Return the http status code and the retry-after hint (seconds) of a failed call, if any."""
+        from google.genai import errors
+        import httpx
+        if isinstance(e, httpx.TimeoutException):
+            return 408, None
+        if isinstance(e, httpx.TransportError):
+            return 503, None
+        if not isinstance(e, errors.APIError):
+            return None, None
+        retry_after = None
+        headers = getattr(e.response, "headers", None) or {}
+        try:
+            if headers.get("retry-after"):
+                retry_after = float(headers["retry-after"])
+        except ValueError:
+            pass
+        # quota errors carry a google.rpc.RetryInfo detail such as {"retryDelay": "31s"}
+        details = e.details.get("error", {}).get("details", []) if isinstance(e.details, dict) else []
+        for detail in details:
+            delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+            if retry_after is None and isinstance(delay, str) and delay.endswith("s"):
+                try:
+                    retry_after = float(delay[:-1])
+                except ValueError:
+                    pass
+        return e.code, retry_after
+
+    def _text_error(self, e: Exception) -> GeminiResponse:
+        logger.error(f"Error generating text with Gemini from Google AI studio: {str(e)}")
+        error_code, retry_after = self._error_details(e)
+        return GeminiResponse(
+            content = None,
+            input_tokens = 0,
+            output_tokens = 0,
+            cost = 0.0,
+            model= self.model,
+            success=False,
+            error_message= f"Error generating text with Gemini from Google AI studio: {str(e)}",
+            error_code = error_code,
+            retry_after = retry_after,
+            )
+
+    def _structured_response(self, response) -> GeminiStructuredResponse:
+        """Convert a Gemini structured response to a GeminiStructuredResponse."""
+        input_tok, output_tok, cached_tok, thinking_tok, cost = self._usage(response)
+        return GeminiStructuredResponse(
+            structure = response.parsed,
+            input_tokens = input_tok,
+            output_tokens = output_tok,
+            cached_input_tokens = cached_tok,
+            thinking_tokens = thinking_tok,
+            cost = cost,
+            model = self.model,
+            success=True,
+            )
+
+    def _structured_error(self, e: Exception) -> GeminiStructuredResponse:
+        logger.error(f"Error generating structured data with Gemini from Google AI studio: {str(e)}")
+        error_code, retry_after = self._error_details(e)
+        return GeminiStructuredResponse(
+            structure = None,
+            input_tokens = 0,
+            output_tokens = 0,
+            cost = 0.0,
+            model= self.model,
+            success=False,
+            error_message=f"Error generating structured data with Gemini from Google AI studio: {str(e)}",
+            error_code = error_code,
+            retry_after = retry_after,
+            )
+
+    def _prompt_attempts(self, system_prompt: Optional[str], prompt_prefix: Optional[str], user_prompt: str):
+        """Return the (cached content, system instruction, prompt) variants to try in order.
+
+        A question scoped prefix is served from the context cache when one is available,
+        the inline prompt is kept as a fallback in case the cached content has expired.
+        """
+        inline = (None, system_prompt, (prompt_prefix or "") + user_prompt)
+        if not prompt_prefix:
+            return [inline]
+        context_cache = get_context_cache()
+        cached_content = context_cache.get(self.model, system_prompt, prompt_prefix) if context_cache else None
+        if cached_content is None:
+            return [inline]
+        return [(cached_content, None, user_prompt), inline]
+
+    def _context_failed(self, system_prompt: Optional[str], prompt_prefix: Optional[str], e: Exception):
+        logger.warning(f"Cached context rejected by Gemini, retrying inline: {str(e)}")
+        get_context_cache().invalidate(self.model, system_prompt, prompt_prefix)
+
     def generate(self, 
                  user_prompt: str,
                  system_prompt: Optional[str]= None,
                  images: List= [],
                  max_tokens: int = 4048,
                  temperature: float = 0.1,
+                 prompt_prefix: Optional[str] = None,
                 ) -> GeminiResponse:
         """Generate text using Gemini.
         
@@ -70,140 +257,193 @@ class GeminiClient(LLMClient):
             max_tokens: Maximum number of tokens to generate
             temperature: Sampling temperature (0.0 to 1.0)
             system_prompt: Optional system prompt to guide Gemini's behavior
+            prompt_prefix: Question scoped start of the user prompt, served from the context cache if enabled
             
         Returns:
             Generated response structure
         """
         try:
             # add images in context if any 
-            image_content = []
-            for image in images:
-                image_bytes = requests.get(image).content
-                image = types.Part.from_bytes(
-                data=image_bytes, mime_type="image/jpeg"
-                )
-                image_content.append(image)
-            
-            # prepare config for thinking and non thinking
-            # Gemini2.5 pro only operates in thinking mode(cant put budget as zero)
-            if self.model == "gemini-2.0-flash" or self.model  == "gemini-2.5-pro":
-                model_config = types.GenerateContentConfig(
-                    system_instruction = system_prompt,
-                    max_output_tokens=max_tokens,
-                    temperature= temperature
+            image_content = self._image_parts(images)
+            for cached_content, system_instruction, prompt in self._prompt_attempts(system_prompt, prompt_prefix, user_prompt):
+                try:
+                    response = self.client.models.generate_content(
+                        model = self.model,
+                        config = self._model_config(system_instruction, max_tokens, temperature, cached_content=cached_content),
+                        contents =  image_content+[prompt],#recommened image before the prompt
                     )
-            # thinking of flash can be restricted 
-            elif self.model == "gemini-2.5-flash":
-                model_config = types.GenerateContentConfig(
-                    system_instruction = system_prompt,
-                    max_output_tokens=max_tokens,
-                    temperature= temperature,
-                    thinking_config=types.ThinkingConfig(thinking_budget=0)
+                    break
+                except Exception as e:
+                    if cached_content is None:
+                        raise
+                    self._context_failed(system_prompt, prompt_prefix, e)
+            return self._text_response(response)
+        except Exception as e:
+            return self._text_error(e)
+
+    async def agenerate(self, 
+                        user_prompt: str,
+                        system_prompt: Optional[str]= None,
+                        images: List= [],
+                        max_tokens: int = 4048,
+                        temperature: float = 0.1,
+                        prompt_prefix: Optional[str] = None,
+                       ) -> GeminiResponse:
+        """Generate text using the async Gemini API, see generate."""
+        try:
+            # image downloads are blocking, keep them off the event loop
+            image_content = await asyncio.to_thread(self._image_parts, images)
+            attempts = await asyncio.to_thread(self._prompt_attempts, system_prompt, prompt_prefix, user_prompt)
+            for cached_content, system_instruction, prompt in attempts:
+                try:
+                    response = await self.client.aio.models.generate_content(
+                        model = self.model,
+                        config = self._model_config(system_instruction, max_tokens, temperature, cached_content=cached_content),
+                        contents =  image_content+[prompt],#recommened image before the prompt
                     )
-            
-            response = self.client.models.generate_content(
-                model = self.model,
-                config = model_config,
-                contents =  image_content+[user_prompt],#recommened image before the prompt
-            )
-            
-            # Check that the response has a `text` field
-            text = getattr(response, "text", None)
-            if text is None:
-                raise ValueError("Gemini response did not contain text output.")
-            
-            input_tok = response.usage_metadata.prompt_token_count
-            output_tok = response.usage_metadata.total_token_count - response.usage_metadata.prompt_token_count
-            
-            cost  = input_tok* (models[self.model]['input_cost']/1000000) + output_tok * (models[self.model]['output_cost']/1000000)
-            
-            return GeminiResponse(
-                content = response.text,
-                input_tokens = input_tok,
-                output_tokens = output_tok,
-                cost = cost,
-                model= self.model,
-                success=True
-                )
-            
+                    break
+                except Exception as e:
+                    if cached_content is None:
+                        raise
+                    self._context_failed(system_prompt, prompt_prefix, e)
+            return self._text_response(response)
         except Exception as e:
-            logger.error(f"Error generating text with Gemini from Google AI studio: {str(e)}")
-            return GeminiResponse(
-                content = None,
-                input_tokens = 0,
-                output_tokens = 0,
-                cost = 0.0,
-                model= self.model,
-                success=False,
-                error_message= f"Error generating text with Gemini from Google AI studio: {str(e)}"
-                )
+            return self._text_error(e)
+
+    def generate_stream(self,
+                        user_prompt: str,
+                        on_text: Callable[[str], None],
+                        system_prompt: Optional[str]= None,
+                        images: List= [],
+                        max_tokens: int = 4048,
+                        temperature: float = 0.1,
+                        prompt_prefix: Optional[str] = None,
+                       ) -> GeminiResponse:
+        """Generate text using the Gemini streaming API, see generate.
+
+        Args:
+            on_text: called with each chunk of text as it arrives
+
+        Returns:
+            Generated response structure with the complete text
+        """
+        try:
+            image_content = self._image_parts(images)
+            for cached_content, system_instruction, prompt in self._prompt_attempts(system_prompt, prompt_prefix, user_prompt):
+                chunks = []
+                last_chunk = None
+                try:
+                    for chunk in self.client.models.generate_content_stream(
+                        model = self.model,
+                        config = self._model_config(system_instruction, max_tokens, temperature, cached_content=cached_content),
+                        contents =  image_content+[prompt],
+                    ):
+                        last_chunk = chunk
+                        if chunk.text:
+                            chunks.append(chunk.text)
+                            on_text(chunk.text)
+                    break
+                except Exception as e:
+                    # text already shown cannot be taken back, only retry before the first chunk
+                    if cached_content is None or chunks:
+                        raise
+                    self._context_failed(system_prompt, prompt_prefix, e)
+            return self._text_response(last_chunk, text="".join(chunks) if chunks else None)
+        except Exception as e:
+            return self._text_error(e)
+
+    async def agenerate_stream(self,
+                               user_prompt: str,
+                               on_text: Callable[[str], None],
+                               system_prompt: Optional[str]= None,
+                               images: List= [],
+                               max_tokens: int = 4048,
+                               temperature: float = 0.1,
+                               prompt_prefix: Optional[str] = None,
+                              ) -> GeminiResponse:
+        """Generate text using the async Gemini streaming API, see generate_stream."""
+        try:
+            image_content = await asyncio.to_thread(self._image_parts, images)
+            attempts = await asyncio.to_thread(self._prompt_attempts, system_prompt, prompt_prefix, user_prompt)
+            for cached_content, system_instruction, prompt in attempts:
+                chunks = []
+                last_chunk = None
+                try:
+                    async for chunk in await self.client.aio.models.generate_content_stream(
+                        model = self.model,
+                        config = self._model_config(system_instruction, max_tokens, temperature, cached_content=cached_content),
+                        contents =  image_content+[prompt],
+                    ):
+                        last_chunk = chunk
+                        if chunk.text:
+                            chunks.append(chunk.text)
+                            on_text(chunk.text)
+                    break
+                except Exception as e:
+                    if cached_content is None or chunks:
+                        raise
+                    self._context_failed(system_prompt, prompt_prefix, e)
+            return self._text_response(last_chunk, text="".join(chunks) if chunks else None)
+        except Exception as e:
+            return self._text_error(e)
 
     def generate_structured_response(self, 
                                      user_prompt:str,
                                      structure,
                                      system_prompt: Optional[str]= None,
                                      max_tokens: int = 4048,
-                                     temperature: float = 0.1,)->BaseModel:
+                                     temperature: float = 0.1,
+                                     prompt_prefix: Optional[str] = None,)->BaseModel:
         """Generate structured reponse based on the chat messages history.
         
         Args:
             prompt: Details about structured reponse 
             input: Input for extracting or generating structure
             structure: Pydantic Datamodel for structure
+            prompt_prefix: Question scoped start of the user prompt, served from the context cache if enabled
             
         Returns:
             Generated structured response
         """
         try:
-            # prepare config for thinking and non thinking
-            # Gemini2.5 pro only operates in thinking mode(cant put budget as zero)
-            if self.model == "gemini-2.0-flash" or self.model == "gemini-2.5-pro":
-                model_config = types.GenerateContentConfig(
-                    system_instruction = system_prompt,
-                    response_mime_type = "application/json",
-                    response_schema = structure,
-                    max_output_tokens=max_tokens,
-                    temperature= temperature
-                    )
-            # thinking of flash can be restricted 
-            elif self.model == "gemini-2.5-flash":
-                model_config = types.GenerateContentConfig(
-                    system_instruction = system_prompt,
-                    response_mime_type = "application/json",
-                    response_schema = structure,
-                    max_output_tokens= max_tokens,
-                    temperature = temperature,
-                    thinking_config=types.ThinkingConfig(thinking_budget=0) # Dont need thinking with flash 2.5 
-                    )
+            for cached_content, system_instruction, prompt in self._prompt_attempts(system_prompt, prompt_prefix, user_prompt):
+                try:
+                    response = self.client.models.generate_content(
+                        model = self.model,
+                        config= self._model_config(system_instruction, max_tokens, temperature, structure=structure, cached_content=cached_content),
+                        contents = prompt,
+                        )
+                    break
+                except Exception as e:
+                    if cached_content is None:
+                        raise
+                    self._context_failed(system_prompt, prompt_prefix, e)
+            return self._structured_response(response)
+        except Exception as e:
+            return self._structured_error(e)
 
-            response = self.client.models.generate_content(
-                model = self.model,
-                config= model_config,
-                contents = user_prompt,
-                )
-            
-            input_tok = response.usage_metadata.prompt_token_count
-            output_tok = response.usage_metadata.total_token_count - response.usage_metadata.prompt_token_count
-    
-            # calculate cost of different models 
-            cost  = input_tok* (models[self.model]['input_cost']/1000000) + output_tok * (models[self.model]['output_cost']/1000000)
-    
-            return GeminiStructuredResponse(
-                structure = response.parsed,
-                input_tokens = input_tok,
-                output_tokens = output_tok,
-                cost = cost,
-                model = self.model,
-                success=True,
-                )
+    async def agenerate_structured_response(self, 
+                                            user_prompt:str,
+                                            structure,
+                                            system_prompt: Optional[str]= None,
+                                            max_tokens: int = 4048,
+                                            temperature: float = 0.1,
+                                            prompt_prefix: Optional[str] = None,)->BaseModel:
+        """Generate structured reponse using the async Gemini API, see generate_structured_response."""
+        try:
+            attempts = await asyncio.to_thread(self._prompt_attempts, system_prompt, prompt_prefix, user_prompt)
+            for cached_content, system_instruction, prompt in attempts:
+                try:
+                    response = await self.client.aio.models.generate_content(
+                        model = self.model,
+                        config= self._model_config(system_instruction, max_tokens, temperature, structure=structure, cached_content=cached_content),
+                        contents = prompt,
+                        )
+                    break
+                except Exception as e:
+                    if cached_content is None:
+                        raise
+                    self._context_failed(system_prompt, prompt_prefix, e)
+            return self._structured_response(response)
         except Exception as e:
-            logger.error(f"Error generating structured data with Gemini from Google AI studio: {str(e)}")
-            return GeminiStructuredResponse(
-                structure = None,
-                input_tokens = 0,
-                output_tokens = 0,
-                cost = 0.0,
-                model= self.model,
-                success=False,
-                error_message=f"Error generating structured data with Gemini from Google AI studio: {str(e)}"
-                )
+            return self._structured_error(e)
@@ -0,0 +1,231 @@
+"""
+Image fetching for vision requests.
+
+Pages are downloaded in parallel over a pooled HTTP session with per request timeouts
+and a streamed size cap. Fetched images are kept in a local disk cache keyed by url and
+ETag, a cached page is revalidated with a conditional request instead of downloaded again.
+The cache drops pages older than its ttl and the least recently used ones above its size.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def detect_mime_type(data: bytes) -> str:
+    """Detect the image format from its leading bytes, defaults to JPEG."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"GIF87a") or data.startswith(b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp" and data[8:12] in (b"heic", b"heix", b"heim", b"heis", b"mif1", b"msf1"):
+        return "image/heic"
+    return "image/jpeg"
+
+
+class ImageFetcher:
+    """Parallel, size capped image downloader with an on-disk cache."""
+
+    def __init__(self,
+                 pool_size: int = 16,
+                 max_workers: int = 8,
+                 connect_timeout: float = 5.0,
+                 read_timeout: float = 30.0,
+                 max_bytes: int = 20 * 1024 * 1024,
+                 cache_dir: Optional[str] = None,
+                 cache_max_bytes: Optional[int] = None,
+                 cache_ttl_seconds: Optional[float] = None,
+                ):
+        """Initialize the fetcher.
+
+        Args:
+            pool_size: Connections kept open per host
+            max_workers: Pages downloaded at once
+            connect_timeout: Seconds to wait for a connection
+            read_timeout: Seconds to wait between bytes of the response
+            max_bytes: Largest accepted image, larger downloads are aborted
+            cache_dir: Directory of the disk cache, None disables it
+            cache_max_bytes: Size of the disk cache, least recently used pages above it are deleted, None is unbounded
+            cache_ttl_seconds: Cached pages not used for this long are deleted, None keeps them
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_bytes = max_bytes
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-fetch")
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self._cache_lock = threading.Lock()
+        self._cache_bytes = 0
+        self._last_sweep = 0.0
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._evict()
+
+    def _cache_paths(self, url: str):
+        url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return self.cache_dir / f"{url_hash}.json", url_hash
+
+    def _cached(self, url: str):
+        """Return (etag, bytes) of the cached copy of the url, if any."""
+        if not self.cache_dir:
+            return None, None
+        index_path, _ = self._cache_paths(url)
+        try:
+            index = json.loads(index_path.read_text())
+            data_path = self.cache_dir / index["file"]
+            data = data_path.read_bytes()
+            # the modification time is the last use, the eviction order
+            os.utime(data_path)
+            return index["etag"], data
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+    def _write(self, path: Path, data: bytes):
+        """Write a cache file through a temporary file, readers never see it half written."""
+        temporary = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+        temporary.write_bytes(data)
+        temporary.replace(path)
+
+    def _store(self, url: str, etag: Optional[str], data: bytes):
+        # only responses with an ETag can be revalidated, the rest are not cached
+        if not self.cache_dir or not etag:
+            return
+        index_path, url_hash = self._cache_paths(url)
+        file_name = f"{url_hash}-{hashlib.sha256(etag.encode('utf-8')).hexdigest()[:16]}.bin"
+        try:
+            previous = json.loads(index_path.read_text()).get("file")
+        except (OSError, ValueError):
+            previous = None
+        self._write(self.cache_dir / file_name, data)
+        self._write(index_path, json.dumps({"url": url, "etag": etag, "file": file_name}).encode("utf-8"))
+        released = 0
+        if previous and previous != file_name:
+            # the page changed, its old version is never served again
+            try:
+                released = (self.cache_dir / previous).stat().st_size
+                (self.cache_dir / previous).unlink()
+            except OSError:
+                released = 0
+        with self._cache_lock:
+            self._cache_bytes += len(data) - released
+            sweep_due = self.cache_ttl_seconds is not None and time.time() - self._last_sweep > min(self.cache_ttl_seconds, 3600)
+            over_size = self.cache_max_bytes is not None and self._cache_bytes > self.cache_max_bytes
+        if sweep_due or over_size:
+            self._evict()
+
+    def _evict(self):
+        """Delete pages past the ttl, then the least recently used ones above the cache size."""
+        with self._cache_lock:
+            now = time.time()
+            pages = []
+            for path in self.cache_dir.glob("*.bin"):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                pages.append((stat.st_mtime, stat.st_size, path))
+            pages.sort()
+            total = sum(size for _, size, _ in pages)
+            evicted = 0
+            for used_at, size, path in pages:
+                expired = self.cache_ttl_seconds is not None and now - used_at > self.cache_ttl_seconds
+                if not expired and (self.cache_max_bytes is None or total <= self.cache_max_bytes):
+                    break
+                self._delete_page(path)
+                total -= size
+                evicted += 1
+            self._cache_bytes = total
+            self._last_sweep = now
+        if evicted:
+            logger.info(f"Evicted {evicted} cached images, {total} bytes left")
+
+    def _delete_page(self, path: Path):
+        """Delete a cached page and the index of its url when it still points to it."""
+        index_path = self.cache_dir / f"{path.name.split('-')[0]}.json"
+        try:
+            if json.loads(index_path.read_text()).get("file") == path.name:
+                index_path.unlink()
+        except (OSError, ValueError):
+            pass
+        path.unlink(missing_ok=True)
+
+    def fetch(self, url: str) -> bytes:
+        """Download one image, reusing the disk cache when the ETag still matches."""
+        etag, cached = self._cached(url)
+        headers = {"If-None-Match": etag} if etag else {}
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 304 and cached is not None:
+                return cached
+            response.raise_for_status()
+            length = response.headers.get("Content-Length")
+            if length is not None and int(length) > self.max_bytes:
+                raise ValueError(f"Image {url} is {length} bytes, larger than the {self.max_bytes} bytes limit")
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise ValueError(f"Image {url} is larger than the {self.max_bytes} bytes limit")
+                chunks.append(chunk)
+            data = b"".join(chunks)
+            self._store(url, response.headers.get("ETag"), data)
+            return data
+
+    def fetch_all(self, images: List) -> List[bytes]:
+        """Return the bytes of all images in order, urls are downloaded in parallel."""
+        futures = [None if isinstance(image, (bytes, bytearray)) else self.executor.submit(self.fetch, image)
+                   for image in images]
+        return [bytes(image) if future is None else future.result()
+                for image, future in zip(images, futures)]
+
+
+_fetcher: Optional[ImageFetcher] = None
+_fetcher_lock = threading.Lock()
+
+
+def get_image_fetcher() -> ImageFetcher:
+    """Return the process wide image fetcher configured in config/settings.yaml."""
+    global _fetcher
+    if _fetcher is None:
+        with _fetcher_lock:
+            if _fetcher is None:
+                fetch_settings = settings.get("image_fetch", {})
+                _fetcher = ImageFetcher(
+                    pool_size=fetch_settings.get("pool_size", 16),
+                    max_workers=fetch_settings.get("max_workers", 8),
+                    connect_timeout=fetch_settings.get("connect_timeout", 5.0),
+                    read_timeout=fetch_settings.get("read_timeout", 30.0),
+                    max_bytes=fetch_settings.get("max_bytes", 20 * 1024 * 1024),
+                    cache_dir=fetch_settings.get("cache_dir"),
+                    cache_max_bytes=fetch_settings.get("cache_max_bytes"),
+                    cache_ttl_seconds=fetch_settings.get("cache_ttl_seconds"),
+                )
+    return _fetcher
+
+def load_image_bytes(image) -> bytes:
+    """Return the bytes of an image given as raw bytes or as an url."""
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+    return get_image_fetcher().fetch(image)
+
+def load_images(images: List) -> List[bytes]:
+    """Return the bytes of all images, downloading urls in parallel."""
+    return get_image_fetcher().fetch_all(images)
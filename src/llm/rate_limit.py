@@ -0,0 +1,319 @@
+"""
+Client side rate limiting, retries and circuit breaking per model.
+
+Requests wait on two token buckets per model, one for requests per minute and one for
+prompt tokens per minute, sized from the rpm / tpm quotas in config/models.yaml, so a
+batch runs close to quota instead of bursting into 429s. Rate limit and server errors
+are retried with jittered exponential backoff that honors the retry-after hint of the
+provider. A circuit breaker fails calls fast while a model keeps returning server errors
+and lets a single probe through once the cool down has passed.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from pydantic import BaseModel
+
+from .base import LLMClient
+from config import models, settings
+
+logger = logging.getLogger(__name__)
+
+# rate limited, timed out and server errors are worth another attempt
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class UnavailableResponse(BaseModel):
+    """Response of a call that was not sent because the model is unavailable."""
+    content : Optional[str] = None
+    structure: Optional[dict] = None
+    input_tokens: float = 0
+    output_tokens: float = 0
+    model: str
+    cost: float = 0.0
+    cached_input_tokens: float = 0
+    thinking_tokens: float = 0
+    success: bool = False
+    error_message: Optional[str] = None
+    error_code: Optional[int] = 503
+    retry_after: Optional[float] = None
+    cache_hit: bool = False
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at rate_per_minute, up to capacity.
+
+    Callers reserve their tokens straight away and wait until the balance would have
+    covered them, so concurrent callers are served in arrival order.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Take amount tokens and return the seconds to wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, amount: float):
+        """Give back (or, when negative, take) tokens once the real usage is known."""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures, half opens after reset_seconds."""
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Return whether a call may go out, one probe is let through when half open."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_seconds or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record(self, success: bool):
+        with self._lock:
+            self._probing = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.error(f"Circuit opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+
+class ModelLimiter:
+    """Request and token buckets, circuit breaker and counters of one model."""
+
+    def __init__(self,
+                 model: str,
+                 requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 failure_threshold: int = 5,
+                 reset_seconds: float = 30.0,
+                ):
+        self.model = model
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds)
+        self.counters = {"calls": 0, "retries": 0, "rate_limited": 0, "rejected": 0, "wait_seconds": 0.0}
+        self._lock = threading.Lock()
+
+    def reserve(self, estimated_tokens: int) -> float:
+        """Reserve one request and the estimated prompt tokens, return the seconds to wait."""
+        wait = 0.0
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(estimated_tokens))
+        self.count("wait_seconds", wait)
+        return wait
+
+    def settle(self, estimated_tokens: int, response: BaseModel):
+        """Correct the token bucket with the prompt tokens actually billed."""
+        if self.tokens:
+            self.tokens.refund(estimated_tokens - (response.input_tokens or 0))
+
+    def count(self, name: str, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+
+class RateLimitedLLMClient(LLMClient):
+    """LLM client wrapper applying the model limiter, retries and circuit breaker."""
+
+    def __init__(self,
+                 client: LLMClient,
+                 limiter: ModelLimiter,
+                 max_retries: int = 4,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 chars_per_token: float = 4.0,
+                 image_tokens: int = 258,
+                ):
+        """Initialize the wrapper.
+
+        Args:
+            client: Client calling the provider
+            limiter: Limiter shared by all clients of the model
+            max_retries: Retries of a rate limited or failed call
+            base_delay: Backoff before the first retry, doubled on every retry
+            max_delay: Upper bound of a single backoff
+            chars_per_token: Prompt characters counted as one token for the estimate
+            image_tokens: Tokens counted per image for the estimate
+        """
+        super().__init__()
+        self.client = client
+        self.model = getattr(client, "model", None)
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.chars_per_token = chars_per_token
+        self.image_tokens = image_tokens
+
+    def _estimate(self, kwargs: dict) -> int:
+        """ Estimate the prompt tokens of a request before it is sent"""
+        chars = sum(len(kwargs.get(key) or "") for key in ("system_prompt", "prompt_prefix", "user_prompt"))
+        return int(chars / self.chars_per_token) + self.image_tokens * len(kwargs.get("images") or [])
+
+    def _backoff(self, attempt: int, response: BaseModel) -> float:
+        """ Full jitter exponential backoff, never shorter than the retry-after hint"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = getattr(response, "retry_after", None)
+        return max(delay, retry_after) if retry_after else delay
+
+    def _rejected(self) -> "UnavailableResponse":
+        """ Failure returned without calling the provider while the circuit is open"""
+        self.limiter.count("rejected")
+        return UnavailableResponse(model=self.model,
+                                   error_message=f"Model {self.model} is unavailable, calls are suspended by the circuit breaker")
+
+    def _retry(self, response: BaseModel, attempt: int) -> bool:
+        """ Record the outcome of an attempt and tell whether to try again"""
+        code = getattr(response, "error_code", None)
+        # quota errors say nothing about the health of the model, only server errors trip the breaker
+        self.limiter.breaker.record(response.success or code not in RETRYABLE_CODES or code == 429)
+        if response.success or code not in RETRYABLE_CODES or attempt >= self.max_retries:
+            return False
+        self.limiter.count("retries")
+        if code == 429:
+            self.limiter.count("rate_limited")
+        logger.warning(f"{self.model} returned {code}, retrying ({attempt + 1}/{self.max_retries})")
+        return True
+
+    def _call(self, method: Callable, kwargs: dict) -> BaseModel:
+        estimate = self._estimate(kwargs)
+        attempt = 0
+        while True:
+            if not self.limiter.breaker.allow():
+                return self._rejected()
+            time.sleep(self.limiter.reserve(estimate))
+            self.limiter.count("calls")
+            response = method(**kwargs)
+            self.limiter.settle(estimate, response)
+            if not self._retry(response, attempt):
+                return response
+            time.sleep(self._backoff(attempt, response))
+            attempt += 1
+
+    async def _acall(self, method: Callable, kwargs: dict) -> BaseModel:
+        estimate = self._estimate(kwargs)
+        attempt = 0
+        while True:
+            if not self.limiter.breaker.allow():
+                return self._rejected()
+            await asyncio.sleep(self.limiter.reserve(estimate))
+            self.limiter.count("calls")
+            response = await method(**kwargs)
+            self.limiter.settle(estimate, response)
+            if not self._retry(response, attempt):
+                return response
+            await asyncio.sleep(self._backoff(attempt, response))
+            attempt += 1
+
+    def generate(self, user_prompt: str, **kwargs) -> BaseModel:
+        """Generate text within the rate limits of the model."""
+        return self._call(self.client.generate, dict(user_prompt=user_prompt, **kwargs))
+
+    async def agenerate(self, user_prompt: str, **kwargs) -> BaseModel:
+        """Async version of generate."""
+        return await self._acall(self.client.agenerate, dict(user_prompt=user_prompt, **kwargs))
+
+    def generate_stream(self, user_prompt: str, on_text: Callable[[str], None], **kwargs) -> BaseModel:
+        """Stream text within the rate limits of the model, only attempts that produced no text are retried."""
+        streamed = []
+        def forward(text):
+            streamed.append(text)
+            on_text(text)
+        def method(**call_kwargs):
+            response = self.client.generate_stream(on_text=forward, **call_kwargs)
+            # text already shown cannot be taken back
+            return response if not streamed else response.model_copy(update={"error_code": None})
+        return self._call(method, dict(user_prompt=user_prompt, **kwargs))
+
+    async def agenerate_stream(self, user_prompt: str, on_text: Callable[[str], None], **kwargs) -> BaseModel:
+        """Async version of generate_stream."""
+        streamed = []
+        def forward(text):
+            streamed.append(text)
+            on_text(text)
+        async def method(**call_kwargs):
+            response = await self.client.agenerate_stream(on_text=forward, **call_kwargs)
+            return response if not streamed else response.model_copy(update={"error_code": None})
+        return await self._acall(method, dict(user_prompt=user_prompt, **kwargs))
+
+    def generate_structured_response(self, user_prompt: str, structure, **kwargs) -> BaseModel:
+        """Generate a structured response within the rate limits of the model."""
+        return self._call(self.client.generate_structured_response, dict(user_prompt=user_prompt, structure=structure, **kwargs))
+
+    async def agenerate_structured_response(self, user_prompt: str, structure, **kwargs) -> BaseModel:
+        """Async version of generate_structured_response."""
+        return await self._acall(self.client.agenerate_structured_response, dict(user_prompt=user_prompt, structure=structure, **kwargs))
+
+
+_limiters: Dict[str, ModelLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_model_limiter(model: str) -> ModelLimiter:
+    """Return the limiter of a model, shared by every client of the model in the process."""
+    with _limiters_lock:
+        if model not in _limiters:
+            quota = models.get(model, {})
+            breaker_settings = settings.get("rate_limit", {})
+            _limiters[model] = ModelLimiter(
+                model,
+                requests_per_minute=quota.get("rpm"),
+                tokens_per_minute=quota.get("tpm"),
+                failure_threshold=breaker_settings.get("failure_threshold", 5),
+                reset_seconds=breaker_settings.get("reset_seconds", 30.0),
+            )
+        return _limiters[model]
+
+def circuit_open(model: str) -> bool:
+    """Return whether the circuit breaker of a model is open, False for a model not called yet."""
+    with _limiters_lock:
+        limiter = _limiters.get(model)
+    return limiter is not None and limiter.breaker.opened_at is not None
+
+def rate_limited(client: LLMClient, model: str) -> RateLimitedLLMClient:
+    """Wrap a client with the limiter of its model and the retry settings of config/settings.yaml."""
+    retry_settings = settings.get("rate_limit", {})
+    return RateLimitedLLMClient(
+        client,
+        get_model_limiter(model),
+        max_retries=retry_settings.get("max_retries", 4),
+        base_delay=retry_settings.get("base_delay_seconds", 1.0),
+        max_delay=retry_settings.get("max_delay_seconds", 60.0),
+    )
+
+def limiter_stats() -> Dict[str, dict]:
+    """Return the counters of every model limiter."""
+    with _limiters_lock:
+        return {model: dict(limiter.counters) for model, limiter in _limiters.items()}
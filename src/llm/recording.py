@@ -0,0 +1,400 @@
+"""
+Record and replay of LLM traffic.
+
+In record mode every request going to the provider is appended to a JSONL file together
+with its response and latency : model, hashes of the prompts, schema fingerprint, image
+digests, content or parsed structure and usage. In replay mode those responses are served
+back with their original timing (optionally scaled) instead of calling the provider, so a
+production trace can be run through new graph or scheduler code offline and the
+throughput and latency compared before and after.
+"""
+import asyncio
+import hashlib
+import importlib
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from .base import LLMClient
+from .cache import cache_key, _schema_fingerprint
+from .images import load_images
+
+logger = logging.getLogger(__name__)
+
+
+def _sha256(text: Optional[str]) -> Optional[str]:
+    return None if text is None else hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _schema_hash(structure) -> Optional[str]:
+    return _sha256(_schema_fingerprint(structure))
+
+def _request_fields(model, method, system_prompt, user_prompt, prompt_prefix, image_bytes, structure, temperature, max_tokens) -> dict:
+    """ Describe a request by hashes only, prompts and images are not stored"""
+    digests = [hashlib.sha256(data).hexdigest() for data in image_bytes]
+    return {
+        "key": cache_key(model, system_prompt, (prompt_prefix or "") + user_prompt, digests, structure, temperature, max_tokens),
+        "model": model,
+        "method": method,
+        "system_prompt_sha256": _sha256(system_prompt),
+        "user_prompt_sha256": _sha256(user_prompt),
+        "prompt_prefix_sha256": _sha256(prompt_prefix),
+        "schema_sha256": _schema_hash(structure),
+        "image_digests": digests,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+    }
+
+
+class TrafficRecorder:
+    """Thread safe appender of request/response records to a JSONL file."""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def record(self, request: dict, response: BaseModel, started_at: float, latency: float):
+        response_class = type(response)
+        line = json.dumps({
+            **request,
+            "started_at": started_at,
+            "latency": latency,
+            "response_class": f"{response_class.__module__}.{response_class.__qualname__}",
+            "response": response.model_dump(mode="json"),
+        })
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class RecordingLLMClient(LLMClient):
+    """LLM client wrapper that records every request and response of the wrapped client."""
+
+    def __init__(self, client: LLMClient, recorder: TrafficRecorder):
+        """Initialize the wrapper.
+
+        Args:
+            client: Client whose traffic is recorded
+            recorder: Recorder shared between clients
+        """
+        super().__init__()
+        self.client = client
+        self.model = getattr(client, "model", None)
+        self.recorder = recorder
+
+    def generate(self,
+                 user_prompt: str,
+                 system_prompt: Optional[str] = None,
+                 images: List = [],
+                 max_tokens: int = 4048,
+                 temperature: float = 0.1,
+                 prompt_prefix: Optional[str] = None,
+                ) -> BaseModel:
+        """Generate text with the wrapped client and record the exchange."""
+        # images are passed on as bytes so they are not downloaded twice
+        image_bytes = load_images(images)
+        request = _request_fields(self.model, "generate", system_prompt, user_prompt, prompt_prefix, image_bytes, None, temperature, max_tokens)
+        started_at, start = time.time(), time.perf_counter()
+        response = self.client.generate(user_prompt=user_prompt, system_prompt=system_prompt, images=image_bytes,
+                                        max_tokens=max_tokens, temperature=temperature, prompt_prefix=prompt_prefix)
+        self.recorder.record(request, response, started_at, time.perf_counter() - start)
+        return response
+
+    async def agenerate(self,
+                        user_prompt: str,
+                        system_prompt: Optional[str] = None,
+                        images: List = [],
+                        max_tokens: int = 4048,
+                        temperature: float = 0.1,
+                        prompt_prefix: Optional[str] = None,
+                       ) -> BaseModel:
+        """Async version of generate."""
+        image_bytes = await asyncio.to_thread(load_images, images)
+        request = _request_fields(self.model, "generate", system_prompt, user_prompt, prompt_prefix, image_bytes, None, temperature, max_tokens)
+        started_at, start = time.time(), time.perf_counter()
+        response = await self.client.agenerate(user_prompt=user_prompt, system_prompt=system_prompt, images=image_bytes,
+                                               max_tokens=max_tokens, temperature=temperature, prompt_prefix=prompt_prefix)
+        self.recorder.record(request, response, started_at, time.perf_counter() - start)
+        return response
+
+    def generate_stream(self,
+                        user_prompt: str,
+                        on_text: Callable[[str], None],
+                        system_prompt: Optional[str] = None,
+                        images: List = [],
+                        max_tokens: int = 4048,
+                        temperature: float = 0.1,
+                        prompt_prefix: Optional[str] = None,
+                       ) -> BaseModel:
+        """Stream text from the wrapped client and record the finished exchange."""
+        image_bytes = load_images(images)
+        # recorded as a generate request, the replay serves it to streamed and plain calls alike
+        request = _request_fields(self.model, "generate", system_prompt, user_prompt, prompt_prefix, image_bytes, None, temperature, max_tokens)
+        started_at, start = time.time(), time.perf_counter()
+        response = self.client.generate_stream(user_prompt=user_prompt, on_text=on_text, system_prompt=system_prompt, images=image_bytes,
+                                               max_tokens=max_tokens, temperature=temperature, prompt_prefix=prompt_prefix)
+        self.recorder.record(request, response, started_at, time.perf_counter() - start)
+        return response
+
+    async def agenerate_stream(self,
+                               user_prompt: str,
+                               on_text: Callable[[str], None],
+                               system_prompt: Optional[str] = None,
+                               images: List = [],
+                               max_tokens: int = 4048,
+                               temperature: float = 0.1,
+                               prompt_prefix: Optional[str] = None,
+                              ) -> BaseModel:
+        """Async version of generate_stream."""
+        image_bytes = await asyncio.to_thread(load_images, images)
+        request = _request_fields(self.model, "generate", system_prompt, user_prompt, prompt_prefix, image_bytes, None, temperature, max_tokens)
+        started_at, start = time.time(), time.perf_counter()
+        response = await self.client.agenerate_stream(user_prompt=user_prompt, on_text=on_text, system_prompt=system_prompt, images=image_bytes,
+                                                      max_tokens=max_tokens, temperature=temperature, prompt_prefix=prompt_prefix)
+        self.recorder.record(request, response, started_at, time.perf_counter() - start)
+        return response
+
+    def generate_structured_response(self,
+                                     user_prompt: str,
+                                     structure,
+                                     system_prompt: Optional[str] = None,
+                                     max_tokens: int = 4048,
+                                     temperature: float = 0.1,
+                                     prompt_prefix: Optional[str] = None,
+                                    ) -> BaseModel:
+        """Generate a structured response with the wrapped client and record the exchange."""
+        request = _request_fields(self.model, "generate_structured_response", system_prompt, user_prompt, prompt_prefix, [], structure, temperature, max_tokens)
+        started_at, start = time.time(), time.perf_counter()
+        response = self.client.generate_structured_response(user_prompt=user_prompt, structure=structure, system_prompt=system_prompt,
+                                                            max_tokens=max_tokens, temperature=temperature, prompt_prefix=prompt_prefix)
+        self.recorder.record(request, response, started_at, time.perf_counter() - start)
+        return response
+
+    async def agenerate_structured_response(self,
+                                            user_prompt: str,
+                                            structure,
+                                            system_prompt: Optional[str] = None,
+                                            max_tokens: int = 4048,
+                                            temperature: float = 0.1,
+                                            prompt_prefix: Optional[str] = None,
+                                           ) -> BaseModel:
+        """Async version of generate_structured_response."""
+        request = _request_fields(self.model, "generate_structured_response", system_prompt, user_prompt, prompt_prefix, [], structure, temperature, max_tokens)
+        started_at, start = time.time(), time.perf_counter()
+        response = await self.client.agenerate_structured_response(user_prompt=user_prompt, structure=structure, system_prompt=system_prompt,
+                                                                   max_tokens=max_tokens, temperature=temperature, prompt_prefix=prompt_prefix)
+        self.recorder.record(request, response, started_at, time.perf_counter() - start)
+        return response
+
+
+class TrafficLog:
+    """Recorded exchanges indexed for replay.
+
+    Requests are matched on their exact content address first. Requests the recording
+    never saw (e.g. after a prompt change) fall back to a recorded exchange of the same
+    model, method and schema, so new graph code can still be replayed with realistic
+    timings. Repeated requests cycle through their recorded responses in order.
+    """
+
+    def __init__(self, path: str):
+        self.exact: Dict[str, List[dict]] = defaultdict(list)
+        self.similar: Dict[tuple, List[dict]] = defaultdict(list)
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                self.exact[record["key"]].append(record)
+                self.similar[(record["model"], record["method"], record["schema_sha256"])].append(record)
+        self._next: Dict = defaultdict(int)
+        self._lock = threading.Lock()
+        self.counters = {"exact": 0, "similar": 0, "missing": 0}
+        logger.info(f"Loaded {sum(len(records) for records in self.exact.values())} recorded LLM exchanges from {path}")
+
+    def _take(self, index: Dict, key) -> Optional[dict]:
+        records = index.get(key)
+        if not records:
+            return None
+        position = self._next[(id(index), key)]
+        self._next[(id(index), key)] = position + 1
+        return records[position % len(records)]
+
+    def match(self, request: dict) -> Optional[dict]:
+        """Return the recorded exchange to serve for a request, None when nothing matches."""
+        with self._lock:
+            record = self._take(self.exact, request["key"])
+            if record is not None:
+                self.counters["exact"] += 1
+                return record
+            record = self._take(self.similar, (request["model"], request["method"], request["schema_sha256"]))
+            self.counters["similar" if record is not None else "missing"] += 1
+            return record
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counters)
+
+
+class ReplayLLMClient(LLMClient):
+    """LLM client serving recorded responses with their recorded (or scaled) latency."""
+
+    def __init__(self, model: str, traffic: TrafficLog, time_scale: float = 1.0):
+        """Initialize the replay client.
+
+        Args:
+            model: Model whose recorded traffic is served
+            traffic: Recorded exchanges
+            time_scale: Factor applied to the recorded latencies, 0 replays without waiting
+        """
+        super().__init__()
+        self.model = model
+        self.traffic = traffic
+        self.time_scale = time_scale
+
+    def _replay(self, request: dict, missing_class: str):
+        """ Return the delay and response of the matching recorded exchange"""
+        record = self.traffic.match(request)
+        if record is None:
+            module, _, name = missing_class.rpartition(".")
+            response_class = getattr(importlib.import_module(module), name)
+            logger.error(f"No recorded response for a {request['method']} request to {self.model}")
+            return 0.0, response_class(input_tokens=0, output_tokens=0, model=self.model, cost=0.0, success=False,
+                                       error_message="No recorded response for this request")
+        module, _, name = record["response_class"].rpartition(".")
+        response_class = getattr(importlib.import_module(module), name)
+        return record["latency"] * self.time_scale, response_class(**record["response"])
+
+    def _text_request(self, user_prompt, system_prompt, images, max_tokens, temperature, prompt_prefix) -> dict:
+        return _request_fields(self.model, "generate", system_prompt, user_prompt, prompt_prefix, load_images(images), None, temperature, max_tokens)
+
+    def generate(self,
+                 user_prompt: str,
+                 system_prompt: Optional[str] = None,
+                 images: List = [],
+                 max_tokens: int = 4048,
+                 temperature: float = 0.1,
+                 prompt_prefix: Optional[str] = None,
+                ) -> BaseModel:
+        """Serve the recorded text response after the recorded latency."""
+        request = self._text_request(user_prompt, system_prompt, images, max_tokens, temperature, prompt_prefix)
+        delay, response = self._replay(request, "src.llm.fake_client.FakeResponse")
+        time.sleep(delay)
+        return response
+
+    async def agenerate(self,
+                        user_prompt: str,
+                        system_prompt: Optional[str] = None,
+                        images: List = [],
+                        max_tokens: int = 4048,
+                        temperature: float = 0.1,
+                        prompt_prefix: Optional[str] = None,
+                       ) -> BaseModel:
+        """Async version of generate, the latency is awaited without holding a thread."""
+        request = await asyncio.to_thread(self._text_request, user_prompt, system_prompt, images, max_tokens, temperature, prompt_prefix)
+        delay, response = self._replay(request, "src.llm.fake_client.FakeResponse")
+        await asyncio.sleep(delay)
+        return response
+
+    @staticmethod
+    def _pieces(response: BaseModel) -> List[str]:
+        """ Split the content of a successful response into the word pieces it is streamed in"""
+        if not response.success or not response.content:
+            return []
+        words = response.content.split(" ")
+        return [word if index == 0 else " " + word for index, word in enumerate(words)]
+
+    def generate_stream(self,
+                        user_prompt: str,
+                        on_text: Callable[[str], None],
+                        system_prompt: Optional[str] = None,
+                        images: List = [],
+                        max_tokens: int = 4048,
+                        temperature: float = 0.1,
+                        prompt_prefix: Optional[str] = None,
+                       ) -> BaseModel:
+        """Serve the recorded text response, passed to on_text word by word over the recorded latency."""
+        request = self._text_request(user_prompt, system_prompt, images, max_tokens, temperature, prompt_prefix)
+        delay, response = self._replay(request, "src.llm.fake_client.FakeResponse")
+        pieces = self._pieces(response)
+        if not pieces:
+            time.sleep(delay)
+        for piece in pieces:
+            time.sleep(delay / len(pieces))
+            on_text(piece)
+        return response
+
+    async def agenerate_stream(self,
+                               user_prompt: str,
+                               on_text: Callable[[str], None],
+                               system_prompt: Optional[str] = None,
+                               images: List = [],
+                               max_tokens: int = 4048,
+                               temperature: float = 0.1,
+                               prompt_prefix: Optional[str] = None,
+                              ) -> BaseModel:
+        """Async version of generate_stream."""
+        request = await asyncio.to_thread(self._text_request, user_prompt, system_prompt, images, max_tokens, temperature, prompt_prefix)
+        delay, response = self._replay(request, "src.llm.fake_client.FakeResponse")
+        pieces = self._pieces(response)
+        if not pieces:
+            await asyncio.sleep(delay)
+        for piece in pieces:
+            await asyncio.sleep(delay / len(pieces))
+            on_text(piece)
+        return response
+
+    def generate_structured_response(self,
+                                     user_prompt: str,
+                                     structure,
+                                     system_prompt: Optional[str] = None,
+                                     max_tokens: int = 4048,
+                                     temperature: float = 0.1,
+                                     prompt_prefix: Optional[str] = None,
+                                    ) -> BaseModel:
+        """Serve the recorded structured response after the recorded latency."""
+        request = _request_fields(self.model, "generate_structured_response", system_prompt, user_prompt, prompt_prefix, [], structure, temperature, max_tokens)
+        delay, response = self._replay(request, "src.llm.fake_client.FakeStructuredResponse")
+        time.sleep(delay)
+        return response
+
+    async def agenerate_structured_response(self,
+                                            user_prompt: str,
+                                            structure,
+                                            system_prompt: Optional[str] = None,
+                                            max_tokens: int = 4048,
+                                            temperature: float = 0.1,
+                                            prompt_prefix: Optional[str] = None,
+                                           ) -> BaseModel:
+        """Async version of generate_structured_response."""
+        request = _request_fields(self.model, "generate_structured_response", system_prompt, user_prompt, prompt_prefix, [], structure, temperature, max_tokens)
+        delay, response = self._replay(request, "src.llm.fake_client.FakeStructuredResponse")
+        await asyncio.sleep(delay)
+        return response
+
+
+_recorder: Optional[TrafficRecorder] = None
+_traffic: Optional[TrafficLog] = None
+_lock = threading.Lock()
+
+
+def get_traffic_recorder(path: str) -> TrafficRecorder:
+    """Return the process wide recorder."""
+    global _recorder
+    with _lock:
+        if _recorder is None:
+            _recorder = TrafficRecorder(path)
+    return _recorder
+
+def get_traffic_log(path: str) -> TrafficLog:
+    """Return the process wide recorded traffic, loaded once."""
+    global _traffic
+    with _lock:
+        if _traffic is None:
+            _traffic = TrafficLog(path)
+    return _traffic
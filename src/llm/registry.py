@@ -0,0 +1,144 @@
+"""
+Process wide registry of LLM clients.
+
+Clients are created once per model and shared across nodes and requests so that
+the underlying HTTP connections are reused instead of being rebuilt on every call.
+"""
+import os
+import threading
+import logging
+from typing import Callable, Dict, List, Optional
+
+from .base import LLMClient
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def llm_backend() -> str:
+    """ Backend of new clients : the LLM_BACKEND env variable, else llm.backend in config/settings.yaml"""
+    return os.environ.get("LLM_BACKEND") or settings.get("llm", {}).get("backend", "gemini")
+
+def _default_factory(model: str) -> LLMClient:
+    """ create a new client for the model, wrapped in the traffic recorder, rate limiter, router statistics and response cache"""
+    backend = llm_backend()
+    traffic_settings = settings.get("llm_traffic", {})
+    traffic_mode = os.environ.get("LLM_TRAFFIC_MODE") or traffic_settings.get("mode", "none")
+    if traffic_mode not in ("none", "record", "replay"):
+        raise ValueError(f"Unknown LLM traffic mode {traffic_mode}, expected none, record or replay")
+    if traffic_mode == "replay":
+        from .recording import ReplayLLMClient, get_traffic_log
+        client = ReplayLLMClient(model, get_traffic_log(traffic_settings["path"]), traffic_settings.get("time_scale", 1.0))
+    elif backend == "gemini":
+        from .gemini_client import GeminiClient
+        client = GeminiClient(model=model)
+    elif backend == "fake":
+        from .fake_client import fake_client_from_settings
+        client = fake_client_from_settings(model)
+    else:
+        raise ValueError(f"Unknown LLM backend {backend}, expected gemini or fake")
+    if traffic_mode == "record":
+        # every provider attempt is recorded with its own latency, limiter waits and backoff are not
+        from .recording import RecordingLLMClient, get_traffic_recorder
+        client = RecordingLLMClient(client, get_traffic_recorder(traffic_settings["path"]))
+    if settings.get("rate_limit", {}).get("enabled", False):
+        # replayed failures are retried by the limiter as the live ones were
+        from .rate_limit import rate_limited
+        client = rate_limited(client, model)
+    # live latency / error statistics for the model router
+    from .router import ObservedLLMClient, get_router
+    client = ObservedLLMClient(client, get_router().stats(model))
+    if settings.get("response_cache", {}).get("enabled", False):
+        from .cache import CachedLLMClient, get_response_cache
+        client = CachedLLMClient(client, get_response_cache())
+    return client
+
+
+class ClientRegistry:
+    """Thread-safe pool of LLM clients keyed by model name."""
+
+    def __init__(self,
+                 max_clients_per_model: int = 1,
+                 factory: Optional[Callable[[str], LLMClient]] = None,
+                ):
+        """Initialize the registry.
+
+        Args:
+            max_clients_per_model: Number of clients kept in the pool for each model
+            factory: Callable that builds a new client for a model name
+        """
+        if max_clients_per_model < 1:
+            raise ValueError("max_clients_per_model must be at least 1")
+        self.max_clients_per_model = max_clients_per_model
+        self.factory = factory or _default_factory
+        self._pools: Dict[str, List[LLMClient]] = {}
+        self._next: Dict[str, int] = {}
+        self._created: Dict[str, int] = {}
+        self._reused: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, model: str) -> LLMClient:
+        """Return a pooled client for the model, creating it on first use.
+
+        Clients are handed out round robin, the pool is filled lazily up to
+        max_clients_per_model.
+        """
+        with self._lock:
+            pool = self._pools.setdefault(model, [])
+            index = self._next.get(model, 0)
+            self._next[model] = (index + 1) % self.max_clients_per_model
+            if index < len(pool):
+                self._reused[model] = self._reused.get(model, 0) + 1
+                return pool[index]
+            # client creation happens under the lock so a model is never over allocated
+            client = self.factory(model)
+            pool.append(client)
+            self._created[model] = self._created.get(model, 0) + 1
+            logger.info(f"Created LLM client for {model} ({len(pool)}/{self.max_clients_per_model})")
+            return client
+
+    def stats(self) -> dict:
+        """Return creation and reuse counters, overall and per model."""
+        with self._lock:
+            models = sorted(set(self._created) | set(self._reused))
+            return {
+                "created": sum(self._created.values()),
+                "reused": sum(self._reused.values()),
+                "models": {
+                    model: {
+                        "created": self._created.get(model, 0),
+                        "reused": self._reused.get(model, 0),
+                        "pool_size": len(self._pools.get(model, [])),
+                    }
+                    for model in models
+                },
+            }
+
+    def clear(self):
+        """Drop all pooled clients and reset the counters."""
+        with self._lock:
+            self._pools.clear()
+            self._next.clear()
+            self._created.clear()
+            self._reused.clear()
+
+
+_registry: Optional[ClientRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> ClientRegistry:
+    """Return the process wide registry, sized from config/settings.yaml."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                pool_settings = settings.get("client_pool", {})
+                _registry = ClientRegistry(
+                    max_clients_per_model=pool_settings.get("max_clients_per_model", 1))
+    return _registry
+
+
+def get_client(model: str) -> LLMClient:
+    """Return a shared client for the model from the process wide registry."""
+    return get_registry().get(model)
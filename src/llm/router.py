@@ -0,0 +1,327 @@
+"""
+Latency and cost aware model routing.
+
+Each node has routes in the routing section of config/models.yaml : an ordered list of
+equivalent models per route key (question complexity, solution pathway, answer type).
+The first model of the list is preferred. Live statistics of every model (recent p95
+latency, error rate, calls in flight, circuit breaker) decide whether it is healthy,
+traffic moves down the list to the next healthy model when the preferred one is slow
+or saturated, and every choice is logged with its reason. A call failing with a
+retryable error (after the retries of the rate limiter) is sent again to the next model
+of the chain. Calls of a batch close to its budget are downgraded : the chain is tried
+cheapest model first.
+"""
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from .base import LLMClient
+from .rate_limit import RETRYABLE_CODES, circuit_open
+from config import models, routing
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Return the nearest rank percentile (fraction 0.95 for p95) of values sorted in ascending order."""
+    return sorted_values[max(math.ceil(fraction * len(sorted_values)) - 1, 0)]
+
+
+class ModelStats:
+    """Sliding window of recent call latencies and outcomes of one model.
+
+    Calls older than max_age_seconds are forgotten, so a model that lost its traffic
+    after being judged slow or failing gets tried again once its bad window has aged out.
+    """
+
+    def __init__(self, window: int = 50, max_age_seconds: float = 120.0):
+        self.calls: Deque[Tuple[float, float, bool]] = deque(maxlen=window)
+        self.max_age_seconds = max_age_seconds
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def finish(self, latency: float, success: bool):
+        with self._lock:
+            self.in_flight -= 1
+            self.calls.append((time.monotonic(), latency, success))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            while self.calls and time.monotonic() - self.calls[0][0] > self.max_age_seconds:
+                self.calls.popleft()
+            latencies = sorted(latency for _, latency, _ in self.calls)
+            failures = sum(1 for _, _, success in self.calls if not success)
+            count = len(self.calls)
+            return {
+                "calls": count,
+                "in_flight": self.in_flight,
+                "p95_latency": percentile(latencies, 0.95) if count else None,
+                "error_rate": failures / count if count else 0.0,
+            }
+
+
+class ModelRouter:
+    """Chooses a model per node call from the configured routes and live statistics."""
+
+    def __init__(self,
+                 routes: Dict[str, Dict[str, List[str]]],
+                 model_settings: Dict[str, dict],
+                 stats_window: int = 50,
+                 stats_max_age_seconds: float = 120.0,
+                 min_calls: int = 5,
+                 max_error_rate: float = 0.2,
+                ):
+        """Initialize the router.
+
+        Args:
+            routes: node -> route key -> models in order of preference, "default" is the fallback key
+            model_settings: model entries of config/models.yaml (latency_budget_seconds, max_in_flight)
+            stats_window: Recent calls per model used for the latency and error statistics
+            stats_max_age_seconds: Calls older than this no longer count in the statistics
+            min_calls: Calls needed before the latency and error rate of a model are judged
+            max_error_rate: Models failing more often than this are considered down
+        """
+        self.routes = routes
+        self.model_settings = model_settings
+        self.stats_window = stats_window
+        self.stats_max_age_seconds = stats_max_age_seconds
+        self.min_calls = min_calls
+        self.max_error_rate = max_error_rate
+        self._stats: Dict[str, ModelStats] = {}
+        self._lock = threading.Lock()
+        self.decisions: Dict[str, int] = {}
+
+    def stats(self, model: str) -> ModelStats:
+        with self._lock:
+            if model not in self._stats:
+                self._stats[model] = ModelStats(self.stats_window, self.stats_max_age_seconds)
+            return self._stats[model]
+
+    def candidates(self, node: str, *keys: Optional[str]) -> Tuple[str, List[str]]:
+        """Return the route key used and its models, the first key configured for the node wins."""
+        node_routes = self.routes.get(node) or self.routes.get("default", {})
+        for key in (*keys, "default"):
+            if key is not None and key in node_routes:
+                return key, node_routes[key]
+        raise ValueError(f"No route configured for node {node} (keys {keys})")
+
+    def unhealthy_reason(self, model: str) -> Optional[str]:
+        """Return why a model should be avoided right now, None when it is healthy."""
+        snapshot = self.stats(model).snapshot()
+        limits = self.model_settings.get(model, {})
+        max_in_flight = limits.get("max_in_flight")
+        if max_in_flight and snapshot["in_flight"] >= max_in_flight:
+            return f"saturated, {snapshot['in_flight']} calls in flight (max {max_in_flight})"
+        if circuit_open(model):
+            return "circuit breaker open"
+        if snapshot["calls"] < self.min_calls:
+            return None
+        if snapshot["error_rate"] > self.max_error_rate:
+            return f"error rate {snapshot['error_rate']:.0%} above {self.max_error_rate:.0%}"
+        budget = limits.get("latency_budget_seconds")
+        if budget and snapshot["p95_latency"] > budget:
+            return f"p95 latency {snapshot['p95_latency']:.1f}s above the {budget}s budget"
+        return None
+
+    def price(self, model: str) -> float:
+        """Return the per million input plus output token price of a model."""
+        pricing = self.model_settings.get(model, {})
+        return pricing.get("input_cost", 0.0) + pricing.get("output_cost", 0.0)
+
+    def route(self, node: str, *keys: Optional[str], downgrade: bool = False) -> str:
+        """Return the model to use for a node call.
+
+        Args:
+            node: Graph node making the call
+            keys: Route keys in order of precedence (e.g. solution pathway, complexity)
+            downgrade: Prefer the cheapest model of the chain (batch close to its budget)
+        """
+        return self.route_chain(node, *keys, downgrade=downgrade)[0]
+
+    def route_chain(self, node: str, *keys: Optional[str], downgrade: bool = False) -> List[str]:
+        """Return the model to use for a node call followed by the other models of its chain, its fallbacks."""
+        key, chain = self.candidates(node, *keys)
+        if downgrade:
+            chain = sorted(chain, key=self.price)
+        skipped = ["budget downgrade, cheapest model first"] if downgrade else []
+        for model in chain:
+            reason = self.unhealthy_reason(model)
+            if reason is None:
+                break
+            skipped.append(f"{model} {reason}")
+        else:
+            # every model of the chain is degraded, stay with the preferred one
+            model = chain[0]
+            skipped.append("all candidates degraded, using the preferred model")
+        if skipped:
+            logger.warning(f"Routing {node} [{key}] to {model}: {'; '.join(skipped)}")
+        else:
+            logger.info(f"Routing {node} [{key}] to {model}: preferred model")
+        with self._lock:
+            decision = f"{node}:{model}" + (":downgraded" if downgrade else "")
+            self.decisions[decision] = self.decisions.get(decision, 0) + 1
+        return [model] + [fallback for fallback in chain if fallback != model]
+
+    def record_fallback(self, node: str, model: str, fallback: str, reason: str):
+        logger.warning(f"Falling back from {model} to {fallback} for {node}: {reason}")
+        with self._lock:
+            decision = f"{node}:{fallback}:fallback"
+            self.decisions[decision] = self.decisions.get(decision, 0) + 1
+
+    def summary(self) -> dict:
+        """Return the live statistics of every model and the routing decision counts."""
+        with self._lock:
+            models_seen = list(self._stats)
+            decisions = dict(self.decisions)
+        return {"models": {model: self.stats(model).snapshot() for model in models_seen}, "decisions": decisions}
+
+
+class ObservedLLMClient(LLMClient):
+    """LLM client wrapper feeding call latencies and outcomes to the router statistics."""
+
+    def __init__(self, client: LLMClient, stats: ModelStats):
+        super().__init__()
+        self.client = client
+        self.model = getattr(client, "model", None)
+        self.model_stats = stats
+
+    def _call(self, method: Callable, kwargs: dict) -> BaseModel:
+        self.model_stats.start()
+        start = time.perf_counter()
+        success = False
+        try:
+            response = method(**kwargs)
+            success = response.success
+            return response
+        finally:
+            self.model_stats.finish(time.perf_counter() - start, success)
+
+    async def _acall(self, method: Callable, kwargs: dict) -> BaseModel:
+        self.model_stats.start()
+        start = time.perf_counter()
+        success = False
+        try:
+            response = await method(**kwargs)
+            success = response.success
+            return response
+        finally:
+            self.model_stats.finish(time.perf_counter() - start, success)
+
+    def generate(self, user_prompt: str, **kwargs) -> BaseModel:
+        return self._call(self.client.generate, dict(user_prompt=user_prompt, **kwargs))
+
+    async def agenerate(self, user_prompt: str, **kwargs) -> BaseModel:
+        return await self._acall(self.client.agenerate, dict(user_prompt=user_prompt, **kwargs))
+
+    def generate_stream(self, user_prompt: str, on_text: Callable[[str], None], **kwargs) -> BaseModel:
+        return self._call(self.client.generate_stream, dict(user_prompt=user_prompt, on_text=on_text, **kwargs))
+
+    async def agenerate_stream(self, user_prompt: str, on_text: Callable[[str], None], **kwargs) -> BaseModel:
+        return await self._acall(self.client.agenerate_stream, dict(user_prompt=user_prompt, on_text=on_text, **kwargs))
+
+    def generate_structured_response(self, user_prompt: str, structure, **kwargs) -> BaseModel:
+        return self._call(self.client.generate_structured_response, dict(user_prompt=user_prompt, structure=structure, **kwargs))
+
+    async def agenerate_structured_response(self, user_prompt: str, structure, **kwargs) -> BaseModel:
+        return await self._acall(self.client.agenerate_structured_response, dict(user_prompt=user_prompt, structure=structure, **kwargs))
+
+
+class FallbackLLMClient(LLMClient):
+    """LLM client trying the models of a route chain in turn while the calls fail with a retryable error."""
+
+    def __init__(self, router: ModelRouter, node: str, clients: List[LLMClient]):
+        super().__init__()
+        self.router = router
+        self.node = node
+        self.clients = clients
+        self.model = getattr(clients[0], "model", None)
+
+    def _retryable(self, response: BaseModel, index: int) -> bool:
+        if response.success or response.error_code not in RETRYABLE_CODES or index + 1 >= len(self.clients):
+            return False
+        self.router.record_fallback(self.node, self.clients[index].model, self.clients[index + 1].model,
+                                    f"error {response.error_code}: {response.error_message}")
+        return True
+
+    def _call(self, method: str, kwargs: dict, streamed: List[str] = ()) -> BaseModel:
+        for index, client in enumerate(self.clients):
+            response = getattr(client, method)(**kwargs)
+            # text already passed on cannot be taken back, a stream that produced some is not retried
+            if streamed or not self._retryable(response, index):
+                return response
+
+    async def _acall(self, method: str, kwargs: dict, streamed: List[str] = ()) -> BaseModel:
+        for index, client in enumerate(self.clients):
+            response = await getattr(client, method)(**kwargs)
+            if streamed or not self._retryable(response, index):
+                return response
+
+    def generate(self, user_prompt: str, **kwargs) -> BaseModel:
+        return self._call("generate", dict(user_prompt=user_prompt, **kwargs))
+
+    async def agenerate(self, user_prompt: str, **kwargs) -> BaseModel:
+        return await self._acall("agenerate", dict(user_prompt=user_prompt, **kwargs))
+
+    def generate_stream(self, user_prompt: str, on_text: Callable[[str], None], **kwargs) -> BaseModel:
+        streamed = []
+        def forward(text):
+            streamed.append(text)
+            on_text(text)
+        return self._call("generate_stream", dict(user_prompt=user_prompt, on_text=forward, **kwargs), streamed)
+
+    async def agenerate_stream(self, user_prompt: str, on_text: Callable[[str], None], **kwargs) -> BaseModel:
+        streamed = []
+        def forward(text):
+            streamed.append(text)
+            on_text(text)
+        return await self._acall("agenerate_stream", dict(user_prompt=user_prompt, on_text=forward, **kwargs), streamed)
+
+    def generate_structured_response(self, user_prompt: str, structure, **kwargs) -> BaseModel:
+        return self._call("generate_structured_response", dict(user_prompt=user_prompt, structure=structure, **kwargs))
+
+    async def agenerate_structured_response(self, user_prompt: str, structure, **kwargs) -> BaseModel:
+        return await self._acall("agenerate_structured_response", dict(user_prompt=user_prompt, structure=structure, **kwargs))
+
+
+_router: Optional[ModelRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> ModelRouter:
+    """Return the process wide router configured in config/models.yaml."""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = ModelRouter(
+                    routing.get("nodes", {}),
+                    models,
+                    stats_window=routing.get("stats_window", 50),
+                    stats_max_age_seconds=routing.get("stats_max_age_seconds", 120.0),
+                    min_calls=routing.get("min_calls", 5),
+                    max_error_rate=routing.get("max_error_rate", 0.2),
+                )
+    return _router
+
+
+def route(node: str, *keys: Optional[str], downgrade: bool = False) -> str:
+    """Return the model for a node call from the process wide router."""
+    return get_router().route(node, *keys, downgrade=downgrade)
+
+def routed_client(node: str, *keys: Optional[str], downgrade: bool = False) -> LLMClient:
+    """Return the client of the routed model, falling back to the rest of its chain on retryable failures."""
+    from .registry import get_client
+    router = get_router()
+    chain = router.route_chain(node, *keys, downgrade=downgrade)
+    if len(chain) == 1:
+        return get_client(chain[0])
+    return FallbackLLMClient(router, node, [get_client(model) for model in chain])
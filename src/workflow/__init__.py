@@ -2,7 +2,24 @@
 Graph imports 
 """
 from .datamodels import SubmitQueryRequest, QueryRepsonse
-from .workflow import build_workflow
 
-__all__ = ["SubmitQueryRequest","QueryRepsonse","build_workflow"]
+__all__ = ["SubmitQueryRequest","QueryRepsonse","build_workflow","get_graph","submit_query","asubmit_query","asubmit_queries","stream_query","astream_query"]
 
+# the graph (langgraph, llm clients) is imported on first use to keep start up fast
+_lazy_imports = {
+    "build_workflow": ".workflow",
+    "get_graph": ".endpoint",
+    "submit_query": ".endpoint",
+    "asubmit_query": ".endpoint",
+    "asubmit_queries": ".endpoint",
+    "stream_query": ".endpoint",
+    "astream_query": ".endpoint",
+}
+
+def __getattr__(name):
+    if name not in _lazy_imports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    value = getattr(importlib.import_module(_lazy_imports[name], __name__), name)
+    globals()[name] = value
+    return value
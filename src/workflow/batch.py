@@ -0,0 +1,190 @@
+"""
+Batch grading of a whole set of submissions.
+
+Usage:
+    python -m src.workflow.batch submissions.jsonl -o responses.jsonl --concurrency 20
+
+The input is a JSONL file with one SubmitQueryRequest per line, or a YAML file holding a
+list of requests (optionally under a `submissions` key). One response is written per line
+as soon as it is ready. Successful submission ids are appended to a checkpoint file, a
+re-run with the same checkpoint skips them so interrupted runs resume where they stopped.
+Failed submissions are graded again on resume, the output is then compacted to the last
+response of every submission.
+
+The calls of the batch are recorded in the cost ledger under its batch id (the output file
+name unless given). With a budget, the batch moves to the cheapest models as it nears the
+budget and stops starting new submissions once it is spent; a re-run with a higher budget
+grades the remaining ones.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from pathlib import Path
+from typing import List, Optional, Set
+
+import yaml
+
+from config import settings
+from .datamodels import SubmitQueryRequest
+from .endpoint import asubmit_query
+from .reconcile import reconciliation_stats
+from .ledger import get_ledger, ledger_enabled
+
+logger = logging.getLogger(__name__)
+
+
+def submission_key(request: SubmitQueryRequest) -> str:
+    """ Return the submission id, or a content hash for requests without one"""
+    if request.submission_id:
+        return request.submission_id
+    payload = request.model_dump_json(exclude={"submission_id"})
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+def load_requests(path) -> List[SubmitQueryRequest]:
+    """ Load the submissions from a JSONL or YAML file"""
+    path = Path(path)
+    with open(path, "r", encoding="utf-8") as f:
+        if path.suffix in (".yaml", ".yml"):
+            records = yaml.safe_load(f) or []
+            if isinstance(records, dict):
+                records = records["submissions"]
+        else:
+            records = [json.loads(line) for line in f if line.strip()]
+    requests = [SubmitQueryRequest(**record) for record in records]
+    # fill in ids so responses and checkpoints can be matched to the input
+    for request in requests:
+        request.submission_id = submission_key(request)
+    return requests
+
+def load_checkpoint(path) -> Set[str]:
+    """ Return the ids of already completed submissions"""
+    path = Path(path)
+    if not path.exists():
+        return set()
+    with open(path, "r", encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+def compact_output(path) -> int:
+    """ Keep only the last response of every submission in a JSONL output, return the count dropped"""
+    path = Path(path)
+    last_line = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for index, line in enumerate(f):
+            if line.strip():
+                last_line[json.loads(line)["submission_id"]] = index
+    keep = set(last_line.values())
+    with open(path, "r", encoding="utf-8") as f, open(path.with_suffix(path.suffix + ".tmp"), "w", encoding="utf-8") as compacted:
+        dropped = 0
+        for index, line in enumerate(f):
+            if index in keep:
+                compacted.write(line)
+            elif line.strip():
+                dropped += 1
+    path.with_suffix(path.suffix + ".tmp").replace(path)
+    return dropped
+
+async def run_batch(requests: List[SubmitQueryRequest],
+                    output_path,
+                    checkpoint_path,
+                    concurrency: Optional[int] = None,
+                    graph=None,
+                    batch_id: Optional[str] = None,
+                    budget_usd: Optional[float] = None) -> dict:
+    """ Grade the requests with bounded parallelism, streaming responses to output_path.
+
+    Args:
+        requests: submissions to grade
+        output_path: JSONL file the responses are appended to, compacted to the last response per submission on resume
+        checkpoint_path: file listing completed submission ids
+        concurrency: number of submissions graded at once, defaults to config/settings.yaml
+        graph: compiled async graph, defaults to the shared one
+        batch_id: id the calls are recorded under in the cost ledger, defaults to the output file name
+        budget_usd: budget ceiling of the batch, defaults to config/settings.yaml
+
+    Returns:
+        counts of graded, failed, skipped and (budget) paused submissions
+    """
+    concurrency = concurrency or settings["batch"]["concurrency"]
+    batch_id = batch_id or Path(output_path).stem
+    completed = load_checkpoint(checkpoint_path)
+    pending = [request for request in requests if request.submission_id not in completed]
+    for request in pending:
+        request.batch_id = request.batch_id or batch_id
+    summary = {"batch_id": batch_id, "total": len(requests), "skipped": len(requests) - len(pending),
+               "graded": 0, "failed": 0, "paused": 0}
+    ledger = get_ledger() if ledger_enabled() else None
+    if ledger is not None and budget_usd is not None:
+        ledger.set_budget(batch_id, budget_usd)
+    logger.info(f"Batch: {len(pending)} to grade, {summary['skipped']} already completed")
+
+    resumed = Path(output_path).exists()
+    queue: asyncio.Queue = asyncio.Queue()
+    queued_time = time.time()
+    for request in pending:
+        queue.put_nowait(request)
+
+    with open(output_path, "a", encoding="utf-8") as output, open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+
+        async def worker():
+            while True:
+                if ledger is not None and await asyncio.to_thread(ledger.budget_status, batch_id) == "paused":
+                    # the rest stays out of the checkpoint, a re-run with a higher budget grades it
+                    return
+                try:
+                    request = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    response = await asubmit_query(request, graph=graph, queued_time=queued_time)
+                    record = {"submission_id": request.submission_id, **response.model_dump(mode="json")}
+                except Exception as e:
+                    logger.error(f"Grading failed for {request.submission_id}: {str(e)}")
+                    record = {"submission_id": request.submission_id, "success": False, "error_message": str(e)}
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+                # only successful submissions are checkpointed, failures are retried on resume
+                if record["success"]:
+                    checkpoint.write(request.submission_id + "\n")
+                    checkpoint.flush()
+                    summary["graded"] += 1
+                else:
+                    summary["failed"] += 1
+
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(pending)))))
+    # submissions left in the queue were never started, the workers stopped on the budget
+    summary["paused"] = queue.qsize()
+    if resumed and pending:
+        # failures of the previous runs were graded again, their old responses are dropped
+        dropped = compact_output(output_path)
+        if dropped:
+            logger.info(f"Dropped {dropped} superseded responses from {output_path}")
+    if summary["paused"]:
+        logger.warning(f"Batch {batch_id} paused by its budget, {summary['paused']} submissions not started")
+    if ledger is not None:
+        summary["spent_usd"] = ledger.spent(batch_id)
+        summary["budget_usd"] = ledger.budget(batch_id)
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Grade a batch of submissions")
+    parser.add_argument("input", help="JSONL or YAML file of SubmitQueryRequest records")
+    parser.add_argument("-o", "--output", required=True, help="JSONL file for the responses")
+    parser.add_argument("--checkpoint", help="file of completed ids (default: <output>.checkpoint)")
+    parser.add_argument("--concurrency", type=int, default=None, help="submissions graded at once")
+    parser.add_argument("--batch-id", default=None, help="id of the batch in the cost ledger (default: output file name)")
+    parser.add_argument("--budget", type=float, default=None, help="budget ceiling of the batch in USD")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint"
+    requests = load_requests(args.input)
+    summary = asyncio.run(run_batch(requests, args.output, checkpoint_path, concurrency=args.concurrency,
+                                      batch_id=args.batch_id, budget_usd=args.budget))
+    summary["mark_validation"] = reconciliation_stats()
+    print(json.dumps(summary))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""
+Resumable grading : SQLite checkpoints of the graph state, one thread per submission id.
+
+Nodes report failures in the state (success = False) instead of raising, so a failed run
+still reaches the end of the graph. When the same submission is graded again, the history
+of its thread is searched for the last checkpoint taken before the first failure and the
+run is forked from there : image preprocessing and extraction are not paid twice when the
+content analysis or the feedback failed. Successful threads are dropped at the end of the
+run and failed ones are kept for a limited time and number (pruned every prune_every
+finished runs), so the store stays bounded.
+
+The saver keeps each channel value once per version (as the in-memory saver of langgraph
+does), so the answer images are not copied into every checkpoint. It uses a single sqlite3
+connection behind a lock, the async methods run the same code in a worker thread, so one
+store serves the sync and async graphs on any event loop.
+"""
+import asyncio
+import itertools
+import logging
+import random
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Sequence, Tuple
+
+from langgraph.checkpoint.base import (WRITES_IDX_MAP, BaseCheckpointSaver, ChannelVersions, Checkpoint,
+                                       CheckpointMetadata, CheckpointTuple, get_checkpoint_id,
+                                       get_checkpoint_metadata)
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# state types stored in checkpoints, allowed back when they are loaded
+STATE_TYPES = [("src.workflow.datamodels", "SubmitQueryRequest"), ("src.workflow.datamodels", "Feedback")]
+
+
+class SqliteCheckpointSaver(BaseCheckpointSaver):
+    """Checkpoint saver storing checkpoints, pending writes and channel values in SQLite."""
+
+    def __init__(self, sqlite_path: Optional[str] = None):
+        """Initialize the saver.
+
+        Args:
+            sqlite_path: Path of the database, None keeps the checkpoints in memory for the process
+        """
+        super().__init__(serde=JsonPlusSerializer(allowed_msgpack_modules=STATE_TYPES))
+        if sqlite_path:
+            Path(sqlite_path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(sqlite_path or ":memory:", check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                parent_checkpoint_id TEXT,
+                type TEXT NOT NULL,
+                checkpoint BLOB NOT NULL,
+                metadata_type TEXT NOT NULL,
+                metadata BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+            );
+            CREATE TABLE IF NOT EXISTS writes (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                type TEXT NOT NULL,
+                value BLOB NOT NULL,
+                task_path TEXT NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+            );
+            CREATE TABLE IF NOT EXISTS blobs (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                version TEXT NOT NULL,
+                type TEXT NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+            );
+            CREATE INDEX IF NOT EXISTS checkpoints_created ON checkpoints(created_at);
+        """)
+        self._db.commit()
+
+    def _config(self, thread_id: str, checkpoint_ns: str, checkpoint_id: Optional[str]) -> Optional[dict]:
+        if checkpoint_id is None:
+            return None
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}}
+
+    def _tuple(self, thread_id: str, checkpoint_ns: str, row) -> CheckpointTuple:
+        """ Build a checkpoint tuple from a checkpoints row, with its channel values and pending writes"""
+        checkpoint_id, parent_checkpoint_id, checkpoint_type, checkpoint_blob, metadata_type, metadata_blob = row
+        checkpoint = self.serde.loads_typed((checkpoint_type, checkpoint_blob))
+        channel_values = {}
+        for channel, version in checkpoint["channel_versions"].items():
+            blob = self._db.execute(
+                "SELECT type, value FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                (thread_id, checkpoint_ns, channel, str(version))).fetchone()
+            if blob is not None and blob[0] != "empty":
+                channel_values[channel] = self.serde.loads_typed(blob)
+        writes = self._db.execute(
+            "SELECT task_id, channel, type, value FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? "
+            "ORDER BY task_id, idx", (thread_id, checkpoint_ns, checkpoint_id)).fetchall()
+        return CheckpointTuple(
+            config=self._config(thread_id, checkpoint_ns, checkpoint_id),
+            checkpoint={**checkpoint, "channel_values": channel_values},
+            metadata=self.serde.loads_typed((metadata_type, metadata_blob)),
+            parent_config=self._config(thread_id, checkpoint_ns, parent_checkpoint_id),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((value_type, value))) for task_id, channel, value_type, value in writes],
+        )
+
+    def get_tuple(self, config: dict) -> Optional[CheckpointTuple]:
+        """Return the checkpoint of the config, the latest of its thread when no checkpoint id is given."""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        query = ("SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata FROM checkpoints "
+                 "WHERE thread_id = ? AND checkpoint_ns = ?")
+        params: Tuple = (thread_id, checkpoint_ns)
+        if checkpoint_id := get_checkpoint_id(config):
+            query += " AND checkpoint_id = ?"
+            params += (checkpoint_id,)
+        with self._lock:
+            row = self._db.execute(query + " ORDER BY checkpoint_id DESC LIMIT 1", params).fetchone()
+            return self._tuple(thread_id, checkpoint_ns, row) if row is not None else None
+
+    def list(self,
+             config: Optional[dict],
+             *,
+             filter: Optional[Dict[str, Any]] = None,
+             before: Optional[dict] = None,
+             limit: Optional[int] = None,
+            ) -> Iterator[CheckpointTuple]:
+        """List checkpoints newest first, optionally of one thread, matching the metadata filter."""
+        query = ("SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata "
+                 "FROM checkpoints WHERE 1 = 1")
+        params: Tuple = ()
+        if config:
+            query += " AND thread_id = ?"
+            params += (config["configurable"]["thread_id"],)
+            if "checkpoint_ns" in config["configurable"]:
+                query += " AND checkpoint_ns = ?"
+                params += (config["configurable"]["checkpoint_ns"],)
+            if checkpoint_id := get_checkpoint_id(config):
+                query += " AND checkpoint_id = ?"
+                params += (checkpoint_id,)
+        if before and (before_id := get_checkpoint_id(before)):
+            query += " AND checkpoint_id < ?"
+            params += (before_id,)
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY checkpoint_id DESC", params).fetchall()
+            tuples = []
+            for thread_id, checkpoint_ns, *row in rows:
+                checkpoint_tuple = self._tuple(thread_id, checkpoint_ns, row)
+                if filter and not all(checkpoint_tuple.metadata.get(key) == value for key, value in filter.items()):
+                    continue
+                tuples.append(checkpoint_tuple)
+                if limit is not None and len(tuples) >= limit:
+                    break
+        yield from tuples
+
+    def put(self, config: dict, checkpoint: Checkpoint, metadata: CheckpointMetadata, new_versions: ChannelVersions) -> dict:
+        """Store a checkpoint and the channel values that changed with it."""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint = checkpoint.copy()
+        values = checkpoint.pop("channel_values")
+        checkpoint_type, checkpoint_blob = self.serde.dumps_typed(checkpoint)
+        metadata_type, metadata_blob = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        blobs = [(thread_id, checkpoint_ns, channel, str(version), *(self.serde.dumps_typed(values[channel]) if channel in values else ("empty", b"")))
+                 for channel, version in new_versions.items()]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?)", blobs)
+            self._db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                              checkpoint_type, checkpoint_blob, metadata_type, metadata_blob, time.time()))
+            self._db.commit()
+        return self._config(thread_id, checkpoint_ns, checkpoint["id"])
+
+    def put_writes(self, config: dict, writes: Sequence[Tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        """Store the pending writes of a task."""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx), channel,
+                         *self.serde.dumps_typed(value), task_path))
+        # special writes (errors, interrupts) replace earlier ones, regular writes are kept once
+        replace = all(channel in WRITES_IDX_MAP for channel, _ in writes)
+        with self._lock:
+            self._db.executemany(f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+
+    def delete_thread(self, thread_id: str) -> None:
+        """Delete the checkpoints, writes and channel values of a thread."""
+        with self._lock:
+            for table in ("checkpoints", "writes", "blobs"):
+                self._db.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+            self._db.commit()
+
+    def prune_threads(self, ttl_seconds: Optional[float] = None, max_threads: Optional[int] = None) -> int:
+        """Delete threads not updated for ttl_seconds, then the oldest beyond max_threads, return the count deleted."""
+        with self._lock:
+            threads = self._db.execute(
+                "SELECT thread_id, MAX(created_at) AS updated_at FROM checkpoints GROUP BY thread_id ORDER BY updated_at DESC").fetchall()
+        expired = [thread_id for index, (thread_id, updated_at) in enumerate(threads)
+                   if (ttl_seconds is not None and time.time() - updated_at > ttl_seconds)
+                   or (max_threads is not None and index >= max_threads)]
+        for thread_id in expired:
+            self.delete_thread(thread_id)
+        return len(expired)
+
+    def thread_count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(DISTINCT thread_id) FROM checkpoints").fetchone()[0]
+
+    async def aget_tuple(self, config: dict) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self,
+                    config: Optional[dict],
+                    *,
+                    filter: Optional[Dict[str, Any]] = None,
+                    before: Optional[dict] = None,
+                    limit: Optional[int] = None,
+                   ) -> AsyncIterator[CheckpointTuple]:
+        for checkpoint_tuple in await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit))):
+            yield checkpoint_tuple
+
+    async def aput(self, config: dict, checkpoint: Checkpoint, metadata: CheckpointMetadata, new_versions: ChannelVersions) -> dict:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: dict, writes: Sequence[Tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def get_next_version(self, current: Optional[str], channel: None) -> str:
+        # same version format as the langgraph savers : zero padded counter and a random suffix
+        current_version = 0 if current is None else current if isinstance(current, int) else int(current.split(".")[0])
+        return f"{current_version + 1:032}.{random.random():016}"
+
+
+def checkpointing_enabled() -> bool:
+    return settings.get("checkpointing", {}).get("enabled", False)
+
+_saver: Optional[SqliteCheckpointSaver] = None
+_saver_lock = threading.Lock()
+
+def get_checkpointer() -> SqliteCheckpointSaver:
+    """Return the process wide checkpoint saver configured in config/settings.yaml."""
+    global _saver
+    if _saver is None:
+        with _saver_lock:
+            if _saver is None:
+                _saver = SqliteCheckpointSaver(settings.get("checkpointing", {}).get("sqlite_path"))
+    return _saver
+
+
+def resume_point(graph, request, fresh_input: dict) -> Tuple[Optional[dict], dict]:
+    """ Return the graph input and config grading a submission, resuming its last failed run if any.
+
+    Args:
+        graph: compiled graph with the checkpointer
+        request: submission, its id is the checkpoint thread
+        fresh_input: input of a run from the start
+
+    Returns:
+        (input, config), the input is None when the run is forked from an earlier checkpoint
+    """
+    thread = {"configurable": {"thread_id": request.submission_id}}
+    latest = graph.get_state(thread)
+    # a run that reached the end without failing (kept with keep_successful) has nothing to resume
+    unfinished = bool(latest.next) or latest.values.get("success") is False
+    if latest.values and unfinished and latest.values.get("question") == request:
+        # newest checkpoint with nodes left to run that no failure has reached yet
+        for snapshot in graph.get_state_history(thread):
+            if snapshot.next and snapshot.values.get("success") is not False and snapshot.values.get("student_answer_text"):
+                print(f"|| Resuming submission {request.submission_id} at {', '.join(snapshot.next)} ||")
+                return None, snapshot.config
+    if latest.values:
+        # finished, changed or failed before extraction : grade again from the start
+        get_checkpointer().delete_thread(request.submission_id)
+    return fresh_input, thread
+
+# runs finished in this process, the retention scan runs on the first and every prune_every
+_finished_runs = itertools.count()
+
+def finish_thread(request, state: dict):
+    """ Apply the retention policy once a checkpointed run is over"""
+    checkpoint_settings = settings.get("checkpointing", {})
+    saver = get_checkpointer()
+    if state.get("success") != False and not checkpoint_settings.get("keep_successful", False):
+        saver.delete_thread(request.submission_id)
+    if next(_finished_runs) % checkpoint_settings.get("prune_every", 100) != 0:
+        return
+    pruned = saver.prune_threads(checkpoint_settings.get("ttl_seconds"), checkpoint_settings.get("max_threads"))
+    if pruned:
+        logger.info(f"Pruned {pruned} checkpoint threads")
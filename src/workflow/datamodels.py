@@ -1,10 +1,16 @@
 """ Data Models"""
 
-from pydantic import BaseModel, Field
+import operator
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Annotated, TypedDict, List, Dict, Any,  Optional
 
 # class to accept input 
 class SubmitQueryRequest(BaseModel):
+    # inline image bytes travel as base64 in JSON
+    model_config = ConfigDict(ser_json_bytes="base64", val_json_bytes="base64")
+    submission_id : Optional[str] = None
+    # batch the submission is graded in, its spend counts against the batch budget
+    batch_id : Optional[str] = None
     type : str = 'numerical_problem'
     grade : int = 12
     max_marks :float = 2
@@ -21,16 +27,41 @@ class SubmitQueryRequest(BaseModel):
     student_answer_typed : str = ""
     handwritten: bool = True 
     student_answer_image_urls : list = ["https://smart-grading-test.s3.us-west-2.amazonaws.com/Vision_testing/259260_Incorrect+soln_Set+01.jpg"]
+    # pages passed in memory or from local disk skip the upload/download round trip
+    student_answer_images : List[bytes] = []
+    student_answer_image_paths : List[str] = []
     complexity : str = "basic"
 
+    def answer_images(self) -> list:
+        """ Return the answer pages : inline bytes, then local files, then urls"""
+        images = list(self.student_answer_images)
+        for path in self.student_answer_image_paths:
+            with open(path, "rb") as f:
+                images.append(f.read())
+        return images + list(self.student_answer_image_urls)
+
 # class 
 class Feedback(BaseModel):
     criteria: list[list[str]]
 
+# reducers for state keys written by parallel branches
+def all_succeeded(current: Optional[bool], new: Optional[bool]) -> Optional[bool]:
+    """ a failure in any branch fails the run"""
+    if current is None or new is None:
+        return new if current is None else current
+    return current and new
+
+def first_error(current: Optional[str], new: Optional[str]) -> Optional[str]:
+    """ keep the first error reported"""
+    return current if current is not None else new
+
 # state 
 class State(TypedDict):
     question: SubmitQueryRequest
+    answer_images: List[bytes]
+    image_preprocessing: dict
     student_answer_text: str
+    page_extractions: List[dict]
     solution_pathway : str
     reason_for_classification : str
     content_analysis : str
@@ -39,11 +70,19 @@ class State(TypedDict):
     mark : float
     validation: bool = True
     retry_attempt : int = 0
-    cost : float
-    input_tokens : float
-    output_tokens : float
-    success: bool = True
-    error_message: Optional[str] = None
+    # nodes return the cost of their own calls, parallel branches are summed
+    cost : Annotated[float, operator.add]
+    input_tokens : Annotated[float, operator.add]
+    output_tokens : Annotated[float, operator.add]
+    cached_input_tokens : Annotated[float, operator.add]
+    success: Annotated[Optional[bool], all_succeeded]
+    error_message: Annotated[Optional[str], first_error]
+    # spans of the node executions and llm calls, set when tracing is enabled
+    trace_context: dict
+    trace: Annotated[List[dict], operator.add]
+    # set when the grade was reused from an earlier "exact" or "near" duplicate answer
+    duplicate: Optional[str]
+    duplicate_of: Optional[str]
 
 # class to output through endpoint 
 class QueryRepsonse(BaseModel):
@@ -53,11 +92,17 @@ class QueryRepsonse(BaseModel):
     mark: Optional[float]
     extracted_answer : Optional[str]
     content_analysis : Optional[str]
+    image_preprocessing : Optional[dict] = None
     cost : float
     input_tokens: float
     output_tokens: float
+    cached_input_tokens: float = 0.0
     success: bool = True
     error_message: Optional[str] = None
+    trace: Optional[List[dict]] = None
+    # "exact" or "near" when the grade was reused from an earlier duplicate answer, with its submission id
+    duplicate: Optional[str] = None
+    duplicate_of: Optional[str] = None
 
 # solution pathway analysis structure 
 solution_pathway_classification = {
@@ -214,4 +259,66 @@ response_structure_textual= {
     "total_points",
     "mark"
   ]
-}
\ No newline at end of file
+}
+
+# fused numerical structure : pathway classification, content analysis and grading in one call.
+# propertyOrdering keeps the classification and analysis ahead of the marks they justify
+numerical_fused_response_structure = {
+  "type": "object",
+  "properties": {
+    "solution_pathway": {
+      "type": "string",
+      "enum": ["standard_approach","acceptable_alternative_approach","irrelevant_approach"]
+    },
+    "reason_for_classification": {
+        "type": "string",
+        "description": "Concise reason for classification"
+    },
+    "content_analysis": {
+        "type": "string",
+        "description": "Detailed step analysis of the student answer, with the MAX marks of every step"
+    },
+    "criteria": {
+      "type": "array",
+      "description": "Contains array of steps (or partial credit criteria for an irrelevant approach) from the content analysis",
+      "items": {
+        "type": "array",
+        "description": "Contains deatils about grading each step[Concise Step ,Marks Given/Total Marks, ONE LINE CALLOUT of specific error if any or comment on correctness]",
+        "items": {
+          "type": "string"
+        }
+      },
+      "minItems": 1,
+      "maxItems": 6
+    },
+    "total_points": {
+      "type": "array",
+      "description": "Contains Total marks and concise over all feedback for the student answer [Total_Marks_Scored/Max_Marks, Overall Feedback]",
+      "items": {
+        "type": "string"
+      },
+      "minItems": 2,
+      "maxItems": 2
+    },
+    "mark": {
+      "type": "number",
+      "format": "double"
+    }
+  },
+  "required": [
+    "solution_pathway",
+    "reason_for_classification",
+    "content_analysis",
+    "criteria",
+    "total_points",
+    "mark"
+  ],
+  "propertyOrdering": [
+    "solution_pathway",
+    "reason_for_classification",
+    "content_analysis",
+    "criteria",
+    "total_points",
+    "mark"
+  ]
+}
@@ -0,0 +1,192 @@
+"""
+Duplicate answer detection : reuse the grade of an earlier answer to the same question.
+
+Handwritten answers of a class often transcribe to nearly the same text. After extraction
+the answer is normalized and fingerprinted twice : a sha256 of the normalized text for
+exact duplicates and a 64 bit simhash of its token shingles for near duplicates. Near
+duplicates must also have exactly the same sequence of numbers, single letter variables and
+operators (signs included, in order), so two answers that only differ in a sign, an
+operator, a variable or a final value are never merged. Case is kept, R and r differ. Grades are stored
+per question (every request field that affects grading, none of the answer fields, and the
+prompt versions) in SQLite, in memory unless a path is set.
+"""
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import config
+from config import settings
+from .datamodels import SubmitQueryRequest
+
+logger = logging.getLogger(__name__)
+
+# request fields describing the answer rather than the question
+ANSWER_FIELDS = {"submission_id", "batch_id", "handwritten", "student_answer_typed", "student_answer_image_urls",
+                 "student_answer_images", "student_answer_image_paths"}
+
+# numbers, single letter variables (case sensitive) and the operators between them, "-" keeps the signs
+_MATH_TOKEN = re.compile(r"\d+(?:\.\d+)?|(?<![^\W\d_])[^\W\d_](?![^\W\d_])|[-+*/=<>^()±×÷√∫∑≤≥≠]")
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+
+def normalize_answer(text: str) -> str:
+    """ Unicode and spacing normalized form of an extracted answer, case is significant"""
+    text = unicodedata.normalize("NFKC", text).replace("\u2212", "-")
+    text = re.sub(r"\s+", " ", text)
+    # spacing around symbols and operators varies between transcriptions of the same page
+    return re.sub(r"\s*([^\w\s])\s*", r"\1", text).strip()
+
+def math_fingerprint(normalized: str) -> str:
+    """ Digest of the ordered numbers, variables and operators of the answer, near duplicates must agree on all of them"""
+    tokens = " ".join(_MATH_TOKEN.findall(normalized))
+    return hashlib.blake2b(tokens.encode("utf-8"), digest_size=16).hexdigest()
+
+def simhash(normalized: str, shingle: int = 3) -> int:
+    """ 64 bit simhash of the token shingles of a normalized answer"""
+    tokens = _TOKEN.findall(normalized)
+    features = [" ".join(tokens[i:i + shingle]) for i in range(max(1, len(tokens) - shingle + 1))]
+    weights = [0] * 64
+    for feature in features:
+        value = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+def question_key(request: SubmitQueryRequest) -> str:
+    """ Fingerprint of everything in a request that affects the grade except the answer"""
+    fields = request.model_dump(mode="json", exclude=ANSWER_FIELDS)
+    # grades from earlier prompts are not reused, the prompt files are read on first use
+    fields["prompts_version"] = config.prompts_version
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class DuplicateMatch(NamedTuple):
+    kind: str # "exact" or "near"
+    submission_id: Optional[str]
+    grade: dict
+
+
+class GradeStore:
+    """SQLite store of finished grades, looked up by exact and near duplicate fingerprints."""
+
+    def __init__(self,
+                 sqlite_path: Optional[str] = None,
+                 near_duplicates: bool = True,
+                 max_hamming_distance: int = 3,
+                 min_words: int = 20,
+                 ttl_seconds: Optional[float] = None,
+                ):
+        """Initialize the store.
+
+        Args:
+            sqlite_path: Path of the database, None keeps the grades in memory for the process
+            near_duplicates: Also match answers whose simhash is within max_hamming_distance
+            max_hamming_distance: Differing simhash bits (out of 64) still counted as a near duplicate
+            min_words: Shorter answers are only matched exactly, their simhash is too coarse
+            ttl_seconds: Grades older than this are no longer reused
+        """
+        self.near_duplicates = near_duplicates
+        self.max_hamming_distance = max_hamming_distance
+        self.min_words = min_words
+        self.ttl_seconds = ttl_seconds
+        self.counters = {"exact": 0, "near": 0, "misses": 0, "stored": 0}
+        self._lock = threading.Lock()
+        if sqlite_path:
+            Path(sqlite_path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(sqlite_path or ":memory:", check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS answer_grades (
+                question_key TEXT NOT NULL,
+                answer_sha256 TEXT NOT NULL,
+                math_tokens TEXT NOT NULL,
+                simhash TEXT NOT NULL,
+                words INTEGER NOT NULL,
+                submission_id TEXT,
+                grade TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (question_key, answer_sha256)
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS answer_grades_math ON answer_grades(question_key, math_tokens)")
+        self._db.commit()
+
+    def _fingerprints(self, answer: str):
+        normalized = normalize_answer(answer)
+        return (hashlib.sha256(normalized.encode("utf-8")).hexdigest(), math_fingerprint(normalized),
+                simhash(normalized), len(normalized.split(" ")))
+
+    def find(self, request: SubmitQueryRequest, answer: str) -> Optional[DuplicateMatch]:
+        """Return the stored grade of an exact or near duplicate answer to the question, if any."""
+        key = question_key(request)
+        answer_sha256, math_tokens, answer_simhash, words = self._fingerprints(answer)
+        oldest = time.time() - self.ttl_seconds if self.ttl_seconds is not None else 0.0
+        with self._lock:
+            row = self._db.execute(
+                "SELECT submission_id, grade FROM answer_grades WHERE question_key = ? AND answer_sha256 = ? AND created_at >= ?",
+                (key, answer_sha256, oldest)).fetchone()
+            if row is not None:
+                self.counters["exact"] += 1
+                return DuplicateMatch("exact", row[0], json.loads(row[1]))
+            if self.near_duplicates and words >= self.min_words:
+                best = None
+                for submission_id, grade, stored_simhash in self._db.execute(
+                        "SELECT submission_id, grade, simhash FROM answer_grades "
+                        "WHERE question_key = ? AND math_tokens = ? AND words >= ? AND created_at >= ?",
+                        (key, math_tokens, self.min_words, oldest)):
+                    distance = bin(answer_simhash ^ int(stored_simhash, 16)).count("1")
+                    if distance <= self.max_hamming_distance and (best is None or distance < best[0]):
+                        best = (distance, submission_id, grade)
+                if best is not None:
+                    self.counters["near"] += 1
+                    return DuplicateMatch("near", best[1], json.loads(best[2]))
+            self.counters["misses"] += 1
+            return None
+
+    def add(self, request: SubmitQueryRequest, answer: str, grade: dict):
+        """Store the grade of an answer, the first grade of an exact duplicate is kept."""
+        answer_sha256, math_tokens, answer_simhash, words = self._fingerprints(answer)
+        now = time.time()
+        with self._lock:
+            if self.ttl_seconds is not None:
+                self._db.execute("DELETE FROM answer_grades WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._db.execute(
+                "INSERT OR IGNORE INTO answer_grades (question_key, answer_sha256, math_tokens, simhash, words, submission_id, grade, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (question_key(request), answer_sha256, math_tokens, f"{answer_simhash:016x}", words,
+                 request.submission_id, json.dumps(grade), now))
+            self._db.commit()
+            self.counters["stored"] += 1
+
+    def stats(self) -> dict:
+        """Return the match counters and the number of stored grades."""
+        with self._lock:
+            return {**self.counters, "grades": self._db.execute("SELECT COUNT(*) FROM answer_grades").fetchone()[0]}
+
+
+def dedupe_enabled() -> bool:
+    return settings.get("dedupe", {}).get("enabled", False)
+
+_grade_store: Optional[GradeStore] = None
+_grade_store_lock = threading.Lock()
+
+def get_grade_store() -> GradeStore:
+    """Return the process wide grade store configured in config/settings.yaml."""
+    global _grade_store
+    if _grade_store is None:
+        with _grade_store_lock:
+            if _grade_store is None:
+                dedupe_settings = settings.get("dedupe", {})
+                _grade_store = GradeStore(
+                    sqlite_path=dedupe_settings.get("sqlite_path"),
+                    near_duplicates=dedupe_settings.get("near_duplicates", True),
+                    max_hamming_distance=dedupe_settings.get("max_hamming_distance", 3),
+                    min_words=dedupe_settings.get("min_words", 20),
+                    ttl_seconds=dedupe_settings.get("ttl_seconds"),
+                )
+    return _grade_store
@@ -0,0 +1,161 @@
+"""
+Grading entry points : run the graph for a request and build the response
+"""
+import asyncio
+import time
+from functools import lru_cache
+from typing import AsyncIterator, Iterator, List, Optional
+
+from config import settings
+from .datamodels import SubmitQueryRequest, QueryRepsonse
+from .tracing import new_trace_context, root_span, export_trace, tracing_enabled
+
+
+@lru_cache(maxsize=None)
+def get_graph(asynchronous: bool = False, fused: Optional[bool] = None, checkpointed: bool = False):
+    """ Build the compiled graph once and reuse it, langgraph is only imported here
+
+    Args:
+        fused: force the fused (True) or three call (False) variant, None follows config/settings.yaml
+        checkpointed: compile with the checkpoint store, every run then needs a submission id
+    """
+    from .workflow import build_workflow
+    checkpointer = None
+    if checkpointed:
+        from .checkpoints import get_checkpointer
+        checkpointer = get_checkpointer()
+    return build_workflow(asynchronous=asynchronous, fused=fused, checkpointer=checkpointer)
+
+def prepare_run(request: SubmitQueryRequest, graph=None, asynchronous: bool = False):
+    """ Return the graph, input and config of a run.
+
+    Submissions with an id are checkpointed when checkpointing is enabled, a failed
+    run of the same submission is then resumed from its last good checkpoint.
+    """
+    checkpointed = bool(request.submission_id) and settings.get("checkpointing", {}).get("enabled", False)
+    graph = graph or get_graph(asynchronous=asynchronous, checkpointed=checkpointed)
+    if graph.checkpointer is None:
+        return graph, initial_state(request), None
+    from .checkpoints import resume_point
+    graph_input, config = resume_point(graph, request, initial_state(request))
+    return graph, graph_input, config
+
+def finish_run(request: SubmitQueryRequest, state: dict, config: Optional[dict]):
+    """ Apply the checkpoint retention policy after a checkpointed run"""
+    if config is not None:
+        from .checkpoints import finish_thread
+        finish_thread(request, state)
+
+def state_to_response(state: dict) -> QueryRepsonse:
+    """ Convert the final graph state into the endpoint response"""
+    return QueryRepsonse(
+    solution_pathway = state.get("solution_pathway", None),
+    reason = state.get("feedback", None),
+    value_points = state.get("value_points", None),
+    mark= state.get("mark", 0.0),
+    extracted_answer = state.get("student_answer_text", None),
+    content_analysis = state.get("content_analysis", None),
+    image_preprocessing = state.get("image_preprocessing", None),
+    cost = state.get("cost", 0.0),
+    input_tokens = state.get("input_tokens", 0.0),
+    output_tokens = state.get("output_tokens", 0.0),
+    cached_input_tokens = state.get("cached_input_tokens", 0.0),
+    success = state.get("success", True),
+    error_message = state.get("error_message", None),
+    trace = state.get("trace") if settings.get("tracing", {}).get("include_in_response", False) else None,
+    duplicate = state.get("duplicate", None),
+    duplicate_of = state.get("duplicate_of", None),
+    )
+
+def initial_state(request: SubmitQueryRequest) -> dict:
+    """ Graph input for a request, with a new trace when tracing is enabled"""
+    if tracing_enabled():
+        return {"question": request, "trace_context": new_trace_context(), "trace": []}
+    return {"question": request}
+
+def finish_trace(state: dict, request: SubmitQueryRequest, start_time: float, queued_time: Optional[float] = None) -> dict:
+    """ Add the submission span to the trace of a finished run and export it"""
+    if not state.get("trace_context"):
+        return state
+    end_time = time.time()
+    span = root_span(state["trace_context"], state, start_time, end_time,
+                     queue_time=start_time - (queued_time or start_time), submission_id=request.submission_id)
+    trace = [span] + state.get("trace", [])
+    export_trace(trace)
+    return {**state, "trace": trace}
+
+def submit_query(request: SubmitQueryRequest, graph=None) -> QueryRepsonse:
+    """ invoke the graph and return reposne"""
+    start_time = time.time()
+    graph, graph_input, config = prepare_run(request, graph)
+    state = graph.invoke(graph_input, config)
+    finish_run(request, state, config)
+    return state_to_response(finish_trace(state, request, start_time))
+
+async def asubmit_query(request: SubmitQueryRequest, graph=None, queued_time: Optional[float] = None) -> QueryRepsonse:
+    """ invoke the async graph and return reposne
+
+    Args:
+        queued_time: when the request was queued, the wait is recorded as the queue time of its trace
+    """
+    start_time = time.time()
+    # checkpoint lookups are sqlite reads, kept off the event loop
+    graph, graph_input, config = await asyncio.to_thread(prepare_run, request, graph, True)
+    state = await graph.ainvoke(graph_input, config)
+    await asyncio.to_thread(finish_run, request, state, config)
+    return state_to_response(finish_trace(state, request, start_time, queued_time))
+
+def stream_query(request: SubmitQueryRequest, graph=None) -> Iterator[dict]:
+    """ Grade a request and yield progress events as they happen.
+
+    Events:
+        {"type": "node", "node": name, "status": "started" | "finished"}
+        {"type": "partial", "field": "content_analysis", "text": next piece of text}
+        {"type": "result", "response": QueryRepsonse}, always the last event
+    """
+    start_time = time.time()
+    graph, graph_input, config = prepare_run(request, graph)
+    state = {}
+    for mode, event in graph.stream(graph_input, config, stream_mode=["custom", "values"]):
+        if mode == "custom":
+            yield event
+        else:
+            state = event
+    finish_run(request, state, config)
+    yield {"type": "result", "response": state_to_response(finish_trace(state, request, start_time))}
+
+async def astream_query(request: SubmitQueryRequest, graph=None) -> AsyncIterator[dict]:
+    """ Async version of stream_query"""
+    start_time = time.time()
+    graph, graph_input, config = await asyncio.to_thread(prepare_run, request, graph, True)
+    state = {}
+    async for mode, event in graph.astream(graph_input, config, stream_mode=["custom", "values"]):
+        if mode == "custom":
+            yield event
+        else:
+            state = event
+    await asyncio.to_thread(finish_run, request, state, config)
+    yield {"type": "result", "response": state_to_response(finish_trace(state, request, start_time))}
+
+async def asubmit_queries(requests: List[SubmitQueryRequest],
+                          concurrency: Optional[int] = None,
+                          graph=None) -> List[QueryRepsonse]:
+    """ Grade many requests concurrently on the running event loop.
+
+    Args:
+        requests: requests to grade
+        concurrency: maximum number of submissions in flight, defaults to config/settings.yaml
+        graph: compiled async graph, defaults to the shared one
+
+    Returns:
+        responses in the same order as the requests
+    """
+    concurrency = concurrency or settings["concurrency"]["max_concurrent_submissions"]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def grade(request):
+        queued_time = time.time()
+        async with semaphore:
+            return await asubmit_query(request, graph=graph, queued_time=queued_time)
+
+    return await asyncio.gather(*(grade(request) for request in requests))
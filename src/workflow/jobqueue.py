@@ -0,0 +1,327 @@
+"""
+Durable grading job queue in SQLite, processed by several worker processes.
+
+    python -m src.workflow.jobqueue enqueue submissions.jsonl
+    python -m src.workflow.jobqueue work --processes 4 --concurrency 10
+    python -m src.workflow.jobqueue status --watch 5
+    python -m src.workflow.jobqueue results -o responses.jsonl
+
+A job is one submission (keyed by its submission id, enqueueing it again is a no-op) and
+moves pending -> leased -> done | failed. A worker leases a job for lease_seconds and
+renews the lease while grading it; the lease of a worker that died expires and the job is
+leased again, up to max_attempts. Completing a job only succeeds for the current holder of
+its lease, so a job finished twice (a slow worker whose lease was taken over) keeps its
+first result. Runs are checkpointed per submission id, a re-leased job resumes from its
+last good step.
+
+Every worker process builds its own graph and grades `concurrency` jobs at once, the
+processes share the queue, the checkpoints and the cost ledger through SQLite, and image
+preprocessing and JSON handling use every core.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+from config import settings
+from .datamodels import SubmitQueryRequest, QueryRepsonse
+
+logger = logging.getLogger(__name__)
+
+STATES = ("pending", "leased", "done", "failed")
+
+
+class LeasedJob(NamedTuple):
+    job_id: str
+    request: SubmitQueryRequest
+    attempts: int
+    enqueued_at: float
+
+
+class JobQueue:
+    """SQLite queue of grading jobs with leases, shared by processes on one machine."""
+
+    def __init__(self,
+                 sqlite_path: str,
+                 lease_seconds: float = 300.0,
+                 max_attempts: int = 3,
+                ):
+        """Initialize the queue.
+
+        Args:
+            sqlite_path: Path of the database, shared by the enqueuing process, the workers and the status tool
+            lease_seconds: A leased job not renewed for this long is handed to another worker
+            max_attempts: Leases of a job before it is marked failed
+        """
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        Path(sqlite_path).parent.mkdir(parents=True, exist_ok=True)
+        # transactions are opened explicitly, BEGIN IMMEDIATE serialises the leases of all processes
+        self._db = sqlite3.connect(sqlite_path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                request TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires REAL,
+                enqueued_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                response TEXT,
+                error_message TEXT
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, enqueued_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_finished ON jobs(finished_at)")
+
+    def _transaction(self, statements):
+        """Run statements(cursor) in one write transaction and return its result."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self._db)
+                self._db.execute("COMMIT")
+                return result
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, requests: List[SubmitQueryRequest]) -> int:
+        """Add the submissions as pending jobs, return how many were new."""
+        now = time.time()
+        rows = [(request.submission_id, request.model_dump_json(), now) for request in requests]
+        if any(job_id is None for job_id, _, _ in rows):
+            raise ValueError("Every queued submission needs a submission_id")
+
+        def insert(db):
+            before = db.total_changes
+            db.executemany("INSERT OR IGNORE INTO jobs (job_id, request, state, enqueued_at) VALUES (?, ?, 'pending', ?)", rows)
+            return db.total_changes - before
+        return self._transaction(insert)
+
+    def lease(self, owner: str) -> Optional[LeasedJob]:
+        """Lease the oldest pending job, or a job whose lease expired, None when there is none."""
+        def take(db):
+            now = time.time()
+            # jobs of dead workers that used up their attempts are not handed out again
+            db.execute("UPDATE jobs SET state = 'failed', finished_at = ?, lease_owner = NULL, "
+                       "error_message = 'lease expired after ' || attempts || ' attempts' "
+                       "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, self.max_attempts))
+            row = db.execute("SELECT job_id, request, attempts, enqueued_at FROM jobs WHERE state = 'pending' "
+                             "OR (state = 'leased' AND lease_expires < ?) ORDER BY enqueued_at LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                       "started_at = ? WHERE job_id = ?", (owner, now + self.lease_seconds, now, row[0]))
+            return row
+        row = self._transaction(take)
+        if row is None:
+            return None
+        return LeasedJob(row[0], SubmitQueryRequest.model_validate_json(row[1]), row[2] + 1, row[3])
+
+    def has_work(self) -> bool:
+        """Return whether a job is pending or held by an expired lease, so could still be leased."""
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM jobs WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) LIMIT 1",
+                                    (time.time(),)).fetchone() is not None
+
+    def renew(self, owner: str, job_ids: List[str]) -> int:
+        """Extend the leases still held by owner, return how many were renewed."""
+        if not job_ids:
+            return 0
+        expires = time.time() + self.lease_seconds
+
+        def extend(db):
+            before = db.total_changes
+            db.executemany("UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND state = 'leased' AND lease_owner = ?",
+                           [(expires, job_id, owner) for job_id in job_ids])
+            return db.total_changes - before
+        return self._transaction(extend)
+
+    def complete(self, owner: str, job: LeasedJob, response: Optional[QueryRepsonse], error_message: Optional[str] = None) -> bool:
+        """Record the outcome of a leased job, False when the lease was lost (the outcome is dropped).
+
+        Successful gradings are done. Failed ones go back to pending until the job used
+        max_attempts, then they are failed.
+        """
+        success = response is not None and response.success
+        if response is not None and not success:
+            error_message = response.error_message
+        state = "done" if success else ("failed" if job.attempts >= self.max_attempts else "pending")
+
+        def finish(db):
+            return db.execute(
+                "UPDATE jobs SET state = ?, response = ?, error_message = ?, finished_at = ?, lease_owner = NULL, "
+                "lease_expires = NULL WHERE job_id = ? AND state = 'leased' AND lease_owner = ?",
+                (state, response.model_dump_json() if response is not None else None, error_message,
+                 time.time() if state != "pending" else None, job.job_id, owner)).rowcount
+        if not self._transaction(finish):
+            logger.warning(f"Lease of job {job.job_id} was lost, its result is dropped")
+            return False
+        return True
+
+    def status(self, window_seconds: float = 60.0) -> dict:
+        """Return the per state counts, queue depth, throughput and age of the oldest pending job."""
+        now = time.time()
+        with self._lock:
+            counts = dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            expired = self._db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'leased' AND lease_expires < ?", (now,)).fetchone()[0]
+            finished = dict(self._db.execute("SELECT state, COUNT(*) FROM jobs WHERE finished_at >= ? GROUP BY state",
+                                             (now - window_seconds,)).fetchall())
+            oldest = self._db.execute("SELECT MIN(enqueued_at) FROM jobs WHERE state = 'pending'").fetchone()[0]
+            workers = self._db.execute("SELECT COUNT(DISTINCT lease_owner) FROM jobs WHERE state = 'leased' AND lease_expires >= ?",
+                                       (now,)).fetchone()[0]
+        return {
+            "states": {state: counts.get(state, 0) for state in STATES},
+            "queue_depth": counts.get("pending", 0) + expired,
+            "expired_leases": expired,
+            "active_workers": workers,
+            "throughput_per_minute": (finished.get("done", 0) + finished.get("failed", 0)) * 60.0 / window_seconds,
+            "oldest_pending_seconds": now - oldest if oldest is not None else None,
+        }
+
+    def results(self, states=("done", "failed")):
+        """Yield (job_id, state, response dict or None, error_message) of the finished jobs."""
+        with self._lock:
+            rows = self._db.execute(f"SELECT job_id, state, response, error_message FROM jobs WHERE state IN "
+                                    f"({', '.join('?' for _ in states)}) ORDER BY finished_at", tuple(states)).fetchall()
+        for job_id, state, response, error_message in rows:
+            yield job_id, state, json.loads(response) if response else None, error_message
+
+
+def queue_from_settings(sqlite_path: Optional[str] = None) -> JobQueue:
+    """ Build the queue from the job_queue section of config/settings.yaml"""
+    queue_settings = settings.get("job_queue", {})
+    return JobQueue(
+        sqlite_path or queue_settings.get("sqlite_path", ".cache/jobs.sqlite3"),
+        lease_seconds=queue_settings.get("lease_seconds", 300),
+        max_attempts=queue_settings.get("max_attempts", 3),
+    )
+
+
+async def work(queue: JobQueue, owner: str, concurrency: int, poll_interval: float, exit_when_empty: bool) -> Dict[str, int]:
+    """ Lease and grade jobs with `concurrency` in flight until stopped (or the queue is empty)"""
+    from .endpoint import asubmit_query
+    held: Dict[str, LeasedJob] = {}
+    counts = {"done": 0, "failed": 0, "retried": 0, "lost": 0}
+
+    async def renew_leases():
+        # a third of the lease leaves time for two missed renewals
+        while True:
+            await asyncio.sleep(queue.lease_seconds / 3)
+            await asyncio.to_thread(queue.renew, owner, list(held))
+
+    async def slot():
+        while True:
+            job = await asyncio.to_thread(queue.lease, owner)
+            if job is None:
+                # a job held by another slot can still fail and go back to pending, stop once none is left anywhere
+                if exit_when_empty and not held and not await asyncio.to_thread(queue.has_work):
+                    return
+                await asyncio.sleep(poll_interval)
+                continue
+            held[job.job_id] = job
+            response, error_message = None, None
+            try:
+                response = await asubmit_query(job.request, queued_time=job.enqueued_at)
+            except Exception as e:
+                logger.error(f"Grading failed for job {job.job_id}: {str(e)}")
+                error_message = str(e)
+            completed = await asyncio.to_thread(queue.complete, owner, job, response, error_message)
+            del held[job.job_id]
+            if not completed:
+                counts["lost"] += 1
+            elif response is not None and response.success:
+                counts["done"] += 1
+            else:
+                counts["failed" if job.attempts >= queue.max_attempts else "retried"] += 1
+
+    renewer = asyncio.create_task(renew_leases())
+    try:
+        await asyncio.gather(*(slot() for _ in range(concurrency)))
+    finally:
+        renewer.cancel()
+    return counts
+
+def worker_process(sqlite_path: str, index: int, concurrency: int, poll_interval: float, exit_when_empty: bool):
+    """ Entry point of one worker process"""
+    logging.basicConfig(level=logging.INFO)
+    owner = f"{socket.gethostname()}:{os.getpid()}:{index}"
+    queue = queue_from_settings(sqlite_path)
+    counts = asyncio.run(work(queue, owner, concurrency, poll_interval, exit_when_empty))
+    print(f"|| Worker {owner} stopped : {counts} ||")
+
+def run_workers(sqlite_path: str, processes: int, concurrency: int, poll_interval: float, exit_when_empty: bool):
+    """ Start the worker processes and wait for them"""
+    # spawned, not forked : the parent may hold sqlite connections and threads
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=worker_process, args=(sqlite_path, index, concurrency, poll_interval, exit_when_empty),
+                               name=f"grading-worker-{index}") for index in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # leases of the interrupted jobs expire and the jobs are graded again
+        for worker in workers:
+            worker.terminate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Durable grading job queue")
+    parser.add_argument("--db", default=None, help="queue database (default: job_queue.sqlite_path in config/settings.yaml)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    enqueue = commands.add_parser("enqueue", help="queue the submissions of a JSONL or YAML file")
+    enqueue.add_argument("input")
+    workers = commands.add_parser("work", help="grade queued jobs with worker processes")
+    workers.add_argument("--processes", type=int, default=None, help="worker processes (default: settings, then cpu count)")
+    workers.add_argument("--concurrency", type=int, default=None, help="jobs graded at once per process")
+    workers.add_argument("--exit-when-empty", action="store_true", help="stop once no job is left instead of polling")
+    status = commands.add_parser("status", help="per state counts, queue depth and throughput")
+    status.add_argument("--watch", type=float, default=None, metavar="SECONDS", help="print the status every SECONDS")
+    status.add_argument("--window", type=float, default=60.0, help="seconds the throughput is measured over")
+    results = commands.add_parser("results", help="write the finished jobs as JSONL")
+    results.add_argument("-o", "--output", required=True)
+    args = parser.parse_args(argv)
+
+    queue_settings = settings.get("job_queue", {})
+    sqlite_path = args.db or queue_settings.get("sqlite_path", ".cache/jobs.sqlite3")
+    if args.command == "enqueue":
+        from .batch import load_requests
+        requests = load_requests(args.input)
+        added = queue_from_settings(sqlite_path).enqueue(requests)
+        print(f"|| Queued {added} new jobs, {len(requests) - added} already queued ||")
+    elif args.command == "work":
+        run_workers(sqlite_path,
+                    processes=args.processes or queue_settings.get("processes") or os.cpu_count() or 1,
+                    concurrency=args.concurrency or queue_settings.get("concurrency", 10),
+                    poll_interval=queue_settings.get("poll_interval_seconds", 1.0),
+                    exit_when_empty=args.exit_when_empty)
+    elif args.command == "status":
+        queue = queue_from_settings(sqlite_path)
+        while True:
+            print(json.dumps(queue.status(args.window)))
+            if args.watch is None:
+                break
+            time.sleep(args.watch)
+    elif args.command == "results":
+        with open(args.output, "w", encoding="utf-8") as output:
+            for job_id, state, response, error_message in queue_from_settings(sqlite_path).results():
+                record = response or {"success": False, "error_message": error_message}
+                output.write(json.dumps({"submission_id": job_id, "state": state, **record}) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+Persistent cost and token ledger, with per batch budgets.
+
+Every LLM call of a node is appended to a local SQLite ledger : batch, submission,
+question, node, model, tokens (input, cached input, output and the thinking part of the
+output) and cost. Rows are never updated, totals are aggregated on demand by any mix of
+batch, question, node and model.
+
+A batch can have a budget ceiling (config/settings.yaml or set per batch). Once its spend
+reaches downgrade_at of the ceiling the remaining calls of the batch are routed to the
+cheapest healthy model of their route, once it reaches pause_at the batch runner stops
+starting new submissions.
+
+Rows are buffered in memory and committed in batches by a background thread (every
+flush_interval_seconds, or sooner once flush_rows are waiting), so recording a call never
+waits on the disk. Budget checks never query the database either : the spend and budget of
+a batch are read once, the spend is then advanced by every recorded call, and the
+background thread re-reads both every flush interval to pick up the calls and budgets of
+other processes sharing the ledger.
+
+    python -m src.workflow.ledger --by batch_id model
+    python -m src.workflow.ledger --batch responses --by node
+"""
+import argparse
+import atexit
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from config import settings
+from .datamodels import SubmitQueryRequest
+from .dedupe import question_key
+
+logger = logging.getLogger(__name__)
+
+# columns totals can be grouped by
+GROUP_COLUMNS = ("batch_id", "submission_id", "question_key", "node", "model")
+
+_TOTALS = ("COUNT(*) AS calls, SUM(input_tokens) AS input_tokens, SUM(cached_input_tokens) AS cached_input_tokens, "
+           "SUM(output_tokens) AS output_tokens, SUM(thinking_tokens) AS thinking_tokens, SUM(cost) AS cost, "
+           "SUM(1 - success) AS failures, SUM(cache_hit) AS cache_hits")
+
+
+class CostLedger:
+    """Append only SQLite ledger of LLM calls with per batch budgets."""
+
+    def __init__(self,
+                 sqlite_path: Optional[str] = None,
+                 default_budget_usd: Optional[float] = None,
+                 downgrade_at: float = 0.8,
+                 pause_at: float = 1.0,
+                 flush_interval_seconds: float = 1.0,
+                 flush_rows: int = 500,
+                ):
+        """Initialize the ledger.
+
+        Args:
+            sqlite_path: Path of the database, None keeps the ledger in memory for the process
+            default_budget_usd: Budget of batches without their own, None leaves them unlimited
+            downgrade_at: Fraction of the budget spent after which calls go to the cheapest model
+            pause_at: Fraction of the budget spent after which no new submission is started
+            flush_interval_seconds: Buffered calls are written at least this often
+            flush_rows: Buffered calls written straight away once this many are waiting
+        """
+        self.default_budget_usd = default_budget_usd
+        self.downgrade_at = downgrade_at
+        self.pause_at = pause_at
+        self.flush_interval_seconds = flush_interval_seconds
+        self.flush_rows = flush_rows
+        self._lock = threading.Lock()
+        self._pending: List[tuple] = []
+        # running spend and budget of the batches this process has checked
+        self._spend: Dict[str, float] = {}
+        self._budgets: Dict[str, Optional[float]] = {}
+        self._flush_needed = threading.Event()
+        self.sqlite_path = sqlite_path
+        if sqlite_path:
+            Path(sqlite_path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(sqlite_path or ":memory:", check_same_thread=False)
+        if sqlite_path:
+            # several processes append to the same ledger
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS llm_calls (
+                ts REAL NOT NULL,
+                batch_id TEXT,
+                submission_id TEXT,
+                question_key TEXT,
+                node TEXT,
+                model TEXT,
+                input_tokens REAL NOT NULL,
+                cached_input_tokens REAL NOT NULL,
+                output_tokens REAL NOT NULL,
+                thinking_tokens REAL NOT NULL,
+                cost REAL NOT NULL,
+                success INTEGER NOT NULL,
+                cache_hit INTEGER NOT NULL
+            )""")
+        # the batch index covers the cost so the budget check never reads the table
+        self._db.execute("CREATE INDEX IF NOT EXISTS llm_calls_batch ON llm_calls(batch_id, cost)")
+        for column in ("question_key", "node", "model", "ts"):
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS llm_calls_{column} ON llm_calls({column})")
+        self._db.execute("CREATE TABLE IF NOT EXISTS budgets (batch_id TEXT PRIMARY KEY, budget_usd REAL)")
+        self._db.commit()
+        threading.Thread(target=self._writer, name="cost-ledger-writer", daemon=True).start()
+        atexit.register(self.flush)
+
+    def record(self, request: SubmitQueryRequest, node: str, response):
+        """Append one LLM call of a node to the ledger (buffered)."""
+        row = (time.time(), request.batch_id, request.submission_id, question_key(request), node,
+               getattr(response, "model", None),
+               response.input_tokens, getattr(response, "cached_input_tokens", 0),
+               response.output_tokens, getattr(response, "thinking_tokens", 0), response.cost,
+               int(bool(response.success)), int(bool(getattr(response, "cache_hit", False))))
+        with self._lock:
+            self._pending.append(row)
+            if request.batch_id in self._spend:
+                self._spend[request.batch_id] += response.cost
+            if len(self._pending) >= self.flush_rows:
+                self._flush_needed.set()
+
+    def flush(self):
+        """Write the buffered calls to the database."""
+        with self._lock:
+            if not self._pending:
+                return
+            self._db.executemany("INSERT INTO llm_calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self._pending)
+            self._db.commit()
+            self._pending = []
+
+    def _pending_cost(self, batch_id: str) -> float:
+        return sum(row[10] for row in self._pending if row[1] == batch_id)
+
+    def _refresh(self, reader: sqlite3.Connection):
+        """Re-read the spend and budget of the tracked batches, other processes may share them."""
+        with self._lock:
+            batches = list(self._spend)
+        for batch_id in batches:
+            spent = reader.execute("SELECT COALESCE(SUM(cost), 0) FROM llm_calls WHERE batch_id = ?", (batch_id,)).fetchone()[0]
+            row = reader.execute("SELECT budget_usd FROM budgets WHERE batch_id = ?", (batch_id,)).fetchone()
+            with self._lock:
+                self._spend[batch_id] = spent + self._pending_cost(batch_id)
+                self._budgets[batch_id] = row[0] if row is not None else self.default_budget_usd
+
+    def _writer(self):
+        # reads of the refresh use their own connection, recording calls never waits on them
+        reader = sqlite3.connect(self.sqlite_path) if self.sqlite_path else None
+        while True:
+            self._flush_needed.wait(self.flush_interval_seconds)
+            self._flush_needed.clear()
+            try:
+                self.flush()
+                if reader is not None:
+                    self._refresh(reader)
+            except Exception as e:
+                logger.error(f"Could not write the cost ledger: {str(e)}")
+
+    def _track(self, batch_id: str):
+        """Read the spend and budget of a batch the first time it is checked (lock held)."""
+        if batch_id in self._spend:
+            return
+        spent = self._db.execute("SELECT COALESCE(SUM(cost), 0) FROM llm_calls WHERE batch_id = ?", (batch_id,)).fetchone()[0]
+        row = self._db.execute("SELECT budget_usd FROM budgets WHERE batch_id = ?", (batch_id,)).fetchone()
+        self._spend[batch_id] = spent + self._pending_cost(batch_id)
+        self._budgets[batch_id] = row[0] if row is not None else self.default_budget_usd
+
+    def totals(self,
+               by: Iterable[str] = (),
+               batch_id: Optional[str] = None,
+               since: Optional[float] = None,
+               until: Optional[float] = None,
+              ) -> List[dict]:
+        """Return the call count, token and cost totals, one row per group.
+
+        Args:
+            by: Columns to group by, any of GROUP_COLUMNS, none for a single grand total
+            batch_id: Only count the calls of this batch
+            since: Only count calls made at or after this unix time
+            until: Only count calls made before this unix time
+        """
+        self.flush()
+        by = list(by)
+        unknown = set(by) - set(GROUP_COLUMNS)
+        if unknown:
+            raise ValueError(f"Cannot group the ledger by {sorted(unknown)}, use {GROUP_COLUMNS}")
+        conditions, params = [], []
+        for condition, value in (("batch_id = ?", batch_id), ("ts >= ?", since), ("ts < ?", until)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        query = f"SELECT {', '.join(by + [_TOTALS])} FROM llm_calls"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        if by:
+            query += f" GROUP BY {', '.join(by)} ORDER BY cost DESC"
+        with self._lock:
+            cursor = self._db.execute(query, params)
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        # a grand total over no calls comes back as one row of NULLs
+        return [row for row in rows if row["calls"]]
+
+    def spent(self, batch_id: str) -> float:
+        """Return the cost of all calls of a batch so far, buffered calls included."""
+        with self._lock:
+            self._track(batch_id)
+            return self._spend[batch_id]
+
+    def set_budget(self, batch_id: str, budget_usd: Optional[float]):
+        """Set the budget ceiling of a batch, None removes it."""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO budgets (batch_id, budget_usd) VALUES (?, ?)", (batch_id, budget_usd))
+            self._db.commit()
+            self._track(batch_id)
+            self._budgets[batch_id] = budget_usd
+
+    def budget(self, batch_id: str) -> Optional[float]:
+        """Return the budget ceiling of a batch, its own or the default."""
+        with self._lock:
+            self._track(batch_id)
+            return self._budgets[batch_id]
+
+    def budget_status(self, batch_id: Optional[str]) -> str:
+        """Return "ok", "downgrade" (route to the cheapest models) or "paused" for a batch."""
+        if batch_id is None:
+            return "ok"
+        with self._lock:
+            self._track(batch_id)
+            budget, spent = self._budgets[batch_id], self._spend[batch_id]
+        if budget is None:
+            return "ok"
+        if spent >= budget * self.pause_at:
+            return "paused"
+        if spent >= budget * self.downgrade_at:
+            return "downgrade"
+        return "ok"
+
+
+def ledger_enabled() -> bool:
+    return settings.get("ledger", {}).get("enabled", False)
+
+_ledger: Optional[CostLedger] = None
+_ledger_lock = threading.Lock()
+
+def get_ledger() -> CostLedger:
+    """Return the process wide ledger configured in config/settings.yaml."""
+    global _ledger
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                ledger_settings = settings.get("ledger", {})
+                _ledger = CostLedger(
+                    sqlite_path=ledger_settings.get("sqlite_path"),
+                    default_budget_usd=ledger_settings.get("batch_budget_usd"),
+                    downgrade_at=ledger_settings.get("downgrade_at", 0.8),
+                    pause_at=ledger_settings.get("pause_at", 1.0),
+                    flush_interval_seconds=ledger_settings.get("flush_interval_seconds", 1.0),
+                )
+    return _ledger
+
+def record_call(request: SubmitQueryRequest, node: str, response):
+    """Append a node's LLM call to the process wide ledger, a ledger failure never fails the grading."""
+    if not ledger_enabled():
+        return
+    try:
+        get_ledger().record(request, node, response)
+    except Exception as e:
+        logger.error(f"Could not record the {node} call in the cost ledger: {str(e)}")
+
+def should_downgrade(request: SubmitQueryRequest) -> bool:
+    """Return whether the calls of this submission should go to the cheapest model of their route."""
+    if not ledger_enabled() or request.batch_id is None:
+        return False
+    return get_ledger().budget_status(request.batch_id) != "ok"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cost and token totals from the ledger")
+    parser.add_argument("--by", nargs="*", default=[], choices=GROUP_COLUMNS, help="columns to group the totals by")
+    parser.add_argument("--batch", default=None, help="only count the calls of this batch")
+    parser.add_argument("--since", type=float, default=None, help="only count calls made in the last SINCE hours")
+    args = parser.parse_args(argv)
+
+    since = time.time() - args.since * 3600 if args.since is not None else None
+    for row in get_ledger().totals(by=args.by, batch_id=args.batch, since=since):
+        print(json.dumps(row))
+
+if __name__ == "__main__":
+    main()
@@ -5,24 +5,155 @@ from pathlib import Path
 graph_dir = Path(__file__).parent
 project_root = graph_dir.parent 
 
-from typing import Annotated, TypedDict, List, Dict, Any
-from config import system_prompts, format_user_prompt
+from typing import Annotated, TypedDict, List, Dict, Any, NamedTuple, Optional
+import asyncio
+import time
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from langgraph.config import get_stream_writer
+from config import system_prompts, format_user_prompt, format_user_prompt_parts, settings, validate_prompts
 
-from dotenv import load_dotenv
-load_dotenv()
-
-from src.llm import GeminiClient
+from src.llm import LLMClient
+from src.llm.images import load_images
+from src.llm.router import routed_client
+from .preprocessing import preprocess_images
+from .tracing import llm_span
+from .dedupe import dedupe_enabled, get_grade_store
+from .reconcile import reconcile, count_path
+from .ledger import record_call, should_downgrade
 
 from .datamodels import State, Feedback 
 from .datamodels import numeirical_response_structure, response_structure_textual, solution_pathway_classification
 
-from.datamodels import numeirical_response_structure_irrelevant, value_point_assesment
+from.datamodels import numeirical_response_structure_irrelevant, value_point_assesment, numerical_fused_response_structure
 import logging
 logger = logging.getLogger(__name__) 
 
+# prompts used by the nodes, checked against the YAML files at import time
+SYSTEM_PROMPTS_USED = [
+    "extraction_numerical_prompt", "extraction_textual_prompt", "extraction_textual_prompt_image",
+    "solution_pathway_analysis_numerical_prompt",
+    "content_analysis_textual_prompt", "content_analysis_standard_numerical_prompt",
+    "feedback_generation_numerical_prompt", "feedback_generation_textual_prompt",
+    "value_point_assesment_prompt", "fused_analysis_numerical_prompt",
+]
+USER_PROMPTS_USED = [
+    "extraction_numerical_prompt", "extraction_textual_prompt", "extraction_textual_prompt_image",
+    "solution_pathway_analysis_numerical_prompt",
+    "content_analysis_textual_prompt", "content_analysis_standard_numerical_prompt",
+    "content_analysis_irrelevant_numerical_prompt", "content_analysis_alternative_numerical_prompt",
+    "feedback_generation_standard_numerical_prompt", "feedback_generation_irrelevant_numerical_prompt",
+    "feedback_generation_alternative_numerical_prompt", "feedback_generation_textual_prompt",
+    "value_point_assesment_prompt", "fused_analysis_numerical_prompt",
+]
+validate_prompts(SYSTEM_PROMPTS_USED, USER_PROMPTS_USED)
 
-def extractor(state:State):
-    """ Extract the answers from image"""
+
+class LLMCall(NamedTuple):
+    """ LLM request prepared by a node"""
+    client: LLMClient
+    structured: bool
+    kwargs: dict
+    # state field whose text is streamed to the graph stream while it is generated
+    stream: Optional[str] = None
+    # node the call is recorded under in the cost ledger
+    node: Optional[str] = None
+
+def _stream_text(field: str):
+    """ Callback sending generated text of a state field to the custom graph stream"""
+    writer = get_stream_writer()
+    return lambda text: writer({"type": "partial", "field": field, "text": text})
+
+def with_progress(name: str, node):
+    """ Wrap a graph node so its start and end are sent to the custom graph stream"""
+    if asyncio.iscoroutinefunction(node):
+        @wraps(node)
+        async def async_wrapper(state):
+            writer = get_stream_writer()
+            writer({"type": "node", "node": name, "status": "started"})
+            update = await node(state)
+            writer({"type": "node", "node": name, "status": "finished"})
+            return update
+        return async_wrapper
+
+    @wraps(node)
+    def wrapper(state):
+        writer = get_stream_writer()
+        writer({"type": "node", "node": name, "status": "started"})
+        update = node(state)
+        writer({"type": "node", "node": name, "status": "finished"})
+        return update
+    return wrapper
+
+def _traced_update(state:State, call:LLMCall, update:dict, response, start_time:float):
+    """ Attach the span of the llm call to the node update when the run is traced"""
+    if not state.get("trace_context"):
+        return update
+    name = "generate_structured_response" if call.structured else "generate"
+    return {**update, "trace": [llm_span(state["trace_context"], name, response, start_time, time.time())]}
+
+def _run_node(state:State, build_call, handle_response):
+    """ Run a node : prepare the call, invoke the llm and turn the response into a state update"""
+    call = build_call(state)
+    if not isinstance(call, LLMCall):
+        return call
+    start_time = time.time()
+    if call.structured:
+        response = call.client.generate_structured_response(**call.kwargs)
+    elif call.stream:
+        response = call.client.generate_stream(on_text=_stream_text(call.stream), **call.kwargs)
+    else:
+        response = call.client.generate(**call.kwargs)
+    record_call(state['question'], call.node, response)
+    return _traced_update(state, call, handle_response(state, response), response, start_time)
+
+async def _arun_node(state:State, build_call, handle_response):
+    """ Async version of _run_node, the llm call is awaited"""
+    call = build_call(state)
+    if not isinstance(call, LLMCall):
+        return call
+    start_time = time.time()
+    if call.structured:
+        response = await call.client.agenerate_structured_response(**call.kwargs)
+    elif call.stream:
+        response = await call.client.agenerate_stream(on_text=_stream_text(call.stream), **call.kwargs)
+    else:
+        response = await call.client.agenerate(**call.kwargs)
+    record_call(state['question'], call.node, response)
+    return _traced_update(state, call, handle_response(state, response), response, start_time)
+
+
+def image_preprocessor(state:State):
+    """ Fetch the answer pages and shrink them before extraction"""
+    question = state['question']
+    preprocessing_settings = settings["image_preprocessing"]
+    if question.handwritten == False or not preprocessing_settings["enabled"]:
+        return {}
+    print(f"|| Preprocessing answer images ...||")
+    try:
+        images = load_images(question.answer_images())
+    except Exception as e:
+        logger.error(f"Image fetching failed: {str(e)}")
+        return {"success": False, "error_message": f"Image fetching failed: {str(e)}"}
+    answer_images, report = preprocess_images(
+        images,
+        max_long_side = preprocessing_settings["max_long_side"],
+        grayscale = preprocessing_settings["grayscale"],
+        contrast = preprocessing_settings["contrast"],
+        quality = preprocessing_settings["jpeg_quality"])
+    return {"answer_images": answer_images, "image_preprocessing": report}
+
+async def aimage_preprocessor(state:State):
+    """ Fetch the answer pages and shrink them before extraction (async)"""
+    # image work is cpu bound, keep it off the event loop
+    return await asyncio.to_thread(image_preprocessor, state)
+
+def _extractor_call(state:State):
+    """ Prepare the extractor llm call, or return the state update if the call is skipped"""
+    if state.get('success', True) == False:
+        # if fetching the images failed, we dont need to continue 
+        logger.error("Extraction skipped due to previous step failure.")
+        return {"student_answer_text": None}
     question = state['question']
     # if handwriten -> extract else skip 
     if question.handwritten == False:
@@ -40,14 +171,13 @@ def extractor(state:State):
         system_prompt_extraction = system_prompts["extraction_textual_prompt_image"]
         user_prompt_extraction = format_user_prompt("extraction_textual_prompt_image")
     
-    # Model Selection 
-    extractor_model = GeminiClient(model = "gemini-2.0-flash") #default model for text extraction
-    if question.type == 'image_answer':
-        # if the question is image answer, we use the gemini pro model
-        extractor_model = GeminiClient(model = "gemini-2.5-pro")
+    # Model Selection, image answers prefer the pro model (routes in config/models.yaml)
+    extractor_model = routed_client("extractor", question.type, downgrade=should_downgrade(question))
 
-    response = extractor_model.generate(system_prompt= system_prompt_extraction, user_prompt= user_prompt_extraction,  images= question.student_answer_image_urls)
+    return LLMCall(extractor_model, False, dict(system_prompt=system_prompt_extraction, user_prompt=user_prompt_extraction, images=state.get("answer_images") or question.answer_images()), node="extractor")
 
+def _extractor_update(state:State, response):
+    """ Convert the extractor llm response into a state update"""
     # Handle the error cases 
     if not response.success:
         logger.error(f"Extraction failed: {response.error_message}")
@@ -64,11 +194,122 @@ def extractor(state:State):
     return {"student_answer_text": response.content,
             "input_tokens": response.input_tokens, 
             "output_tokens": response.output_tokens,
+            "cached_input_tokens": response.cached_input_tokens,
             "cost": response.cost,
             "success": True}
 
-def solution_pathway_analyzer(state:State):
-    """Analyse the content from the students work, classify the solution """
+def _page_calls(state:State):
+    """ Split the extraction call into one call per page, None if per page extraction does not apply"""
+    if not settings["extraction"]["per_page"]:
+        return None
+    call = _extractor_call(state)
+    if not isinstance(call, LLMCall) or len(call.kwargs["images"]) < 2:
+        return None
+    return [LLMCall(call.client, False, {**call.kwargs, "images": [image]}, node=call.node) for image in call.kwargs["images"]]
+
+def _timed_generate(call:LLMCall, queued_time:float):
+    start_time = time.time()
+    response = call.client.generate(**call.kwargs)
+    return response, queued_time, start_time, time.time()
+
+async def _atimed_generate(call:LLMCall, queued_time:float):
+    start_time = time.time()
+    response = await call.client.agenerate(**call.kwargs)
+    return response, queued_time, start_time, time.time()
+
+def _merge_pages(state:State, results, attempts):
+    """ Merge the page transcriptions in page order and record the per page vitals"""
+    for response, *_ in results:
+        record_call(state['question'], "extractor", response)
+    page_extractions = [
+        {"page": page + 1,
+         "latency": end_time - start_time,
+         "input_tokens": response.input_tokens,
+         "output_tokens": response.output_tokens,
+         "cached_input_tokens": response.cached_input_tokens,
+         "cost": response.cost,
+         "attempts": attempts[page],
+         "success": response.success}
+        for page, (response, _, start_time, end_time) in enumerate(results)]
+    # the last attempt of each page is traced, queue time is the wait for a free worker
+    trace = [llm_span(state["trace_context"], f"generate page {page + 1}", response, start_time, end_time,
+                      queue_time=start_time - queued_time, retries=attempts[page] - 1)
+             for page, (response, queued_time, start_time, end_time) in enumerate(results)] if state.get("trace_context") else []
+    failed_pages = [page["page"] for page in page_extractions if not page["success"]]
+    if failed_pages:
+        error_message = results[failed_pages[0] - 1][0].error_message
+        logger.error(f"Extraction failed for pages {failed_pages}: {error_message}")
+        return {
+            "student_answer_text": None,
+            "page_extractions": page_extractions,
+            "trace": trace,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cost": 0.0,
+            "success": False,
+            "error_message": f"Extraction failed for pages {failed_pages}: {error_message}"
+        }
+    student_answer_text = "\n\n".join(
+        f"--- Page {page + 1} ---\n{response.content}" for page, (response, *_) in enumerate(results))
+    return {"student_answer_text": student_answer_text,
+            "page_extractions": page_extractions,
+            "trace": trace,
+            "input_tokens": sum(page["input_tokens"] for page in page_extractions),
+            "output_tokens": sum(page["output_tokens"] for page in page_extractions),
+            "cached_input_tokens": sum(page["cached_input_tokens"] for page in page_extractions),
+            "cost": sum(page["cost"] for page in page_extractions),
+            "success": True}
+
+def _extract_pages(state:State, calls):
+    """ Extract all pages concurrently, retrying only the pages that failed"""
+    results = [None] * len(calls)
+    attempts = [0] * len(calls)
+    pending = list(range(len(calls)))
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        for _ in range(settings["extraction"]["max_page_retries"] + 1):
+            queued_time = time.time()
+            for page, result in zip(pending, executor.map(_timed_generate, [calls[page] for page in pending], [queued_time] * len(pending))):
+                results[page] = result
+                attempts[page] += 1
+            pending = [page for page in pending if not results[page][0].success]
+            if not pending:
+                break
+    return _merge_pages(state, results, attempts)
+
+async def _aextract_pages(state:State, calls):
+    """ Async version of _extract_pages"""
+    results = [None] * len(calls)
+    attempts = [0] * len(calls)
+    pending = list(range(len(calls)))
+    for _ in range(settings["extraction"]["max_page_retries"] + 1):
+        queued_time = time.time()
+        outcomes = await asyncio.gather(*(_atimed_generate(calls[page], queued_time) for page in pending))
+        for page, result in zip(pending, outcomes):
+            results[page] = result
+            attempts[page] += 1
+        pending = [page for page in pending if not results[page][0].success]
+        if not pending:
+            break
+    return _merge_pages(state, results, attempts)
+
+def extractor(state:State):
+    """ Extract the answers from image"""
+    calls = _page_calls(state)
+    if calls:
+        print(f"|| Extracting {len(calls)} pages in parallel ...||")
+        return _extract_pages(state, calls)
+    return _run_node(state, _extractor_call, _extractor_update)
+
+async def aextractor(state:State):
+    """ Extract the answers from image (async)"""
+    calls = _page_calls(state)
+    if calls:
+        print(f"|| Extracting {len(calls)} pages in parallel ...||")
+        return await _aextract_pages(state, calls)
+    return await _arun_node(state, _extractor_call, _extractor_update)
+
+def _solution_pathway_analyzer_call(state:State):
+    """ Prepare the solution_pathway_analyzer llm call, or return the state update if the call is skipped"""
     if state['success'] == False:
         # if the previous step failed, we can skip this step
         logger.error("Solution Pathway Analysis skipped due to previous step failure.")
@@ -98,7 +339,7 @@ def solution_pathway_analyzer(state:State):
         student_answer_text = question.student_answer_typed
     
     # format user prompt 
-    user_prompt_solution_pathway_analysis = format_user_prompt(
+    prompt_prefix_solution_pathway_analysis, user_prompt_solution_pathway_analysis = format_user_prompt_parts(
         "solution_pathway_analysis_numerical_prompt",
         grade_level = question.grade,
         subject = question.subject,
@@ -107,9 +348,11 @@ def solution_pathway_analyzer(state:State):
         steps_description = question.rubrics_for_extraction,
         student_answer = student_answer_text,
     )
-    solution_pathway_analysis_model = GeminiClient(model = "gemini-2.0-flash")
-    response = solution_pathway_analysis_model.generate_structured_response(system_prompt= system_prompt_solution_pathway_analysis,user_prompt= user_prompt_solution_pathway_analysis, structure= solution_pathway_classification)
-    
+    solution_pathway_analysis_model = routed_client("solution_pathway_analyzer", downgrade=should_downgrade(question))
+    return LLMCall(solution_pathway_analysis_model, True, dict(system_prompt=system_prompt_solution_pathway_analysis, user_prompt=user_prompt_solution_pathway_analysis, prompt_prefix=prompt_prefix_solution_pathway_analysis, structure=solution_pathway_classification), node="solution_pathway_analyzer")
+
+def _solution_pathway_analyzer_update(state:State, response):
+    """ Convert the solution_pathway_analyzer llm response into a state update"""
     # Handle the error cases 
     if not response.success:
         logger.error(f"Solution Pathway Analysis failed: {response.error_message}")
@@ -121,22 +364,32 @@ def solution_pathway_analyzer(state:State):
             "error_message": f"Solution Pathway Analysis failed: {response.error_message}"
         }
     
-    # update the cost vitals 
-    input_tokens = state.get("input_tokens", 0) + response.input_tokens
-    output_tokens = state.get("output_tokens", 0) + response.output_tokens
-    cost = state.get("cost", 0)+ response.cost
+    # cost vitals of this call, totals are summed by the state reducers
+    input_tokens = response.input_tokens
+    output_tokens = response.output_tokens
+    cached_input_tokens = response.cached_input_tokens
+    cost = response.cost
 
     return {
         "solution_pathway": response.structure["solution_pathway"],
         "reason_for_classification": response.structure["reason_for_classification"],
         "input_tokens": input_tokens,  
         "output_tokens": output_tokens,
+        "cached_input_tokens": cached_input_tokens,
         "cost": cost,
         "success": True
     }
 
-def content_analyzer(state:State):
-    """Analyse the content from the students work, output natural lanaguage response """
+def solution_pathway_analyzer(state:State):
+    """Analyse the content from the students work, classify the solution """
+    return _run_node(state, _solution_pathway_analyzer_call, _solution_pathway_analyzer_update)
+
+async def asolution_pathway_analyzer(state:State):
+    """Analyse the content from the students work, classify the solution  (async)"""
+    return await _arun_node(state, _solution_pathway_analyzer_call, _solution_pathway_analyzer_update)
+
+def _content_analyzer_call(state:State):
+    """ Prepare the content_analyzer llm call, or return the state update if the call is skipped"""
     
     if state['success'] == False:
         # if the previous step failed, we dont need to continue 
@@ -166,7 +419,7 @@ def content_analyzer(state:State):
         student_answer_text = question.student_answer_typed
     
     if question.type == 'textual_answer' or question.type == 'image_answer':
-        user_prompt_content_analysis = format_user_prompt(
+        prompt_prefix_content_analysis, user_prompt_content_analysis = format_user_prompt_parts(
             "content_analysis_textual_prompt",
             grade_level = question.grade,
             subject = question.subject,
@@ -179,7 +432,7 @@ def content_analyzer(state:State):
     # if question is numerical problem, we need to classify based solution pathway
     else: 
         if state["solution_pathway"] == "standard_approach":
-            user_prompt_content_analysis = format_user_prompt(
+            prompt_prefix_content_analysis, user_prompt_content_analysis = format_user_prompt_parts(
                 "content_analysis_standard_numerical_prompt",
                 grade_level = question.grade,
                 subject = question.subject,
@@ -191,7 +444,7 @@ def content_analyzer(state:State):
                 reason_for_classification = state["reason_for_classification"]
             )
         elif state["solution_pathway"] == "irrelevant_approach": 
-            user_prompt_content_analysis = format_user_prompt(
+            prompt_prefix_content_analysis, user_prompt_content_analysis = format_user_prompt_parts(
                 "content_analysis_irrelevant_numerical_prompt",
                 grade_level = question.grade,
                 subject = question.subject,
@@ -203,7 +456,7 @@ def content_analyzer(state:State):
                 reason_for_classification = state["reason_for_classification"]
             )
         elif state["solution_pathway"] == "acceptable_alternative_approach": 
-            user_prompt_content_analysis = format_user_prompt(
+            prompt_prefix_content_analysis, user_prompt_content_analysis = format_user_prompt_parts(
                 "content_analysis_alternative_numerical_prompt",
                 grade_level = question.grade,
                 subject = question.subject,
@@ -215,19 +468,14 @@ def content_analyzer(state:State):
                 reason_for_classification = state["reason_for_classification"]
             )
     
-    # chose the model based on complexity 
-    if question.complexity == "basic":
-        content_analysis_model = GeminiClient(model = "gemini-2.0-flash")
-    elif question.complexity == "moderate":
-        content_analysis_model = GeminiClient(model = "gemini-2.5-flash")
-    elif question.complexity == "advanced":
-        content_analysis_model = GeminiClient(model = "gemini-2.5-pro")
-    
-    # upgrade the model if its acceptable_alternative_approach
-    if state['solution_pathway'] == "acceptable_alternative_approach":
-        content_analysis_model = GeminiClient(model = "gemini-2.5-flash")
+    # chose the model based on the solution pathway, then the complexity (routes in config/models.yaml)
+    content_analysis_model = routed_client("content_analyzer", state['solution_pathway'], question.complexity, downgrade=should_downgrade(question))
+
+    # the analysis is the longest text of the run, it is streamed so progress shows while it is written
+    return LLMCall(content_analysis_model, False, dict(system_prompt=system_prompt_content_analysis, user_prompt=user_prompt_content_analysis, prompt_prefix=prompt_prefix_content_analysis), stream="content_analysis", node="content_analyzer")
 
-    response = content_analysis_model.generate(system_prompt= system_prompt_content_analysis,user_prompt= user_prompt_content_analysis)
+def _content_analyzer_update(state:State, response):
+    """ Convert the content_analyzer llm response into a state update"""
     print( f"Content analysis model: {response.model}")
     # Handle the error cases 
     if not response.success:
@@ -239,21 +487,31 @@ def content_analyzer(state:State):
             "error_message": f"Content Analysis failed: {response.error_message}"
         }
     
-    # update the cost vitals 
-    input_tokens = state.get("input_tokens", 0) + response.input_tokens
-    output_tokens = state.get("output_tokens", 0) + response.output_tokens
-    cost = state.get("cost", 0)+ response.cost
+    # cost vitals of this call, totals are summed by the state reducers
+    input_tokens = response.input_tokens
+    output_tokens = response.output_tokens
+    cached_input_tokens = response.cached_input_tokens
+    cost = response.cost
 
     return {
         "content_analysis": response.content,
         "input_tokens": input_tokens, 
         "output_tokens": output_tokens,
+        "cached_input_tokens": cached_input_tokens,
         "cost": cost,
         "success": True
     }
 
-def feedback_generator(state:State):
-    """Grades the student and provides feedback"""
+def content_analyzer(state:State):
+    """Analyse the content from the students work, output natural lanaguage response """
+    return _run_node(state, _content_analyzer_call, _content_analyzer_update)
+
+async def acontent_analyzer(state:State):
+    """Analyse the content from the students work, output natural lanaguage response  (async)"""
+    return await _arun_node(state, _content_analyzer_call, _content_analyzer_update)
+
+def _feedback_generator_call(state:State):
+    """ Prepare the feedback_generator llm call, or return the state update if the call is skipped"""
     if state.get('success', False) == False:
         # if the previous step failed, we dont need to continue 
         logger.error("Feedback Generation skipped due to previous step failure.")
@@ -279,7 +537,7 @@ def feedback_generator(state:State):
     # if question is numerical problem, we need to classify based solution pathway
     if question.type == "numerical_problem":
         if state["solution_pathway"] =="standard_approach":
-            user_prompt_feedback_generation = format_user_prompt(
+            prompt_prefix_feedback_generation, user_prompt_feedback_generation = format_user_prompt_parts(
                 "feedback_generation_standard_numerical_prompt",
                 question = question_text,
                 max_marks = question.max_marks,
@@ -289,7 +547,7 @@ def feedback_generator(state:State):
                 content_analysis_output = state["content_analysis"])
             response_structure = numeirical_response_structure
         elif state["solution_pathway"] == "irrelevant_approach":
-            user_prompt_feedback_generation = format_user_prompt(
+            prompt_prefix_feedback_generation, user_prompt_feedback_generation = format_user_prompt_parts(
                 "feedback_generation_irrelevant_numerical_prompt",
                 question = question_text,
                 max_marks = question.max_marks,
@@ -300,7 +558,7 @@ def feedback_generator(state:State):
                 reason_for_classification = state["reason_for_classification"])
             response_structure = numeirical_response_structure_irrelevant
         elif state["solution_pathway"] == "acceptable_alternative_approach":
-            user_prompt_feedback_generation = format_user_prompt(
+            prompt_prefix_feedback_generation, user_prompt_feedback_generation = format_user_prompt_parts(
                 "feedback_generation_alternative_numerical_prompt",
                 question = question_text,
                 max_marks = question.max_marks,
@@ -311,7 +569,7 @@ def feedback_generator(state:State):
             response_structure = numeirical_response_structure
         
     elif question.type == 'textual_answer' or question.type == 'image_answer':
-        user_prompt_feedback_generation = format_user_prompt(
+        prompt_prefix_feedback_generation, user_prompt_feedback_generation = format_user_prompt_parts(
             "feedback_generation_textual_prompt",
             question = question_text,
             max_marks = question.max_marks,
@@ -321,20 +579,13 @@ def feedback_generator(state:State):
             content_analysis_output = state["content_analysis"],)
         response_structure = response_structure_textual
     
-    # choose the model based on complexity 
-    if question.complexity == "basic":
-        feedback_generation_model = GeminiClient(model = "gemini-2.0-flash")
-    elif question.complexity == "moderate":
-        feedback_generation_model = GeminiClient(model = "gemini-2.5-flash")
-    elif question.complexity == "advanced":
-        feedback_generation_model = GeminiClient(model = "gemini-2.5-pro")
-    
-    # upgrade the model if its acceptable_alternative_approach
-    if state['solution_pathway'] == "acceptable_alternative_approach":
-        feedback_generation_model = GeminiClient(model = "gemini-2.5-flash")
+    # choose the model based on the solution pathway, then the complexity (routes in config/models.yaml)
+    feedback_generation_model = routed_client("feedback_generator", state['solution_pathway'], question.complexity, downgrade=should_downgrade(question))
 
-    response = feedback_generation_model.generate_structured_response(system_prompt= system_prompt_feedback_generation, user_prompt= user_prompt_feedback_generation, structure= response_structure)
-    
+    return LLMCall(feedback_generation_model, True, dict(system_prompt=system_prompt_feedback_generation, user_prompt=user_prompt_feedback_generation, prompt_prefix=prompt_prefix_feedback_generation, structure=response_structure), node="feedback_generator")
+
+def _feedback_generator_update(state:State, response):
+    """ Convert the feedback_generator llm response into a state update"""
     print( f"Feedback generation model: {response.model}")
     # Handle the error cases 
     if not response.success:
@@ -347,10 +598,11 @@ def feedback_generator(state:State):
             "error_message": f"Feedback Generation failed: {response.error_message}"
         }
     
-    # update the cost vitals 
-    input_tokens = state.get("input_tokens", 0) + response.input_tokens
-    output_tokens = state.get("output_tokens", 0) + response.output_tokens
-    cost = state.get("cost", 0)+ response.cost
+    # cost vitals of this call, totals are summed by the state reducers
+    input_tokens = response.input_tokens
+    output_tokens = response.output_tokens
+    cached_input_tokens = response.cached_input_tokens
+    cost = response.cost
 
     # update the criteria list
     creterias = response.structure["criteria"]
@@ -364,10 +616,105 @@ def feedback_generator(state:State):
         "mark": response.structure["mark"],
         "input_tokens": input_tokens, 
         "output_tokens": output_tokens,
+        "cached_input_tokens": cached_input_tokens,
         "success": True,
         "cost": cost
     } 
 
+def feedback_generator(state:State):
+    """Grades the student and provides feedback"""
+    return _run_node(state, _feedback_generator_call, _feedback_generator_update)
+
+async def afeedback_generator(state:State):
+    """Grades the student and provides feedback (async)"""
+    return await _arun_node(state, _feedback_generator_call, _feedback_generator_update)
+
+def grading_path(state:State):
+    """ Choose between the fused single call and the three call analysis of a submission"""
+    question = state['question']
+    complexities = settings.get("fused_analysis", {}).get("complexities", ["basic"])
+    if question.type == "numerical_problem" and question.complexity in complexities:
+        return "fused"
+    return "three_call"
+
+def _fused_analyzer_call(state:State):
+    """ Prepare the fused_analyzer llm call, or return the state update if the call is skipped"""
+    if state['success'] == False:
+        # if the previous step failed, we dont need to continue 
+        logger.error("Fused analysis skipped due to previous step failure.")
+        return {"solution_pathway": None, "reason_for_classification": None, "content_analysis": None, "feedback": None, "mark": None}
+    print(f"|| Classifying, analysing and grading in one call ...||")
+    question = state['question']
+    system_prompt_fused_analysis = system_prompts["fused_analysis_numerical_prompt"]
+    # if question contain figure 
+    if question.question_contains_figure:
+        question_text = f"""
+        {question.question}
+        Question also conatin an figure/image which can be described as follows.
+        {question.image_description_for_question}"""
+    else: 
+        question_text = question.question
+
+    # student answer contains image
+    if question.handwritten:
+        student_answer_text  = f"""
+        Here is the extracted content from the students handwritten work,
+        {state["student_answer_text"]}"""
+    else:
+        student_answer_text = question.student_answer_typed
+
+    prompt_prefix_fused_analysis, user_prompt_fused_analysis = format_user_prompt_parts(
+        "fused_analysis_numerical_prompt",
+        grade_level = question.grade,
+        subject = question.subject,
+        chapter = question.chapter,
+        question = question_text,
+        steps_description = question.rubrics_for_extraction,
+        sample_solution_with_steps = question.rubrics_for_evaluation,
+        max_marks = question.max_marks,
+        student_answer = student_answer_text,
+    )
+    fused_analysis_model = routed_client("fused_analyzer", question.complexity, downgrade=should_downgrade(question))
+    return LLMCall(fused_analysis_model, True, dict(system_prompt=system_prompt_fused_analysis, user_prompt=user_prompt_fused_analysis, prompt_prefix=prompt_prefix_fused_analysis, structure=numerical_fused_response_structure), node="fused_analyzer")
+
+def _fused_analyzer_update(state:State, response):
+    """ Convert the fused_analyzer llm response into the state update of the three nodes it replaces"""
+    print( f"Fused analysis model: {response.model}")
+    if not response.success:
+        logger.error(f"Fused analysis failed: {response.error_message}")
+        return {
+            "solution_pathway": None,
+            "reason_for_classification": None,
+            "content_analysis": None,
+            "feedback": None,
+            "mark": None,
+            "success": False,
+            "error_message": f"Fused analysis failed: {response.error_message}"
+        }
+
+    creterias = response.structure["criteria"]
+    creterias.append(["Total"] + response.structure["total_points"])
+    return {
+        "solution_pathway": response.structure["solution_pathway"],
+        "reason_for_classification": response.structure["reason_for_classification"],
+        "content_analysis": response.structure["content_analysis"],
+        "feedback": Feedback(criteria = creterias),
+        "mark": response.structure["mark"],
+        "input_tokens": response.input_tokens,
+        "output_tokens": response.output_tokens,
+        "cached_input_tokens": response.cached_input_tokens,
+        "cost": response.cost,
+        "success": True
+    }
+
+def fused_analyzer(state:State):
+    """Classify the solution pathway, analyse and grade a basic numerical answer in one call"""
+    return _run_node(state, _fused_analyzer_call, _fused_analyzer_update)
+
+async def afused_analyzer(state:State):
+    """Classify the solution pathway, analyse and grade a basic numerical answer in one call (async)"""
+    return await _arun_node(state, _fused_analyzer_call, _fused_analyzer_update)
+
 def mark_validation(state:State):
     """ Validate the mark give by the feedback generator"""
     if state.get('success', False) == False:
@@ -377,12 +724,58 @@ def mark_validation(state:State):
             "validation": True}
     question = state['question']
     print(f"|| Validating marks and checks for rerun ...||")
+    reconciliation_settings = settings.get("mark_reconciliation", {})
+    if reconciliation_settings.get("enabled", False):
+        # re-derive the mark from the per criteria awards, the feedback is only regenerated when that fails
+        result = reconcile(state['feedback'].criteria, state['mark'], question.max_marks,
+                           max_overshoot=reconciliation_settings.get("max_overshoot", 0.5))
+        if result.outcome == "reconciled":
+            count_path("reconciled")
+            logger.warning(f"Mark reconciled without re-running feedback generation: {result.reason}")
+            return {"validation": True, "mark": result.mark, "feedback": Feedback(criteria = result.criteria)}
+        if result.outcome == "consistent":
+            count_path("consistent")
+            return {"validation": True}
+        logger.warning(f"Mark reconciliation failed: {result.reason}")
     if state['mark'] > question.max_marks:
         retry_attempt = state.get("retry_attempt", 0) + 1
         logger.error(f"Mark {state['mark']} exceeds the maximum allowed {question.max_marks}.")
+        # the feedback generator is re-run once, a second failure is left as is
+        count_path("llm_rerun" if retry_attempt == 1 else "unresolved")
         return {"retry_attempt": retry_attempt, "validation": False }
+    count_path("unresolved" if reconciliation_settings.get("enabled", False) else "consistent")
     return {"validation": True}
 
+# state keys making up a grade, reused as is for duplicate answers
+GRADE_FIELDS = ("solution_pathway", "reason_for_classification", "content_analysis", "feedback", "value_points", "mark")
+
+def dedupe(state:State):
+    """ Reuse the grade of an earlier exact or near duplicate answer to the same question"""
+    if state.get('success') == False or not state.get("student_answer_text"):
+        return {"duplicate": None}
+    match = get_grade_store().find(state['question'], state["student_answer_text"])
+    if match is None:
+        return {"duplicate": None}
+    print(f"|| {match.kind.capitalize()} duplicate of submission {match.submission_id}, reusing its grade ||")
+    grade = dict(match.grade)
+    grade["feedback"] = Feedback(**grade["feedback"]) if grade.get("feedback") else None
+    # nothing is spent on a reused grade, the state totals only hold the extraction
+    return {**grade, "validation": True, "duplicate": match.kind, "duplicate_of": match.submission_id}
+
+def dedupe_checker(state:State):
+    """ Skip the grading chain when a duplicate grade was reused"""
+    return "reuse" if state.get("duplicate") else "grade"
+
+def join_results(state:State):
+    """ Join point of the parallel feedback and value point branches"""
+    print(f"|| Grading complete ||")
+    # remember successful, validated grades so later duplicates of the answer can reuse them
+    if dedupe_enabled() and not state.get("duplicate") and state.get("success") and state.get("validation", True):
+        grade = {field: state.get(field) for field in GRADE_FIELDS}
+        grade["feedback"] = grade["feedback"].model_dump() if grade["feedback"] else None
+        get_grade_store().add(state['question'], state["student_answer_text"], grade)
+    return {}
+
 def rerun_checker(state:State):
     """ Checks if the validation failed and requires re-run"""
     # case 1 - pass with no errors
@@ -398,8 +791,8 @@ def rerun_checker(state:State):
         print("|| Validation Failed, re-run allowed ||")
         return "rerun"
 
-def value_point_analyzer(state:State):
-    """Analyse the value point in the student's answer"""
+def _value_point_analyzer_call(state:State):
+    """ Prepare the value_point_analyzer llm call, or return the state update if the call is skipped"""
     if state['success'] == False:
         # if the previous step failed, we dont need to continue 
         logger.error("Value Point Analysis skipped due to previous step failure.")
@@ -422,7 +815,7 @@ def value_point_analyzer(state:State):
         question_text = question.question
 
     #format user_prompt
-    user_prompt_value_point_assesment = format_user_prompt(
+    prompt_prefix_value_point_assesment, user_prompt_value_point_assesment = format_user_prompt_parts(
         "value_point_assesment_prompt",
         question = question_text,
         max_marks = question.max_marks,
@@ -432,9 +825,12 @@ def value_point_analyzer(state:State):
         content_analysis_output = state["content_analysis"])
     
     response_structure = value_point_assesment
-    value_point_assesment_model = GeminiClient(model = "gemini-2.0-flash")   
+    value_point_assesment_model = routed_client("value_point_analyzer", downgrade=should_downgrade(question))
 
-    response = value_point_assesment_model.generate_structured_response(system_prompt= system_prompt_value_point_assesment, user_prompt= user_prompt_value_point_assesment, structure= response_structure)
+    return LLMCall(value_point_assesment_model, True, dict(system_prompt=system_prompt_value_point_assesment, user_prompt=user_prompt_value_point_assesment, prompt_prefix=prompt_prefix_value_point_assesment, structure=response_structure), node="value_point_analyzer")
+
+def _value_point_analyzer_update(state:State, response):
+    """ Convert the value_point_analyzer llm response into a state update"""
     # Handle the error cases 
     if not response.success:
         logger.error(f"Value point analysis failed: {response.error_message}")
@@ -446,18 +842,25 @@ def value_point_analyzer(state:State):
             "error_message": f"Value point analysis failed: {response.error_message}"
         }
 
-    # update the cost vitals 
-    input_tokens = state.get("input_tokens", 0) + response.input_tokens
-    output_tokens = state.get("output_tokens", 0) + response.output_tokens
-    cost = state.get("cost", 0.0)+ response.cost
+    # cost vitals of this call, totals are summed by the state reducers
+    input_tokens = response.input_tokens
+    output_tokens = response.output_tokens
+    cached_input_tokens = response.cached_input_tokens
+    cost = response.cost
 
     return {
         "value_points": response.structure,
         "input_tokens": input_tokens, 
         "output_tokens": output_tokens,
+        "cached_input_tokens": cached_input_tokens,
         "cost": cost,
-        "sucess": True
-    } 
+        "success": True
+    }
 
-    
-    
+def value_point_analyzer(state:State):
+    """Analyse the value point in the student's answer"""
+    return _run_node(state, _value_point_analyzer_call, _value_point_analyzer_update)
+
+async def avalue_point_analyzer(state:State):
+    """Analyse the value point in the student's answer (async)"""
+    return await _arun_node(state, _value_point_analyzer_call, _value_point_analyzer_update)
@@ -0,0 +1,113 @@
+"""
+Image preprocessing before extraction.
+
+Phone photos of handwritten answers are often several MB and 4000px+ on the long side.
+Each page is rotated upright from its EXIF orientation, downscaled, optionally converted
+to grayscale with raised contrast, and re-encoded as JPEG, which cuts both the payload
+and the vision tokens billed for the page.
+"""
+import io
+import logging
+import math
+from typing import List, Tuple
+
+from PIL import Image, ImageOps, ImageEnhance
+
+from src.llm.images import detect_mime_type
+
+logger = logging.getLogger(__name__)
+
+# Gemini bills an image as 258 tokens per 768x768 tile, small images are a single tile
+TOKENS_PER_TILE = 258
+TILE_SIZE = 768
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """ Estimate the vision tokens of an image from its size"""
+    if width <= 384 and height <= 384:
+        return TOKENS_PER_TILE
+    return math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE) * TOKENS_PER_TILE
+
+def preprocess_image(data: bytes,
+                     max_long_side: int = 2048,
+                     grayscale: bool = False,
+                     contrast: float = 1.0,
+                     quality: int = 85) -> Tuple[bytes, dict]:
+    """ Preprocess one page.
+
+    Args:
+        data: original image bytes
+        max_long_side: longest side in pixels after downscaling
+        grayscale: convert the page to grayscale
+        contrast: contrast factor, values above 1 raise the contrast
+        quality: JPEG quality of the re-encoded page
+
+    Returns:
+        processed bytes and a report of the sizes and estimated tokens before and after
+    """
+    image = Image.open(io.BytesIO(data))
+    original_size = image.size
+    report = {
+        "mime_type": detect_mime_type(data),
+        "original_bytes": len(data),
+        "original_tokens": estimate_image_tokens(*original_size),
+    }
+    # rotate the page upright according to its EXIF orientation
+    changed = image.getexif().get(0x0112, 1) != 1
+    image = ImageOps.exif_transpose(image)
+    if max(image.size) > max_long_side:
+        image.thumbnail((max_long_side, max_long_side), Image.LANCZOS)
+        changed = True
+    if grayscale:
+        image = ImageOps.grayscale(image)
+        changed = True
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    if contrast != 1.0:
+        image = ImageEnhance.Contrast(image).enhance(contrast)
+        changed = True
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    processed = buffer.getvalue()
+    # an untouched page that does not shrink when re-encoded is kept as it was
+    if not changed and len(processed) >= len(data):
+        processed = data
+        report["processed_mime_type"] = report["mime_type"]
+    else:
+        report["processed_mime_type"] = "image/jpeg"
+    report.update({
+        "processed_bytes": len(processed),
+        "processed_tokens": estimate_image_tokens(*image.size),
+    })
+    return processed, report
+
+def preprocess_images(images: List[bytes], **options) -> Tuple[List[bytes], dict]:
+    """ Preprocess all pages of an answer and summarise the savings for the request.
+
+    Pages that cannot be decoded are passed through unchanged.
+    """
+    processed_images = []
+    pages = []
+    for data in images:
+        try:
+            processed, report = preprocess_image(data, **options)
+        except Exception as e:
+            logger.error(f"Image preprocessing failed, using the original page: {str(e)}")
+            processed = data
+            mime_type = detect_mime_type(data)
+            report = {"mime_type": mime_type, "original_bytes": len(data), "original_tokens": None,
+                      "processed_mime_type": mime_type, "processed_bytes": len(data), "processed_tokens": None}
+        processed_images.append(processed)
+        pages.append(report)
+
+    original_bytes = sum(page["original_bytes"] for page in pages)
+    processed_bytes = sum(page["processed_bytes"] for page in pages)
+    original_tokens = sum(page["original_tokens"] or 0 for page in pages)
+    processed_tokens = sum(page["processed_tokens"] or 0 for page in pages)
+    summary = {
+        "pages": pages,
+        "bytes_saved": original_bytes - processed_bytes,
+        "estimated_tokens_saved": original_tokens - processed_tokens,
+    }
+    return processed_images, summary
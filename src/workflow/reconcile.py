@@ -0,0 +1,90 @@
+"""
+Deterministic reconciliation of the marks returned by the feedback generator.
+
+Every criteria row carries its award, usually with the maximum of the step ("1/1",
+"0.5 / 1", or "0.5" for partial credit criteria), and the last row holds the total
+("Total", "1.5/2", overall feedback). Instead of asking the model again when the mark is
+above the maximum of the question or disagrees with its own rows, the awards are parsed,
+capped to their step maxima, re-summed and capped to the maximum marks, and the total
+row is rewritten. The feedback is only regenerated when the rows cannot be parsed or
+overshoot the maximum marks by more than the configured tolerance.
+"""
+import logging
+import math
+import re
+import threading
+from typing import List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_AWARD = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*(?:/\s*(\d+(?:\.\d+)?))?")
+
+
+class Reconciliation(NamedTuple):
+    # "consistent" (nothing changed), "reconciled" (fixed locally) or "unresolved"
+    outcome: str
+    mark: Optional[float] = None
+    criteria: Optional[List[List[str]]] = None
+    reason: Optional[str] = None
+
+
+def parse_award(text: str) -> Optional[Tuple[float, Optional[float]]]:
+    """ Parse "awarded/maximum" (or a bare award) from a criteria cell, None if it holds no number"""
+    match = _AWARD.match(str(text))
+    if match is None:
+        return None
+    return float(match.group(1)), float(match.group(2)) if match.group(2) else None
+
+def format_marks(value: float) -> str:
+    """ 1.0 -> "1", 1.5 -> "1.5" """
+    return f"{value:g}"
+
+def reconcile(criteria: List[List[str]], mark: Optional[float], max_marks: float, max_overshoot: float = 0.5) -> Reconciliation:
+    """ Re-derive the mark from the per criteria awards and repair the total row.
+
+    Args:
+        criteria: Feedback criteria rows, the last one being the ["Total", "x/y", feedback] row
+        mark: Mark returned by the model
+        max_marks: Maximum marks of the question
+        max_overshoot: Awards summing above max_marks * (1 + max_overshoot) are not clamped, the grading is redone
+    """
+    if not criteria:
+        return Reconciliation("unresolved", reason="no criteria")
+    rows, total_row = [list(row) for row in criteria[:-1]], list(criteria[-1])
+    # partial credit feedback without any criteria awards nothing
+    rows_total = 0.0
+    for row in rows:
+        award = parse_award(row[1]) if len(row) > 1 else None
+        if award is None:
+            return Reconciliation("unresolved", reason=f"unparseable award in {row}")
+        awarded, maximum = award
+        if maximum is not None and awarded > maximum:
+            awarded = maximum
+            row[1] = f"{format_marks(awarded)}/{format_marks(maximum)}"
+        rows_total += awarded
+    if rows_total > max_marks * (1 + max_overshoot):
+        return Reconciliation("unresolved", reason=f"awards sum to {format_marks(rows_total)} for {format_marks(max_marks)} marks")
+    # marks are awarded in 0.5 steps
+    reconciled_mark = math.floor(min(rows_total, max_marks) * 2) / 2
+    # the total row is only rewritten when it disagrees, not for formatting ("1.5/2.0")
+    if len(total_row) > 1 and parse_award(total_row[1]) != (reconciled_mark, float(max_marks)):
+        total_row[1] = f"{format_marks(reconciled_mark)}/{format_marks(max_marks)}"
+    reconciled = rows + [total_row]
+    if reconciled_mark == mark and reconciled == [list(row) for row in criteria]:
+        return Reconciliation("consistent", mark, reconciled)
+    return Reconciliation("reconciled", reconciled_mark, reconciled,
+                          reason=f"mark {mark} -> {format_marks(reconciled_mark)} of {format_marks(max_marks)}")
+
+
+# how often each path of the mark validation is taken, in this process
+_counters = {"consistent": 0, "reconciled": 0, "llm_rerun": 0, "unresolved": 0}
+_counters_lock = threading.Lock()
+
+def count_path(path: str):
+    with _counters_lock:
+        _counters[path] += 1
+
+def reconciliation_stats() -> dict:
+    """Return how many validations were consistent, reconciled locally, re-run or left unresolved."""
+    with _counters_lock:
+        return dict(_counters)
@@ -0,0 +1,335 @@
+"""
+HTTP grading service : submit, status and result endpoints over an in-process job queue.
+
+    uvicorn src.workflow.service:app --port 8000
+    python -m src.workflow.service --port 8000
+
+Endpoints:
+    POST /v1/submissions                   SubmitQueryRequest JSON -> 202 {"request_id", "status", ...}
+    GET  /v1/submissions/{request_id}         job status (queued, running, done, failed)
+    GET  /v1/submissions/{request_id}/result  QueryRepsonse JSON once finished, 202 while pending
+                                              (?wait=SECONDS holds the request until the job finishes)
+    GET  /v1/health                           queue depth, workers and job counts
+
+Submissions wait in a bounded queue graded by a fixed number of worker tasks, a full queue
+answers 429 with a Retry-After header. Every job has a request id, taken from the
+X-Request-ID header when the caller sends one (submitting the same id again returns the
+existing job) and echoed on every response. The app is a plain ASGI callable, any ASGI
+server runs it; the queue lives in the process, run a single server process per queue.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import re
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+
+from pydantic import ValidationError
+
+from config import settings
+from .datamodels import SubmitQueryRequest
+from .endpoint import asubmit_query
+
+logger = logging.getLogger(__name__)
+
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+_RESULT_PATH = re.compile(r"^/v1/submissions/([^/]+)(/result)?$")
+
+
+class QueueFullError(Exception):
+    """Raised when a submission arrives while the job queue is full."""
+
+
+class Job:
+    """A submission and its grading outcome."""
+
+    def __init__(self, request_id: str, request: SubmitQueryRequest):
+        self.request_id = request_id
+        # dropped once graded, inline answer images are not kept with the result
+        self.request: Optional[SubmitQueryRequest] = request
+        self.submission_id = request.submission_id
+        self.status = "queued"
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # QueryRepsonse serialized once when the job finishes, served as is
+        self.result: Optional[str] = None
+        self.error_message: Optional[str] = None
+        self.done = asyncio.Event()
+
+    def view(self) -> dict:
+        return {
+            "request_id": self.request_id,
+            "submission_id": self.submission_id,
+            "status": self.status,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error_message": self.error_message,
+        }
+
+
+class GradingService:
+    """Bounded job queue graded by a pool of async workers."""
+
+    def __init__(self,
+                 queue_size: int = 500,
+                 workers: int = 20,
+                 result_ttl_seconds: float = 3600.0,
+                 max_finished_jobs: int = 10000,
+                 max_finished_bytes: int = 256 * 1024 * 1024,
+                 graph=None,
+                ):
+        """Initialize the service.
+
+        Args:
+            queue_size: Submissions waiting for a worker before new ones are refused with 429
+            workers: Submissions graded at once
+            result_ttl_seconds: Finished jobs can be fetched for this long
+            max_finished_jobs: The oldest finished jobs beyond this are dropped
+            max_finished_bytes: The oldest finished jobs are dropped while their results hold more than this
+            graph: compiled async graph, defaults to the shared one
+        """
+        self.queue_size = queue_size
+        self.workers = workers
+        self.result_ttl_seconds = result_ttl_seconds
+        self.max_finished_jobs = max_finished_jobs
+        self.max_finished_bytes = max_finished_bytes
+        self._finished_bytes = 0
+        self.graph = graph
+        self.jobs: Dict[str, Job] = {}
+        # finished request ids in completion order with their result size, the oldest are evicted first
+        self._finished: "OrderedDict[str, tuple]" = OrderedDict()
+        self.counters = {"accepted": 0, "rejected": 0, "done": 0, "failed": 0}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+
+    async def start(self):
+        """Start the workers, on the event loop that serves the requests."""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Grading service started : {self.workers} workers, queue of {self.queue_size}")
+
+    async def stop(self):
+        """Cancel the workers, queued and running jobs are abandoned."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def submit(self, request: SubmitQueryRequest, request_id: Optional[str] = None) -> Job:
+        """Queue a submission, an already known request id returns its job.
+
+        Raises:
+            QueueFullError: the queue holds queue_size submissions already
+        """
+        if self._queue is None:
+            raise RuntimeError("The grading service is not started")
+        if request_id is not None and request_id in self.jobs:
+            return self.jobs[request_id]
+        self._evict()
+        job = Job(request_id or uuid.uuid4().hex, request)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.counters["rejected"] += 1
+            raise QueueFullError(f"{self.queue_size} submissions are already waiting")
+        self.jobs[job.request_id] = job
+        self.counters["accepted"] += 1
+        return job
+
+    def get(self, request_id: str) -> Optional[Job]:
+        return self.jobs.get(request_id)
+
+    def _evict(self):
+        """Drop finished jobs past their ttl, then the oldest ones beyond max_finished_jobs or max_finished_bytes."""
+        oldest = time.time() - self.result_ttl_seconds
+        while self._finished:
+            request_id, (finished_at, size) = next(iter(self._finished.items()))
+            if (finished_at >= oldest and len(self._finished) <= self.max_finished_jobs
+                    and self._finished_bytes <= self.max_finished_bytes):
+                break
+            del self._finished[request_id]
+            self._finished_bytes -= size
+            self.jobs.pop(request_id, None)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                response = await asubmit_query(job.request, graph=self.graph, queued_time=job.submitted_at)
+                job.result = response.model_dump_json()
+                job.status = "done" if response.success else "failed"
+                job.error_message = response.error_message
+            except Exception as e:
+                logger.error(f"Grading failed for request {job.request_id}: {str(e)}")
+                job.status = "failed"
+                job.error_message = str(e)
+            job.request = None
+            job.finished_at = time.time()
+            size = len(job.result or "")
+            self._finished[job.request_id] = (job.finished_at, size)
+            self._finished_bytes += size
+            self._evict()
+            self.counters[job.status] += 1
+            job.done.set()
+            self._queue.task_done()
+
+    def health(self) -> dict:
+        statuses = {}
+        for job in self.jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {"status": "ok" if self.running else "stopped", "queue_depth": self.queue_depth(),
+                "queue_size": self.queue_size, "workers": self.workers, "jobs": statuses, **self.counters}
+
+
+def service_from_settings() -> GradingService:
+    """ Build the service from the service section of config/settings.yaml"""
+    service_settings = settings.get("service", {})
+    return GradingService(
+        queue_size=service_settings.get("queue_size", 500),
+        workers=service_settings.get("workers", 20),
+        result_ttl_seconds=service_settings.get("result_ttl_seconds", 3600),
+        max_finished_jobs=service_settings.get("max_finished_jobs", 10000),
+        max_finished_bytes=int(service_settings.get("max_finished_mb", 256) * 1024 * 1024),
+    )
+
+
+async def _read_body(receive, max_bytes: int) -> Optional[bytes]:
+    """ Read the request body, None when it is larger than max_bytes"""
+    body = bytearray()
+    while True:
+        message = await receive()
+        body.extend(message.get("body", b""))
+        if len(body) > max_bytes:
+            return None
+        if not message.get("more_body", False):
+            return bytes(body)
+
+async def _send_json(send, status: int, payload, headers: Optional[dict] = None):
+    body = payload.encode("utf-8") if isinstance(payload, str) else json.dumps(payload).encode("utf-8")
+    raw_headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    raw_headers += [(key.lower().encode(), str(value).encode()) for key, value in (headers or {}).items()]
+    await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+def create_app(service: Optional[GradingService] = None):
+    """ Return the ASGI app serving a grading service, built from config/settings.yaml unless given.
+
+    The workers start with the server (ASGI lifespan), callers driving the app without a
+    lifespan (e.g. httpx.ASGITransport) start the service themselves.
+    """
+    state = {"service": service}
+
+    def current() -> GradingService:
+        if state["service"] is None:
+            state["service"] = service_from_settings()
+        return state["service"]
+
+    async def lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await current().start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await current().stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        grading = current()
+        if not grading.running:
+            return await _send_json(send, 503, {"error": "the grading service is not started"})
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope.get("headers", [])}
+        request_id = headers.get("x-request-id")
+        if request_id is not None and not _REQUEST_ID.match(request_id):
+            return await _send_json(send, 400, {"error": "X-Request-ID must be 1-128 letters, digits or ._:-"})
+        method, path = scope["method"], scope["path"].rstrip("/")
+
+        if path == "/v1/health" and method == "GET":
+            return await _send_json(send, 200, grading.health())
+
+        if path == "/v1/submissions":
+            if method != "POST":
+                return await _send_json(send, 405, {"error": "use POST"}, {"Allow": "POST"})
+            max_bytes = int(settings.get("service", {}).get("max_body_mb", 20) * 1024 * 1024)
+            body = await _read_body(receive, max_bytes)
+            if body is None:
+                return await _send_json(send, 413, {"error": f"body larger than {max_bytes} bytes"})
+            try:
+                request = SubmitQueryRequest.model_validate_json(body)
+            except ValidationError as e:
+                return await _send_json(send, 400, {"error": "invalid SubmitQueryRequest", "details": json.loads(e.json())})
+            try:
+                job = grading.submit(request, request_id)
+            except QueueFullError as e:
+                retry_after = settings.get("service", {}).get("retry_after_seconds", 5)
+                return await _send_json(send, 429, {"error": f"queue full, {str(e)}"}, {"Retry-After": retry_after})
+            return await _send_json(send, 202, {**job.view(), "queue_depth": grading.queue_depth()},
+                                    {"X-Request-ID": job.request_id, "Location": f"/v1/submissions/{job.request_id}"})
+
+        match = _RESULT_PATH.match(path)
+        if match is None:
+            return await _send_json(send, 404, {"error": f"no route {method} {path}"})
+        if method != "GET":
+            return await _send_json(send, 405, {"error": "use GET"}, {"Allow": "GET"})
+        job = grading.get(match.group(1))
+        if job is None:
+            return await _send_json(send, 404, {"error": f"unknown request id {match.group(1)}"})
+        echo = {"X-Request-ID": job.request_id}
+        if match.group(2) is None:
+            return await _send_json(send, 200, job.view(), echo)
+        wait = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("wait")
+        if job.finished_at is None and wait:
+            try:
+                await asyncio.wait_for(job.done.wait(), timeout=min(float(wait[0]), 300.0))
+            except (asyncio.TimeoutError, ValueError):
+                pass
+        if job.finished_at is None:
+            return await _send_json(send, 202, job.view(), echo)
+        if job.result is None:
+            return await _send_json(send, 500, job.view(), echo)
+        return await _send_json(send, 200, job.result, echo)
+
+    app.service = current
+    return app
+
+
+app = create_app()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the grading service over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("The grading service needs an ASGI server : pip install uvicorn")
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run(app, host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
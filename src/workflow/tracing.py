@@ -0,0 +1,214 @@
+"""
+Structured tracing of a grading run.
+
+Every submission gets a root span, every node execution a node span and every LLM call
+an llm span, each recording its wall time, model, tokens, cost, retries and outcome.
+Spans are plain dicts collected in the graph state, returned on the response and can be
+appended to a local JSONL file, either one span per line or as OTLP/JSON trace records.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from functools import wraps
+from inspect import iscoroutinefunction
+from pathlib import Path
+from typing import List, Optional
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def new_trace_context() -> dict:
+    """ Ids of a new trace and of its root span"""
+    return {"trace_id": uuid.uuid4().hex, "span_id": uuid.uuid4().hex[:16]}
+
+def make_span(name: str,
+              kind: str,
+              trace_context: dict,
+              start_time: float,
+              end_time: float,
+              parent_span_id: Optional[str] = None,
+              span_id: Optional[str] = None,
+              **attributes) -> dict:
+    """ Build a span, times are unix timestamps in seconds"""
+    return {
+        "trace_id": trace_context["trace_id"],
+        "span_id": span_id or uuid.uuid4().hex[:16],
+        "parent_span_id": parent_span_id,
+        "name": name,
+        "kind": kind,
+        "start_time": start_time,
+        "end_time": end_time,
+        "wall_time": end_time - start_time,
+        **attributes,
+    }
+
+def llm_span(trace_context: dict, name: str, response, start_time: float, end_time: float,
+             queue_time: float = 0.0, retries: int = 0) -> dict:
+    """ Span of one LLM call, parented to its node span when the node is traced"""
+    return make_span(
+        name, "llm_call", trace_context, start_time, end_time,
+        queue_time=queue_time,
+        model=response.model,
+        input_tokens=response.input_tokens,
+        output_tokens=response.output_tokens,
+        cached_input_tokens=getattr(response, "cached_input_tokens", 0),
+        cost=response.cost,
+        cache_hit=getattr(response, "cache_hit", False),
+        retries=retries,
+        success=response.success,
+        error_message=response.error_message,
+    )
+
+def _node_update(name: str, state: dict, update, start_time: float, end_time: float):
+    """ Add the node span to the node update and parent the llm spans of the node to it"""
+    trace_context = state.get("trace_context")
+    if not trace_context or not isinstance(update, dict):
+        return update
+    node_span_id = uuid.uuid4().hex[:16]
+    children = [{**span, "parent_span_id": span["parent_span_id"] or node_span_id} for span in update.get("trace", [])]
+    # a node that already ran in this trace (feedback re-run) counts as a retry
+    retries = sum(1 for span in state.get("trace") or [] if span["kind"] == "node" and span["name"] == name)
+    node_span = make_span(
+        name, "node", trace_context, start_time, end_time,
+        parent_span_id=trace_context["span_id"], span_id=node_span_id,
+        model=next((span["model"] for span in children), None),
+        input_tokens=update.get("input_tokens", 0),
+        output_tokens=update.get("output_tokens", 0),
+        cached_input_tokens=update.get("cached_input_tokens", 0),
+        cost=update.get("cost", 0.0),
+        llm_calls=len(children),
+        retries=retries,
+        success=update.get("success", True) is not False,
+        error_message=update.get("error_message"),
+    )
+    return {**update, "trace": [node_span] + children}
+
+def traced(name: str, node):
+    """ Wrap a graph node so each execution records a node span"""
+    if iscoroutinefunction(node):
+        @wraps(node)
+        async def async_wrapper(state):
+            start_time = time.time()
+            update = await node(state)
+            return _node_update(name, state, update, start_time, time.time())
+        return async_wrapper
+
+    @wraps(node)
+    def wrapper(state):
+        start_time = time.time()
+        update = node(state)
+        return _node_update(name, state, update, start_time, time.time())
+    return wrapper
+
+def root_span(trace_context: dict, state: dict, start_time: float, end_time: float,
+              queue_time: float = 0.0, submission_id: Optional[str] = None) -> dict:
+    """ Span of the whole submission, totals come from the final state"""
+    return make_span(
+        "submission", "submission", trace_context, start_time, end_time,
+        span_id=trace_context["span_id"],
+        queue_time=queue_time,
+        submission_id=submission_id,
+        input_tokens=state.get("input_tokens", 0),
+        output_tokens=state.get("output_tokens", 0),
+        cached_input_tokens=state.get("cached_input_tokens", 0),
+        cost=state.get("cost", 0.0),
+        success=state.get("success", True) is not False,
+        error_message=state.get("error_message"),
+    )
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def to_otlp(spans: List[dict]) -> dict:
+    """ Convert the spans of one trace into an OTLP/JSON ExportTraceServiceRequest"""
+    reserved = {"trace_id", "span_id", "parent_span_id", "name", "start_time", "end_time"}
+    otlp_spans = []
+    for span in spans:
+        otlp_span = {
+            "traceId": span["trace_id"],
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "kind": 3 if span["kind"] == "llm_call" else 1, # client / internal
+            "startTimeUnixNano": str(int(span["start_time"] * 1e9)),
+            "endTimeUnixNano": str(int(span["end_time"] * 1e9)),
+            "attributes": [{"key": f"grading.{key}", "value": _otlp_value(value)}
+                           for key, value in span.items() if key not in reserved and value is not None],
+            "status": {"code": 1} if span.get("success", True) else {"code": 2, "message": span.get("error_message") or ""},
+        }
+        if span["parent_span_id"]:
+            otlp_span["parentSpanId"] = span["parent_span_id"]
+        otlp_spans.append(otlp_span)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "grading-workflow"}}]},
+        "scopeSpans": [{"scope": {"name": "src.workflow.tracing"}, "spans": otlp_spans}],
+    }]}
+
+
+class TraceExporter:
+    """Appends finished traces to a local file, as JSONL spans or OTLP/JSON records."""
+
+    def __init__(self, path: str, format: str = "jsonl"):
+        """Initialize the exporter.
+
+        Args:
+            path: File the traces are appended to
+            format: jsonl (one span per line) or otlp (one OTLP/JSON trace per line)
+        """
+        if format not in ("jsonl", "otlp"):
+            raise ValueError(f"Unknown trace export format {format}, expected jsonl or otlp")
+        self.path = Path(path)
+        self.format = format
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[dict]):
+        if not spans:
+            return
+        if self.format == "otlp":
+            lines = [json.dumps(to_otlp(spans), default=str)]
+        else:
+            lines = [json.dumps(span, default=str) for span in spans]
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+
+
+_exporter: Optional[TraceExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def tracing_enabled() -> bool:
+    return settings.get("tracing", {}).get("enabled", False)
+
+def get_trace_exporter() -> Optional[TraceExporter]:
+    """Return the process wide exporter configured in config/settings.yaml, None when export is off."""
+    global _exporter
+    trace_settings = settings.get("tracing", {})
+    if not trace_settings.get("export_path"):
+        return None
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = TraceExporter(trace_settings["export_path"], trace_settings.get("export_format", "jsonl"))
+    return _exporter
+
+def export_trace(spans: List[dict]):
+    """ Export the spans of a finished submission, export errors never fail the grading"""
+    exporter = get_trace_exporter()
+    if exporter is None:
+        return
+    try:
+        exporter.export(spans)
+    except Exception as e:
+        logger.error(f"Trace export failed: {str(e)}")
@@ -2,31 +2,79 @@
 Build the workflow using lang graph abstractions
 """
 
-from typing import Annotated, TypedDict, Dict, List, Any
+from typing import Annotated, TypedDict, Dict, List, Any, Optional
+from config import settings
 from .nodes import extractor, solution_pathway_analyzer ,content_analyzer, feedback_generator, value_point_analyzer
-from .nodes import mark_validation, rerun_checker
-from .nodes import State
+from .nodes import aextractor, asolution_pathway_analyzer, acontent_analyzer, afeedback_generator, avalue_point_analyzer
+from .nodes import image_preprocessor, aimage_preprocessor, mark_validation, rerun_checker, join_results
+from .nodes import dedupe, dedupe_checker, fused_analyzer, afused_analyzer, grading_path
+from .nodes import State, with_progress
+from .dedupe import dedupe_enabled
+from .tracing import traced, tracing_enabled
 from langgraph.graph import StateGraph, START, END
 
-def build_workflow():
+def build_workflow(asynchronous: bool = False, fused: Optional[bool] = None, checkpointer=None):
+    """ Build and compile the grading graph.
+
+    Args:
+        asynchronous: use the async llm nodes, the graph should then be run with ainvoke
+        fused: grade the numerical questions of the fused_analysis complexities with a single
+            classify, analyse and grade call, defaults to fused_analysis in config/settings.yaml
+        checkpointer: langgraph checkpoint saver, runs are then keyed by a thread id (the submission id)
+    """
+    if fused is None:
+        fused = settings.get("fused_analysis", {}).get("enabled", False)
+    dedupe_on = dedupe_enabled()
     # Build workflow  
     router_builder = StateGraph(State)
+    trace = tracing_enabled()
+    def add_node(name, node, **kwargs):
+        # node start / end go to the custom stream, every execution records a span when tracing is enabled
+        node = with_progress(name, node)
+        router_builder.add_node(name, traced(name, node) if trace else node, **kwargs)
     # Add nodes
-    router_builder.add_node("extractor", extractor)
-    router_builder.add_node("solution_pathway_analyzer",solution_pathway_analyzer)
-    router_builder.add_node("content_analyzer", content_analyzer)
-    router_builder.add_node("feedback_generator", feedback_generator)
-    router_builder.add_node("mark_validation", mark_validation)
+    add_node("image_preprocessor", aimage_preprocessor if asynchronous else image_preprocessor)
+    add_node("extractor", aextractor if asynchronous else extractor)
+    if dedupe_on:
+        add_node("dedupe", dedupe)
+    add_node("solution_pathway_analyzer", asolution_pathway_analyzer if asynchronous else solution_pathway_analyzer)
+    add_node("content_analyzer", acontent_analyzer if asynchronous else content_analyzer)
+    add_node("feedback_generator", afeedback_generator if asynchronous else feedback_generator)
+    if fused:
+        add_node("fused_analyzer", afused_analyzer if asynchronous else fused_analyzer)
+    add_node("mark_validation", mark_validation)
     
-    router_builder.add_node("value_point_analyzer", value_point_analyzer)
+    add_node("value_point_analyzer", avalue_point_analyzer if asynchronous else value_point_analyzer)
+    # deferred so it runs once, after every branch (including feedback re-runs) has finished
+    add_node("join_results", join_results, defer=True)
     # add edges to connect nodes
-    router_builder.add_edge(START, "extractor")
-    router_builder.add_edge("extractor", "solution_pathway_analyzer")
+    router_builder.add_edge(START, "image_preprocessor")
+    router_builder.add_edge("image_preprocessor", "extractor")
+    # after extraction : duplicates of an already graded answer skip straight to the end,
+    # fused questions take the single call path, the rest the three call chain
+    paths = {"three_call": "solution_pathway_analyzer"}
+    if dedupe_on:
+        router_builder.add_edge("extractor", "dedupe")
+        paths["reuse"] = "join_results"
+    if fused:
+        paths["fused"] = "fused_analyzer"
+    def grading_route(state):
+        if dedupe_on and dedupe_checker(state) == "reuse":
+            return "reuse"
+        return grading_path(state) if fused else "three_call"
+    router_builder.add_conditional_edges("dedupe" if dedupe_on else "extractor", grading_route, paths)
     router_builder.add_edge("solution_pathway_analyzer", "content_analyzer")
+    # value points only need the content analysis, they run in parallel with the feedback
     router_builder.add_edge("content_analyzer", "feedback_generator")
+    router_builder.add_edge("content_analyzer", "value_point_analyzer")
     router_builder.add_edge("feedback_generator", "mark_validation")
     router_builder.add_conditional_edges(
-    "mark_validation", rerun_checker,{"pass": "value_point_analyzer", "rerun": "feedback_generator"})
-    router_builder.add_edge("value_point_analyzer", END)
-    router_workflow = router_builder.compile()
-    return router_workflow
\ No newline at end of file
+    "mark_validation", rerun_checker,{"pass": "join_results", "rerun": "feedback_generator"})
+    if fused:
+        # the fused call delivers the content analysis, value points and validation continue from it
+        router_builder.add_edge("fused_analyzer", "mark_validation")
+        router_builder.add_edge("fused_analyzer", "value_point_analyzer")
+    router_builder.add_edge("value_point_analyzer", "join_results")
+    router_builder.add_edge("join_results", END)
+    router_workflow = router_builder.compile(checkpointer=checkpointer)
+    return router_workflow